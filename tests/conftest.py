@@ -0,0 +1,122 @@
+# Shared fixtures for the xMD tests
+# fake_gmx puts a stand-in gmx on PATH that writes the files mdrun, grompp and friends would,
+# so the scheduling and supervision code can be tested without GROMACS.
+import os
+import sys
+import stat
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FAKE_GMX = textwrap.dedent('''\
+    #!{python}
+    import os, sys, time, signal
+    args = sys.argv[1:]
+    def opt(name, default=None):
+        return args[args.index(name) + 1] if name in args else default
+    with open(os.environ["FAKE_GMX_CALLS"], "a") as f:
+        f.write(" ".join(args) + "\\n")
+    command = args[0]
+    if command == "grompp":
+        with open(opt("-o"), "w") as f:
+            f.write("tpr " + opt("-f") + " " + str(time.time_ns()) + "\\n")
+    elif command == "mdrun":
+        deffnm = opt("-deffnm")
+        # FAKE_MDRUN_PERFORMANCE gives the ns/day per -ntomp, e.g. "2:60,4:fail"
+        performance = dict(item.split(":") for item in os.environ.get("FAKE_MDRUN_PERFORMANCE", "").split(",") if item)
+        ns_per_day = performance.get(opt("-ntomp"), "45.123")
+        if os.environ.get("FAKE_MDRUN_FAIL") or ns_per_day == "fail":
+            sys.stderr.write("Fatal error: fake failure\\n")
+            sys.exit(1)
+        stop = []
+        if not os.environ.get("FAKE_MDRUN_IGNORE_INT"):
+            signal.signal(signal.SIGINT, lambda *a: stop.append(1))
+        else:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        total = float(os.environ.get("FAKE_MDRUN_TIME", "0.2"))
+        n = 10
+        for i in range(n):
+            if stop:
+                sys.stderr.write("\\nReceived the INT signal, stopping within 100 steps\\n")
+                break
+            time.sleep(total / n)
+            sys.stderr.write("\\rimb F  2%% step %d, remaining wall clock time: %d s   " % (i * 500, total * (n - i) / n))
+            sys.stderr.flush()
+        output = deffnm + (".part0002" if "-noappend" in args else "")
+        last_step = int(os.environ.get("FAKE_MDRUN_STEPS", "1000"))
+        with open(output + ".log", "w") as f:
+            for step in (0, last_step):
+                f.write("           Step           Time\\n%15d%15.5f\\n\\n" % (step, step * 0.002))
+                f.write("   Energies (kJ/mol)\\n    Temperature\\n    3.00000e+02\\n\\n")
+            f.write("Performance:       %s        0.532\\n" % ns_per_day)
+        for extension in (".gro", ".xtc", ".edr"):
+            with open(output + extension, "w") as f:
+                f.write(extension + "\\n")
+        with open(deffnm + ".cpt", "w") as f:
+            f.write("cpt\\n")
+        sys.stderr.write("\\nWriting final coordinates.\\nPerformance:       %s        0.532\\n" % ns_per_day)
+    elif command == "trjconv":
+        sys.stdin.read()
+        with open(opt("-o"), "w") as f:
+            f.write("trjconv\\n")
+    elif command == "convert-tpr":
+        with open(opt("-o"), "w") as f:
+            f.write("tpr extended\\n")
+    ''')
+
+
+@pytest.fixture
+def fake_gmx(tmp_path, monkeypatch):
+    """Puts a fake gmx on PATH. Returns the path of the file its calls are logged to."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    gmx = bin_dir / "gmx"
+    gmx.write_text(FAKE_GMX.format(python=sys.executable))
+    gmx.chmod(gmx.stat().st_mode | stat.S_IEXEC)
+    calls = tmp_path / "gmx_calls.txt"
+    calls.write_text("")
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_GMX_CALLS", str(calls))
+    return calls
+
+
+GRO = """test
+    3
+    1ALA     CA    1   1.000   1.000   1.000
+    2ALA     CA    2   1.380   1.000   1.000
+    3ALA     CA    3   1.760   1.000   1.000
+   3.00000   3.00000   3.00000
+"""
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch, fake_gmx):
+    """
+    A trial directory with config and topology files for the pdbcode TEST, as the working directory.
+    md.mdp and md2.mdp differ in more than the run length, so one segment never extends the other.
+    """
+    root = tmp_path / "project"
+    (root / "config").mkdir(parents=True)
+    (root / "topology").mkdir()
+    (root / "config" / "md.mdp").write_text("integrator = md\nnsteps = 1000\ndt = 0.002\nref-t = 300\n")
+    (root / "config" / "md2.mdp").write_text("integrator = md\nnsteps = 1000\ndt = 0.002\nref-t = 310\n")
+    (root / "topology" / "APO_TEST.top").write_text("[ system ]\ntest\n\n[ molecules ]\n")
+    (root / "topology" / "APO_TEST_npt.gro").write_text(GRO)
+    monkeypatch.chdir(root)
+    return root
+
+
+def make_settings(**overrides):
+    from xMD.MD_Settings import GROMACS_Settings
+
+    settings = GROMACS_Settings("T", "TEST")
+    settings.suffix = "APO_md"
+    settings.search = "APO"
+    settings.gmx_mpi_on = False
+    settings.trajectory_backend = "gmx"
+    settings.tb_buffered = False
+    for key, value in overrides.items():
+        setattr(settings, key, value)
+    return settings
@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import make_settings
+from xMD.Analysis import (StructuralSelection, analyse_trajectories, kabsch_align, plan_tasks, radius_of_gyration,
+                          residue_contacts)
+from xMD.Structure import Structure, write_gro
+from xMD.XTC import XTCWriter
+
+N_RES = 8
+
+
+def rotation(angle, axis):
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    k = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k @ k
+
+
+def peptide():
+    """N and CA of N_RES alanines along a helix, then two waters."""
+    rng = np.random.default_rng(0)
+    t = np.arange(N_RES) * 1.7
+    ca = np.stack([0.23 * np.cos(t), 0.23 * np.sin(t), 0.15 * np.arange(N_RES)], axis=1) + 1.5
+    n = ca + rng.normal(0, 0.05, ca.shape)
+    coords = np.concatenate([np.stack([n, ca], axis=1).reshape(-1, 3), [[0.2, 0.2, 0.2], [2.8, 2.8, 2.8]]])
+    resids = np.concatenate([np.repeat(np.arange(1, N_RES + 1), 2), [N_RES + 1, N_RES + 2]])
+    resnames = np.array(["ALA"] * 2 * N_RES + ["SOL"] * 2)
+    names = np.array(["N", "CA"] * N_RES + ["OW"] * 2)
+    return Structure(coords.astype(np.float32), resids, resnames, names, np.eye(3) * 3.0)
+
+
+def write_trajectory(path, coords, first_step=0):
+    n_frames = len(coords)
+    with XTCWriter(str(path)) as writer:
+        writer.write_chunk(first_step + 10 * np.arange(n_frames), 0.02 * (first_step + 10 * np.arange(n_frames)),
+                           np.tile(np.eye(3, dtype=np.float32) * 3.0, (n_frames, 1, 1)), coords.astype(np.float32))
+
+
+def moving(structure, n_frames, seed=1):
+    """Frames of the structure rotated, translated and slightly perturbed."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(n_frames):
+        rotated = (structure.coords - 1.5) @ rotation(rng.uniform(0, np.pi), rng.normal(size=3)).T + 1.5
+        frames.append(rotated + rng.uniform(-0.1, 0.1, 3) + rng.normal(0, 0.01, rotated.shape))
+    return np.array(frames)
+
+
+def test_kabsch_align_removes_rotation_and_translation():
+    rng = np.random.default_rng(2)
+    reference = rng.normal(size=(20, 3))
+    reference -= reference.mean(axis=0)
+    coords = np.stack([reference @ rotation(angle, [1, 2, 3]).T + 5.0 for angle in (0.0, 1.0, 3.0)])
+    fitted, rmsd = kabsch_align(coords, reference)
+    assert np.allclose(rmsd, 0.0, atol=1e-9)
+    assert np.allclose(fitted, reference)
+
+    # a mirror image is not superimposed by a rotation
+    _, rmsd = kabsch_align(reference[None] * [-1, 1, 1], reference)
+    assert rmsd[0] > 0.1
+
+
+def test_radius_of_gyration():
+    coords = np.array([[[0.0, 0.0, 0.0], [2.0, 0.0, 0.0]]])
+    assert radius_of_gyration(coords, np.array([1.0, 1.0])) == pytest.approx([1.0])
+    # the heavier atom pulls the centre towards it
+    assert radius_of_gyration(coords, np.array([3.0, 1.0])) == pytest.approx([np.sqrt(0.75)])
+
+
+def test_residue_contacts_match_the_pairwise_distances():
+    rng = np.random.default_rng(3)
+    coords = rng.uniform(0, 2, (4, 30, 3))
+    contacts = residue_contacts(coords, cutoff=0.8, min_separation=3)
+    distances = np.linalg.norm(coords[:, :, None] - coords[:, None], axis=3)
+    separation = np.abs(np.subtract.outer(np.arange(30), np.arange(30))) >= 3
+    assert contacts.shape == (4, 30, 30)
+    assert np.array_equal(contacts, (distances < 0.8) & separation)
+
+
+def test_plan_tasks_splits_segments_and_drops_repeated_frames(tmp_path):
+    structure = peptide()
+    frames = moving(structure, 12)
+    write_trajectory(tmp_path / "seg_0.xtc", frames[:7])
+    # a continued segment starts with the last frame of the previous one
+    write_trajectory(tmp_path / "seg_1.xtc", frames[6:], first_step=60)
+    write_trajectory(tmp_path / "other_0.xtc", frames[:3])
+    paths = [str(tmp_path / name) for name in ("seg_0.xtc", "seg_1.xtc", "other_0.xtc")]
+    tasks = plan_tasks(paths, [(1, 0), (1, 1), (2, 0)], frames_per_task=4)
+    assert [(key, n_frames) for key, _, _, n_frames in tasks] == [((1, 0), 4), ((1, 0), 3), ((1, 1), 4),
+                                                                  ((1, 1), 1), ((2, 0), 3)]
+    assert sum(n_frames for *_, n_frames in tasks) == 7 + 6 - 1 + 3
+    # the ranges start at frame boundaries
+    assert tasks[0][2] == 0 and tasks[1][2] > 0
+
+
+def test_analysis_matches_a_direct_computation(tmp_path):
+    structure = peptide()
+    write_gro(str(tmp_path / "ref.gro"), structure)
+    coords = moving(structure, 30)
+    write_trajectory(tmp_path / "seg_0.xtc", coords[:17])
+    write_trajectory(tmp_path / "seg_1.xtc", coords[17:], first_step=170)
+    selection = StructuralSelection.from_structure(str(tmp_path / "ref.gro"))
+    assert list(selection.fit_atoms) == list(range(1, 2 * N_RES, 2))
+
+    frames, rmsf, contact_maps = analyse_trajectories([str(tmp_path / "seg_0.xtc"), str(tmp_path / "seg_1.xtc")],
+                                                      [(1, 0), (1, 1)], selection, max_workers=2, chunk_size=5,
+                                                      frames_per_task=10)
+    assert len(frames) == 30
+    assert list(frames["segment"]) == [0] * 17 + [1] * 13
+    # xtc coordinates are stored to 0.001 nm
+    stored = np.round(coords * 1000) / 1000
+    ca = stored[:, selection.fit_atoms]
+    fitted, rmsd = kabsch_align(ca, selection.reference)
+    assert np.allclose(frames["RMSD"], rmsd, atol=1e-5)
+    assert np.allclose(frames["Rg"], radius_of_gyration(stored[:, :2 * N_RES], selection.masses), atol=1e-5)
+    contacts = residue_contacts(ca)
+    assert list(frames["Contacts"]) == list(contacts.sum(axis=(1, 2)) // 2)
+    assert np.allclose(rmsf["RMSF"], np.sqrt(((fitted - fitted.mean(axis=0)) ** 2).sum(axis=2).mean(axis=0)),
+                       atol=1e-5)
+    assert list(rmsf["resid"]) == list(range(1, N_RES + 1))
+    assert np.allclose(contact_maps[(1,)], contacts.mean(axis=0))
+
+
+def test_gmx_backend_analyses_the_mol_trajectories(project, fake_gmx):
+    from xMD.xMD import xMD
+
+    experiment = xMD(make_settings(), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    rep_dir = os.path.join(experiment.dirs[experiment.settings.data_directory], "R_1")
+    structure = peptide()
+    coords = moving(structure, 12)
+    # mdrun's final structure, the whole trajectory and trjconv -dump 0's single frame
+    write_gro(os.path.join(rep_dir, "APO_md_TEST_0.gro"), structure)
+    write_trajectory(os.path.join(rep_dir, "APO_md_TEST_0-mol.xtc"), coords)
+    write_trajectory(os.path.join(rep_dir, "APO_md_TEST_0-nojump.xtc"), coords[:1])
+
+    frames = experiment.analyse_structure(max_workers=1)
+    assert len(frames) == 12
+    assert (frames["replicate"] == 1).all() and (frames["segment"] == 0).all()
@@ -0,0 +1,92 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from xMD import Archive
+from xMD.Archive import archive_segment, count_frames
+from xMD.Structure import Structure, write_gro
+from xMD.XTC import XTCWriter
+
+N_PROTEIN, N_SOLVENT, N_FRAMES = 12, 6, 10
+
+
+@pytest.fixture
+def segment(tmp_path):
+    """A segment with its raw trajectory, both pbc variants, a trr and a backup, and the .gro."""
+    base = str(tmp_path / "APO_md_TEST_0")
+    n_atoms = N_PROTEIN + N_SOLVENT
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(0.5, 2.5, (N_FRAMES, n_atoms, 3)).astype(np.float32)
+    boxes = np.tile(np.eye(3, dtype=np.float32) * 3.0, (N_FRAMES, 1, 1))
+    structure = Structure(coords[0], np.repeat(np.arange(1, 5), [6, 6, 3, 3]),
+                          np.array(["ALA"] * N_PROTEIN + ["SOL"] * N_SOLVENT), np.array(["CA"] * n_atoms),
+                          boxes[0])
+    write_gro(base + ".gro", structure)
+    for variant in ("", "-mol", "-nojump"):
+        with XTCWriter(base + variant + ".xtc") as writer:
+            writer.write_chunk(np.arange(N_FRAMES), np.arange(N_FRAMES, dtype=np.float32), boxes, coords)
+    for path in (base + ".trr", str(tmp_path / "#APO_md_TEST_0-mol.xtc.1#")):
+        with open(path, "w") as f:
+            f.write("old\n")
+    return base
+
+
+def archive(base, **kwargs):
+    return archive_segment(base, "-nojump", base + ".gro", ["-mol", "-nojump"], stride=3, **kwargs)
+
+
+def test_archive_replaces_intermediates_and_keeps_raw(segment):
+    manifest = archive(segment)
+    directory = os.path.dirname(segment)
+    assert manifest["complete"]
+    assert manifest["frames"] == {"protein": N_FRAMES, "system": 4}
+    assert manifest["source_frames"] == N_FRAMES
+    assert sorted(record["path"] for record in manifest["removed"]) == [
+        "#APO_md_TEST_0-mol.xtc.1#", "APO_md_TEST_0-mol.xtc", "APO_md_TEST_0-nojump.xtc", "APO_md_TEST_0.trr"]
+    assert sorted(os.listdir(directory)) == ["APO_md_TEST_0-archive.json", "APO_md_TEST_0-protein.pdb",
+                                             "APO_md_TEST_0-protein.xtc", "APO_md_TEST_0-system.xtc",
+                                             "APO_md_TEST_0.gro", "APO_md_TEST_0.xtc"]
+    assert count_frames(segment + "-protein.xtc") == N_FRAMES
+    # archiving again returns the manifest without touching anything
+    assert archive(segment) == manifest
+
+
+def test_raw_trajectory_is_removed_only_when_asked(segment):
+    manifest = archive(segment, keep_raw=False)
+    assert "APO_md_TEST_0.xtc" in [record["path"] for record in manifest["removed"]]
+    assert not os.path.exists(segment + ".xtc")
+
+
+def test_nothing_is_removed_if_the_source_misses_frames(segment):
+    # trjconv -dump 0 leaves a single frame
+    with XTCWriter(segment + "-nojump.xtc") as writer:
+        writer.write_frame(np.zeros((N_PROTEIN + N_SOLVENT, 3)), box=np.ones(3) * 3.0)
+    with pytest.raises(ValueError, match="1 frames"):
+        archive(segment, keep_raw=False)
+    assert os.path.exists(segment + ".xtc")
+    assert os.path.exists(segment + ".trr")
+    assert not os.path.exists(segment + "-archive.json")
+
+
+def test_interrupted_archive_finishes_its_removals(segment, monkeypatch):
+    removed = []
+
+    def fail_after_first(path):
+        if removed:
+            raise KeyboardInterrupt
+        removed.append(path)
+        os.unlink(path)
+
+    monkeypatch.setattr(Archive.os, "remove", fail_after_first)
+    with pytest.raises(KeyboardInterrupt):
+        archive(segment, keep_raw=False)
+    monkeypatch.undo()
+
+    with open(segment + "-archive.json") as f:
+        assert not json.load(f)["complete"]
+    manifest = archive(segment, keep_raw=False)
+    assert manifest["complete"]
+    assert not any(os.path.exists(os.path.join(os.path.dirname(segment), record["path"]))
+                   for record in manifest["removed"])
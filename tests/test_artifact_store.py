@@ -0,0 +1,86 @@
+import os
+
+from xMD.Artifact_Store import ArtifactStore
+from xMD.AuxMD import run_grompp
+from xMD.MDP import random_seeds
+
+NVT = """integrator = md
+nsteps = 50000
+tcoupl = V-rescale
+gen_vel = yes
+gen_temp = 300
+gen_seed = -1
+"""
+
+
+def grompp(tmp_path, mdp_text, tpr_name, store):
+    mdp = tmp_path / "nvt.mdp"
+    mdp.write_text(mdp_text)
+    structure = tmp_path / "in.gro"
+    structure.write_text("gro\n")
+    topology = tmp_path / "topol.top"
+    topology.write_text("[ system ]\n")
+    tpr = tmp_path / tpr_name
+    run_grompp(["gmx", "grompp", "-f", str(mdp), "-c", str(structure), "-p", str(topology),
+                "-o", str(tpr), "-r", str(structure), "-maxwarn", "1"], store)
+    return tpr.read_text()
+
+
+def grompp_calls(calls):
+    return sum(line.startswith("grompp") for line in calls.read_text().splitlines())
+
+
+def test_replicates_with_random_seeds_get_their_own_tpr(tmp_path, fake_gmx):
+    store = ArtifactStore(str(tmp_path / "store"))
+    first = grompp(tmp_path, NVT, "R_1.tpr", store)
+    second = grompp(tmp_path, NVT, "R_2.tpr", store)
+    assert first != second
+    assert grompp_calls(fake_gmx) == 2
+    # nothing is cached for them
+    assert os.listdir(store.tpr_index) == []
+    assert store.size() == 0
+
+
+def test_fixed_seeds_reuse_the_cached_tpr(tmp_path, fake_gmx):
+    store = ArtifactStore(str(tmp_path / "store"))
+    mdp = NVT.replace("gen_seed = -1", "gen_seed = 1234") + "ld_seed = 42\n"
+    first = grompp(tmp_path, mdp, "R_1.tpr", store)
+    second = grompp(tmp_path, mdp, "R_2.tpr", store)
+    assert first == second
+    assert grompp_calls(fake_gmx) == 1
+    # the second replicate links the stored copy of the first's tpr
+    assert os.path.samefile(tmp_path / "R_2.tpr", store.object_path(store.hash_file(str(tmp_path / "R_1.tpr"))))
+    # another seed is another key
+    grompp(tmp_path, mdp.replace("ld_seed = 42", "ld_seed = 43"), "R_3.tpr", store)
+    assert grompp_calls(fake_gmx) == 2
+
+
+def test_grompp_key_covers_contents_and_local_includes(tmp_path):
+    store = ArtifactStore(str(tmp_path / "store"))
+    for name, text in (("md.mdp", "nsteps = 10\n"), ("in.gro", "gro\n"), ("ligand.itp", "[ atoms ]\n")):
+        (tmp_path / name).write_text(text)
+    (tmp_path / "topol.top").write_text('#include "oplsaa.ff/forcefield.itp"\n#include "ligand.itp"\n')
+    paths = [str(tmp_path / name) for name in ("md.mdp", "in.gro", "topol.top")]
+    key = store.grompp_key(*paths)
+    assert store.grompp_key(*paths) == key
+    assert store.grompp_key(*paths, args=["-maxwarn", "2"]) != key
+
+    # the same contents under another name give the same key
+    (tmp_path / "copy.mdp").write_text("nsteps = 10\n")
+    assert store.grompp_key(str(tmp_path / "copy.mdp"), *paths[1:]) == key
+    (tmp_path / "ligand.itp").write_text("[ atoms ]\n1 C\n")
+    assert store.grompp_key(*paths) != key
+
+
+def test_random_seeds():
+    assert random_seeds({"gen-vel": "yes"})
+    assert random_seeds({"gen-vel": "yes", "gen-seed": "-1"})
+    assert not random_seeds({"gen-vel": "yes", "gen-seed": "7"})
+    # the thermostat draws from ld-seed
+    assert random_seeds({"gen-vel": "no", "tcoupl": "V-rescale"})
+    assert not random_seeds({"tcoupl": "V-rescale", "ld-seed": "42"})
+    assert random_seeds({"integrator": "sd"})
+    assert random_seeds({"pcoupl": "C-rescale", "ld-seed": "-1"})
+    # deterministic runs can share a tpr
+    assert not random_seeds({"integrator": "steep"})
+    assert not random_seeds({"tcoupl": "nose-hoover", "pcoupl": "Parrinello-Rahman"})
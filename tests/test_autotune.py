@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+from conftest import GRO, make_settings
+from xMD.Autotune import (MDRunTuner, apply_layout, layout_grid, layout_options, option_cores, remove_layout_options,
+                          size_bucket)
+
+LAYOUTS = [{"ntmpi": 1, "ntomp": 4, "npme": -1, "nstlist": None},
+           {"ntmpi": 2, "ntomp": 2, "npme": -1, "nstlist": 40},
+           {"ntmpi": 4, "ntomp": 1, "npme": 1, "nstlist": None}]
+
+
+def mdrun_calls(calls):
+    return [line.split() for line in calls.read_text().splitlines() if line.startswith("mdrun")]
+
+
+def test_option_cores():
+    assert option_cores(["-nt", "8", "-pin", "on"]) == 8
+    assert option_cores(["-ntmpi", "2", "-ntomp", "3"]) == 6
+    assert option_cores(["-ntomp", "3"]) == 3
+    assert option_cores(["-pin", "on"]) is None
+
+
+def test_layout_replaces_the_thread_options_and_keeps_pinning():
+    options = ["-nt", "4", "-pin", "on", "-pinoffset", "4", "-nstlist", "20"]
+    assert remove_layout_options(options) == ["-pin", "on", "-pinoffset", "4"]
+    assert apply_layout(options, LAYOUTS[1]) == ["-pin", "on", "-pinoffset", "4",
+                                                 "-ntmpi", "2", "-ntomp", "2", "-nstlist", "40"]
+    assert layout_options(LAYOUTS[2]) == ["-ntmpi", "4", "-ntomp", "1", "-npme", "1"]
+    # gmx_mpi takes its ranks from mpirun
+    assert layout_options(LAYOUTS[2], "gmx_mpi") == ["-ntomp", "1"]
+
+
+def test_layout_grid():
+    layouts = layout_grid(8, nstlist=(None,))
+    assert {(layout["ntmpi"], layout["ntomp"]) for layout in layouts} == {(1, 8), (2, 4), (4, 2), (8, 1)}
+    assert all(layout["ntmpi"] * layout["ntomp"] == 8 for layout in layouts)
+    # separate PME ranks are only tried with enough ranks
+    assert {layout["npme"] for layout in layouts if layout["ntmpi"] < 4} == {-1}
+    assert {layout["npme"] for layout in layouts if layout["ntmpi"] == 8} == {-1, 0, 2}
+    assert [layout["ntmpi"] for layout in layout_grid(8, "gmx_mpi")] == [1, 1]
+    assert max(layout["ntmpi"] for layout in layout_grid(16, gpu=True)) == 4
+
+
+def test_size_bucket():
+    assert size_bucket(87) == 87
+    assert size_bucket(23456) == 23000
+    assert size_bucket(23449) == size_bucket(23456)
+
+
+def test_tune_caches_the_fastest_layout(tmp_path, fake_gmx, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_PERFORMANCE", "4:30.5,2:60.25,1:fail")
+    (tmp_path / "in.gro").write_text(GRO)
+    (tmp_path / "short.mdp").write_text("nsteps = 5000\n")
+    cache_path = str(tmp_path / "tuning" / "layouts.json")
+    tuner = MDRunTuner(cache_path)
+    assert tuner.best(3, 4) is None
+
+    results = tuner.tune(str(tmp_path / "short.mdp"), str(tmp_path / "in.gro"), "topol.top", str(tmp_path / "probe"),
+                         cores=4, layouts=LAYOUTS, nsteps=100, pin_opts=["-pin", "on"])
+    assert [result["ns_per_day"] for result in results] == [60.25, 30.5, None]
+    assert results[0]["layout"] == LAYOUTS[1]
+
+    # one grompp for all probes, then a short mdrun per layout with the pinning kept
+    assert sum(line.startswith("grompp") for line in fake_gmx.read_text().splitlines()) == 1
+    calls = mdrun_calls(fake_gmx)
+    assert len(calls) == 3
+    assert all(call[call.index("-nsteps") + 1] == "100" and "-pin" in call for call in calls)
+
+    assert tuner.best(3, 4) == LAYOUTS[1]
+    # the cache is shared with later runs, other core counts and gpu runs are not tuned
+    cached = MDRunTuner(cache_path)
+    assert cached.best(3, 4) == LAYOUTS[1]
+    assert cached.best(3, 8) is None
+    assert cached.best(3, 4, gpu=True) is None
+    assert len(cached.history()) == 3
+
+
+def test_failed_probes_are_not_cached(tmp_path, fake_gmx, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_FAIL", "1")
+    (tmp_path / "in.gro").write_text(GRO)
+    (tmp_path / "short.mdp").write_text("nsteps = 5000\n")
+    tuner = MDRunTuner(str(tmp_path / "layouts.json"))
+    results = tuner.tune(str(tmp_path / "short.mdp"), str(tmp_path / "in.gro"), "topol.top", str(tmp_path / "probe"),
+                         cores=4, layouts=LAYOUTS[:1])
+    assert results[0]["ns_per_day"] is None
+    assert tuner.best(3, 4) is None
+    assert not (tmp_path / "layouts.json").exists()
+
+
+def test_regressions_compare_the_latest_session(tmp_path):
+    tuner = MDRunTuner(str(tmp_path / "layouts.json"))
+    for session, ns_per_day in ((1.0, 50.0), (1.0, 40.0), (2.0, 30.0), (2.0, None)):
+        tuner.record({"key": "k", "session": session, "ns_per_day": ns_per_day})
+    assert tuner.regressions() == {"k": (50.0, 30.0)}
+    assert tuner.regressions(tolerance=0.5) == {}
+
+
+def test_runs_use_the_tuned_layout(project, fake_gmx, monkeypatch):
+    from xMD.xMD import xMD
+
+    monkeypatch.setenv("FAKE_MDRUN_PERFORMANCE", "4:30,2:60")
+    (project / "config" / "md_short.mdp").write_text("integrator = md\nnsteps = 5000\ndt = 0.002\n")
+    settings = make_settings(mdrun_supervised=False, mdrun_tuning=str(project / "tuning.json"))
+    experiment = xMD(settings, "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    experiment.mdrun_opts = ["-nt", "4", "-pin", "on"]
+
+    with pytest.raises(ValueError):
+        xMD(make_settings(), "T", "TEST", 1).tune_mdrun()
+    results = experiment.tune_mdrun(layouts=LAYOUTS[:2], nsteps=100)
+    assert results[0]["layout"] == LAYOUTS[1]
+    with open(project / "tuning.json") as f:
+        assert len(json.load(f)["layouts"]) == 1
+
+    fake_gmx.write_text("")
+    experiment.run_experiment(search="APO", config_files=["md.mdp"])
+    mdrun, = mdrun_calls(fake_gmx)
+    assert "-nt" not in mdrun
+    assert mdrun[mdrun.index("-ntmpi") + 1] == "2" and mdrun[mdrun.index("-ntomp") + 1] == "2"
+    assert mdrun[mdrun.index("-nstlist") + 1] == "40"
+    assert "-pin" in mdrun
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from xMD.AuxMD import run_MD, gpu_options, aggregate_performance, partition_cores, mdrun_thread_options, traj_to_pdb
+from xMD.Structure import Structure, write_gro
+from xMD.XTC import XTCWriter
+
+
+def mdrun_calls(calls):
+    return [line.split() for line in calls.read_text().splitlines() if line.startswith("mdrun")]
+
+
+def test_gpu_run_with_pinning_gives_each_option_once(tmp_path, fake_gmx):
+    mdp = tmp_path / "md.mdp"
+    mdp.write_text("nsteps = 100\n")
+    pinning = mdrun_thread_options(4, 8)
+    run_MD(str(mdp), "in.gro", "topol.top", str(tmp_path / "seg_0.tpr"), "gmx", gpu=True, mdrun_opts=pinning)
+    command, = mdrun_calls(fake_gmx)
+    flags = [option for option in command if option.startswith("-")]
+    assert len(flags) == len(set(flags))
+    assert command[command.index("-pinoffset") + 1] == "8"
+    assert "-pme" in command
+
+
+def test_gpu_options():
+    assert gpu_options() == ["-pin", "on", "-pme", "gpu", "-pmefft", "gpu"]
+    assert gpu_options(["-pin", "on", "-pinoffset", "0"]) == ["-pme", "gpu", "-pmefft", "gpu"]
+
+
+def test_aggregate_performance():
+    # all at once: the measured rates add up
+    assert aggregate_performance([10.0, 12.0, None], 4, 3) == (22.0, False)
+    # two at a time: only an estimate
+    assert aggregate_performance([10.0, 12.0, 14.0, 16.0], 2, 4) == (26.0, True)
+    assert aggregate_performance([None], 2, 1) == (None, False)
+
+
+def test_partition_cores():
+    assert partition_cores(3, 12) == [(0, 4), (4, 4), (8, 4)]
+    assert partition_cores(2, 8, pin_stride=2) == [(0, 2), (4, 2)]
+    with pytest.raises(ValueError):
+        partition_cores(5, 4)
+
+
+def test_numpy_traj_to_pdb_writes_the_protein_of_every_frame(tmp_path):
+    n_frames = 250
+    structure = Structure(np.zeros((5, 3)), np.array([1, 1, 2, 3, 4]), np.array(["ALA", "ALA", "GLY", "SOL", "NA"]),
+                          np.array(["N", "CA", "CA", "OW", "NA"]), np.eye(3) * 3.0)
+    write_gro(str(tmp_path / "seg.gro"), structure)
+    coords = np.random.default_rng(0).uniform(0, 3, (n_frames, 5, 3)).astype(np.float32)
+    with XTCWriter(str(tmp_path / "seg.xtc")) as writer:
+        writer.write_chunk(np.arange(n_frames), np.arange(n_frames, dtype=np.float32),
+                           np.tile(np.eye(3, dtype=np.float32) * 3.0, (n_frames, 1, 1)), coords)
+
+    traj_to_pdb(str(tmp_path / "seg.xtc"), str(tmp_path / "seg.gro"), str(tmp_path / "seg.pdb"), "numpy")
+    lines = (tmp_path / "seg.pdb").read_text().splitlines()
+    atoms = [line for line in lines if line.startswith("ATOM")]
+    assert sum(line.startswith("MODEL") for line in lines) == n_frames
+    assert len(atoms) == 3 * n_frames
+    # pdb coordinates are in angstrom
+    last = np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])] for line in atoms[-3:]])
+    assert np.allclose(last, coords[-1, :3] * 10, atol=0.02)
@@ -0,0 +1,86 @@
+import os
+import json
+import time
+
+from conftest import make_settings
+from xMD import Campaign as campaign_module
+from xMD.Campaign import Campaign, CampaignJob
+
+
+def die_once(settings, job, mdrun_opts, env=None, log_path=None):
+    """Stands in for run_campaign_job: the worker dies on the first attempt of a job."""
+    if job.attempts == 1:
+        os._exit(1)
+    now = time.time()
+    return {"key": job.key, "pdbcode": job.pdbcode, "name": job.name, "rep": job.rep,
+            "cores": job.cores, "priority": job.priority, "status": "complete",
+            "start": now, "end": now, "run_time": 0.0, "cpu_time": 0.0}
+
+
+def test_allocate_takes_the_first_free_run_of_cores():
+    campaign = Campaign(make_settings(), total_cores=6)
+    free = [True, False, True, True, False, True]
+    assert campaign._allocate(free, 2) == 2
+    assert free == [True, False, False, False, False, True]
+    assert campaign._allocate(free, 2) is None
+    assert campaign._allocate(free, 1) == 0
+
+
+def test_jobs_larger_than_the_node_are_rejected():
+    campaign = Campaign(make_settings(), total_cores=4, pin_stride=2)
+    try:
+        campaign.add_job(CampaignJob("TEST", 1, ["md.mdp"], "T", cores=3))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a job needing 6 cores was accepted on 4")
+
+
+def test_campaign_runs_jobs_on_disjoint_cores(project, fake_gmx, tmp_path):
+    metrics_path = str(tmp_path / "metrics.jsonl")
+    campaign = Campaign(make_settings(mdrun_supervised=False), total_cores=2,
+                        gmx_path=str(tmp_path / "bin"), metrics_path=metrics_path,
+                        log_dir=str(tmp_path / "logs"))
+    campaign.add_matrix(["TEST"], 2, {"T": ["md.mdp"]}, cores=1, search="APO", monitor=False)
+    metrics = campaign.run()
+
+    assert sorted(metrics["status"]) == ["complete", "complete"]
+    assert sorted(metrics["rep"]) == [1, 2]
+    assert list(metrics["ns_per_day"]) == [45.123, 45.123]
+    with open(metrics_path) as f:
+        assert len([json.loads(line) for line in f]) == 2
+    assert campaign.summary["complete"] == 2
+    assert campaign.summary["mean_ns_per_day"] == 45.123
+
+    offsets = sorted(line.split()[line.split().index("-pinoffset") + 1]
+                     for line in fake_gmx.read_text().splitlines() if line.startswith("mdrun"))
+    assert offsets == ["0", "1"]
+    assert sorted(os.listdir(tmp_path / "logs")) == ["TEST_T_R_1.out", "TEST_T_R_2.out"]
+
+
+def test_failed_job_is_recorded(project, fake_gmx, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_FAIL", "1")
+    campaign = Campaign(make_settings(mdrun_supervised=False), total_cores=1)
+    campaign.add_job(CampaignJob("TEST", 1, ["md.mdp"], "T", search="APO", monitor=False))
+    metrics = campaign.run()
+    assert list(metrics["status"]) == ["failed"]
+    assert "mdrun" in metrics["error"][0]
+    assert campaign.summary["failed"] == 1
+
+
+def test_jobs_are_retried_after_the_pool_breaks(monkeypatch):
+    monkeypatch.setattr(campaign_module, "run_campaign_job", die_once)
+    campaign = Campaign(make_settings(), total_cores=1, max_attempts=2)
+    campaign.add_job(CampaignJob("TEST", 1, ["md.mdp"], "T"))
+    metrics = campaign.run()
+    assert list(metrics["status"]) == ["complete"]
+    assert list(metrics["attempts"]) == [2]
+
+
+def test_jobs_fail_once_out_of_attempts(monkeypatch):
+    monkeypatch.setattr(campaign_module, "run_campaign_job", die_once)
+    campaign = Campaign(make_settings(), total_cores=1, max_attempts=1)
+    campaign.add_job(CampaignJob("TEST", 1, ["md.mdp"], "T"))
+    metrics = campaign.run()
+    assert list(metrics["status"]) == ["failed"]
+    assert list(metrics["error"]) == ["worker process died"]
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from xMD.__main__ import build_parser, make_settings, parse_value
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = {"numpy", "pandas", "tensorboardX"}
+
+
+def imported_modules(importtime_output):
+    """Returns the names of the modules listed by python -X importtime."""
+    modules = set()
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            modules.add(name.split(".")[0])
+    return modules
+
+
+def test_status_starts_without_numpy_or_pandas(tmp_path):
+    rep_dir = tmp_path / "data" / "MD" / "TEST" / "T" / "R_1"
+    rep_dir.mkdir(parents=True)
+    for name in ("APO_md_TEST_0.tpr", "APO_md_TEST_0.gro", "APO_md_TEST_1.tpr", "APO_md_TEST_1.cpt"):
+        (rep_dir / name).write_text("")
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-m", "xMD", "status",
+                             "-P", "TEST", "-N", "T", "-S", "APO_md", "--json"],
+                            cwd=tmp_path, env=dict(os.environ, PYTHONPATH=REPO),
+                            capture_output=True, text=True, check=True)
+    report = json.loads(result.stdout)
+    assert [row["state"] for row in report["R_1"]] == ["complete", "checkpoint"]
+    modules = imported_modules(result.stderr)
+    assert "xMD" in modules
+    assert not modules & HEAVY_MODULES
+
+
+def test_parse_value_reads_json_then_strings():
+    assert parse_value("3") == 3
+    assert parse_value("0.5") == 0.5
+    assert parse_value("true") is True
+    assert parse_value("null") is None
+    assert parse_value('["-nb", "gpu"]') == ["-nb", "gpu"]
+    assert parse_value("gmx_mpi") == "gmx_mpi"
+    assert parse_value("") == ""
+
+
+def parse(*argv):
+    return build_parser().parse_args(["run", "-P", "TEST", "-N", "T"] + list(argv))
+
+
+def test_set_overrides_settings():
+    args = parse("-S", "APO_md", "--set", "gpu=true", "--set", "monitor_frequency=10",
+                 "--set", 'mdrun_gpu_opt=["-nb", "gpu"]', "--set", "environ_path=/opt/a=b")
+    settings = make_settings(args)
+    assert settings.suffix == "APO_md"
+    assert settings.gpu is True
+    assert settings.monitor_frequency == 10
+    assert settings.mdrun_gpu_opt == ["-nb", "gpu"]
+    # only the first = separates the key from the value
+    assert settings.environ_path == "/opt/a=b"
+
+
+def test_unknown_setting_is_rejected():
+    with pytest.raises(SystemExit, match="Unknown setting: gpus"):
+        make_settings(parse("--set", "gpus=1"))
+
+
+def test_subcommand_options():
+    args = parse("-R", "2", "-c", "md.mdp", "md2.mdp", "--pipeline")
+    assert (args.replicate, args.config, args.pipeline, args.monitor) == (2, ["md.mdp", "md2.mdp"], True, False)
+    args = build_parser().parse_args(["status", "-P", "TEST", "-R", "1", "3"])
+    assert args.replicate == [1, 3]
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(["status"])
+
+
+def test_experiment_module_imports_without_numpy_or_pandas(tmp_path):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import xMD.xMD"],
+                            cwd=tmp_path, env=dict(os.environ, PYTHONPATH=REPO),
+                            capture_output=True, text=True, check=True)
+    assert not imported_modules(result.stderr) & HEAVY_MODULES
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from xMD.Convergence import BlockStatistics, ConvergenceMonitor, Criterion
+from xMD.Supervisor import Supervisor
+
+
+def window_statistics(samples, block_size, n_blocks):
+    """The window statistics computed directly from the last n_blocks block means."""
+    n_full = len(samples) // block_size
+    means = np.asarray(samples[:n_full * block_size]).reshape(n_full, block_size).mean(axis=1)
+    k = np.arange(n_full)[-n_blocks:]
+    means = means[-n_blocks:]
+    slope, intercept = np.polyfit(k, means, 1)
+    residuals = means - (slope * k + intercept)
+    slope_error = np.sqrt(np.sum(residuals ** 2) / (len(k) - 2) / np.sum((k - k.mean()) ** 2))
+    return {"mean": means.mean(),
+            "sem": means.std(ddof=1) / np.sqrt(len(means)),
+            "slope": slope,
+            "drift": slope * (len(k) - 1),
+            "drift_t": slope / slope_error}
+
+
+@pytest.mark.parametrize("n_samples", [50, 57, 200])
+def test_block_statistics_match_a_direct_fit(n_samples):
+    rng = np.random.default_rng(1)
+    samples = 1000.0 + 0.01 * np.arange(n_samples) + rng.normal(0, 0.5, n_samples)
+    stats = BlockStatistics(block_size=5, n_blocks=6)
+    completed = [stats.add(value) for value in samples]
+    assert sum(completed) == n_samples // 5
+    assert stats.full
+    # the window slides, only the last 6 blocks count
+    assert [k for k, _ in stats.blocks] == list(range(n_samples // 5 - 6, n_samples // 5))
+    expected = window_statistics(samples, 5, 6)
+    for key, value in expected.items():
+        assert getattr(stats, key) == pytest.approx(value, rel=1e-6), key
+
+
+def test_statistics_need_enough_blocks():
+    stats = BlockStatistics(block_size=2, n_blocks=3)
+    assert stats.mean is None
+    for value in (1.0, 2.0, 3.0, 4.0):
+        stats.add(value)
+    assert stats.mean == 2.5
+    assert stats.slope == 2.0
+    assert stats.drift_t is None
+    assert not stats.full
+    for value in (5.0, 6.0):
+        stats.add(value)
+    # the block means are on a line, any drift is significant
+    assert stats.drift_t == np.inf
+
+
+@pytest.mark.parametrize("options", [{"n_blocks": 2}, {"n_blocks": None}, {"block_size": 0}, {"block_size": None}])
+def test_invalid_windows_are_rejected(options):
+    with pytest.raises(ValueError):
+        Criterion("Temperature", **options)
+    with pytest.raises(ValueError):
+        ConvergenceMonitor({"Temperature": options})
+
+
+def test_criterion_limits():
+    drifting = Criterion("Pressure", block_size=1, n_blocks=5, max_drift=1.0)
+    assert not any(drifting.add(float(value)) for value in range(10))
+    assert drifting.state()["drift"] == pytest.approx(4.0)
+
+    noisy = Criterion("Pressure", block_size=1, n_blocks=5, max_sem=0.1)
+    assert not any(noisy.add(value) for value in (0.0, 10.0) * 5)
+
+    # without limits only a significant drift fails
+    flat = Criterion("Temperature", block_size=1, n_blocks=4)
+    assert flat.max_drift_t == 2.0
+    assert [flat.add(value) for value in (300.0, 301.0, 299.0, 300.0)] == [False, False, False, True]
+
+
+def test_rmsd_criterion_needs_a_trajectory():
+    with pytest.raises(ValueError, match="rmsd"):
+        ConvergenceMonitor.for_segment({"nvt*.mdp": {"rmsd": {}}}, "config/nvt.mdp", "seg_0")
+    assert ConvergenceMonitor.for_segment({"nvt*.mdp": {"rmsd": {}}}, "config/npt.mdp", "seg_0") is None
+
+
+def records(values, start=0):
+    return [(start + 100 * i, 0.2 * i, {"Temperature": value, "Pressure": 1.0}) for i, value in enumerate(values)]
+
+
+def test_converged_segment_stops_its_mdrun(tmp_path, fake_gmx, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_TIME", "5")
+    monitor = ConvergenceMonitor.for_segment({"md*.mdp": {"Temperature": {"block_size": 2, "n_blocks": 3}}},
+                                             "config/md.mdp", "seg_0")
+    supervisor = Supervisor(grace_secs=3, poll_secs=0.05, verbose=False)
+    process = supervisor.start(["gmx", "mdrun", "-v", "-deffnm", str(tmp_path / "seg_0")])
+    monitor.attach(process)
+    # mdrun handles SIGINT once it is running
+    while process.progress.step is None:
+        assert not process.done.wait(0.01)
+
+    # a heating run has not converged
+    assert not monitor.feed(records([250.0, 260.0, 270.0, 280.0, 290.0, 300.0]))
+    assert process.state == "running"
+    assert monitor.feed(records([300.0, 301.0, 299.0, 300.0, 301.0, 299.0], start=600))
+    assert monitor.converged_step == 1100
+    assert process.wait(10) == 0
+    assert (process.state, process.cancel_reason) == ("cancelled", "converged")
+    assert process.progress.signal == "INT"
+    assert monitor.summary()["Temperature"]["converged"]
+
+
+def test_convergence_before_mdrun_starts_stops_it_on_attach():
+    cancelled = []
+
+    class Process():
+        def cancel(self, reason):
+            cancelled.append(reason)
+
+    monitor = ConvergenceMonitor({"Temperature": {"block_size": 1, "n_blocks": 3}})
+    assert monitor.feed(records([300.0, 300.0, 300.0]))
+    monitor.attach(Process())
+    assert cancelled == ["converged"]
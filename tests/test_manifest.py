@@ -0,0 +1,88 @@
+import json
+
+import pandas as pd
+import pytest
+
+from conftest import make_settings
+from xMD import Manifest
+from xMD.Manifest import append_manifest, compact_manifest, load_sidecar, read_manifest, save_sidecar, write_manifest
+
+
+def state(**attributes):
+    return {"class": "xMD", "settings_class": "GROMACS_Settings", "settings": {}, "attributes": attributes}
+
+
+def test_records_are_folded_in_order(tmp_path):
+    path = str(tmp_path / "exp.manifest.jsonl")
+    write_manifest(path, state(rep_no=1, segments=[{"traj_no": 0, "status": "complete"}]))
+    append_manifest(path, {"segment": {"traj_no": 1, "status": "complete"}})
+    append_manifest(path, {"segment": {"traj_no": 0, "status": "converged"}})
+    assert [(s["traj_no"], s["status"]) for s in read_manifest(path)["attributes"]["segments"]] == [
+        (0, "converged"), (1, "complete")]
+
+    # a later state replaces the earlier one, the segments recorded since are kept
+    append_manifest(path, {"state": state(rep_no=2, segments=[])})
+    append_manifest(path, {"segment": {"traj_no": 2, "status": "complete"}})
+    folded = read_manifest(path)
+    assert folded["attributes"]["rep_no"] == 2
+    assert [s["traj_no"] for s in folded["attributes"]["segments"]] == [0, 1, 2]
+
+    assert compact_manifest(path) == folded
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+    assert read_manifest(path) == folded
+
+
+def test_a_partly_written_record_is_ignored(tmp_path):
+    path = str(tmp_path / "exp.manifest.jsonl")
+    write_manifest(path, state(segments=[]))
+    append_manifest(path, {"segment": {"traj_no": 0}})
+    with open(path, "a") as f:
+        f.write('{"segment": {"traj_')
+    assert [s["traj_no"] for s in read_manifest(path)["attributes"]["segments"]] == [0]
+
+
+def test_newer_manifests_are_rejected(tmp_path):
+    path = tmp_path / "exp.manifest.jsonl"
+    path.write_text(json.dumps({"version": Manifest.MANIFEST_VERSION + 1}) + "\n")
+    with pytest.raises(ValueError, match="newer version"):
+        read_manifest(str(path))
+
+
+def test_sidecar_round_trip_and_column_selection(tmp_path):
+    path = str(tmp_path / "frame.npz")
+    dataframe = pd.DataFrame({"Step": [0, 100], "Temperature": [300.0, 301.5], "mdp": ["md.mdp", "md2.mdp"]})
+    save_sidecar(path, dataframe)
+    loaded = load_sidecar(path)
+    assert list(loaded.columns) == ["Step", "Temperature", "mdp"]
+    assert loaded["Step"].tolist() == [0, 100]
+    assert loaded["Temperature"].tolist() == [300.0, 301.5]
+    assert loaded["mdp"].tolist() == ["md.mdp", "md2.mdp"]
+    assert list(load_sidecar(path, columns=["Temperature"]).columns) == ["Temperature"]
+
+
+def test_saved_experiment_is_restored_with_its_segments(project):
+    from xMD.xMD import xMD
+
+    experiment = xMD(make_settings(), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    experiment.dataframe = pd.DataFrame({"Step": [0, 100], "Temperature": [300.0, 301.0]})
+    path = experiment.save_experiment()
+    # segments finished after the save are appended to the manifest
+    experiment.record_segment(0, "md.mdp", "APO_md_TEST_0.tpr")
+    experiment.record_segment(1, "md2.mdp", "APO_md_TEST_1.tpr", status="converged")
+
+    loaded = experiment.load_experiment(load_path=path)
+    assert type(loaded) is xMD
+    assert loaded.manifest_path == path
+    assert loaded.settings.pdbcode == "TEST"
+    assert loaded.dirs == experiment.dirs
+    assert [(s["traj_no"], s["status"]) for s in loaded.segments] == [(0, "complete"), (1, "converged")]
+    # the dataframe is read from its sidecar when it is first used
+    assert loaded._dataframe is None
+    assert loaded.dataframe["Temperature"].tolist() == [300.0, 301.0]
+
+    # saving again appends a state record to the same manifest
+    assert loaded.save_experiment() == path
+    with open(path) as f:
+        assert sum("state" in json.loads(line) for line in f) == 2
@@ -0,0 +1,145 @@
+import os
+import time
+
+from xMD.MD_Log import GROMACS_energy_parser, parse_gromacs_energy_log
+
+BLOCK = """           Step           Time
+{step:>15d}{time:>15.5f}
+
+   Energies (kJ/mol)
+      Potential    Temperature
+   -1.68027e+04    {temperature:>11.5e}
+
+"""
+
+AVERAGES = """	<======  ###############  ==>
+	<====  A V E R A G E S  ====>
+	<==  ###############  ======>
+
+	Statistics over 201 steps using 3 frames
+
+   Energies (kJ/mol)
+      Potential    Temperature
+   -1.00000e+04    1.00000e+00
+
+"""
+
+
+def write_log(path, runs):
+    with open(path, "w") as f:
+        for steps in runs:
+            for step in steps:
+                f.write(BLOCK.format(step=step, time=step * 0.002, temperature=300.0 + step))
+            f.write(AVERAGES)
+
+
+def test_blocks_are_parsed_across_chunks(tmp_path):
+    path = tmp_path / "md.log"
+    write_log(path, [range(0, 1000, 100)])
+    dataframe = parse_gromacs_energy_log(path, chunk_size=37)
+    assert dataframe["Step"].tolist() == list(range(0, 1000, 100))
+    assert dataframe["Temperature"].tolist() == [300.0 + step for step in range(0, 1000, 100)]
+
+
+def test_averages_are_not_a_frame():
+    parser = GROMACS_energy_parser()
+    records = parser.feed((BLOCK.format(step=0, time=0.0, temperature=300.0) + AVERAGES).splitlines())
+    assert [record[0] for record in records] == [0]
+
+
+def test_appended_continuation_is_parsed(tmp_path):
+    # mdrun -cpi without -noappend appends the continuation after the averages of the first run
+    path = tmp_path / "md.log"
+    write_log(path, [[0, 100, 200], [300, 400]])
+    dataframe = parse_gromacs_energy_log(path)
+    assert dataframe["Step"].tolist() == [0, 100, 200, 300, 400]
+    assert dataframe["Potential"].tolist() == [-1.68027e+04] * 5
+
+
+def test_last_energy_step_reads_the_tail(tmp_path):
+    from xMD.MD_Log import last_energy_step
+
+    path = tmp_path / "md.log"
+    write_log(path, [range(0, 5000, 100)])
+    assert last_energy_step(path, tail_bytes=400) == 4900
+    # the tail is too short to hold a frame, the whole log is parsed instead
+    assert last_energy_step(path, tail_bytes=20) == 4900
+    empty = tmp_path / "empty.log"
+    empty.write_text("no energies\n")
+    assert last_energy_step(empty) is None
+
+
+class RecordingWriter():
+    def __init__(self):
+        self.scalars = []
+
+    def add_scalar(self, tag, value, global_step=None):
+        self.scalars.append((tag, global_step, value))
+
+    def flush(self):
+        pass
+
+
+def test_live_reader_parses_only_the_appended_bytes(tmp_path):
+    from xMD.utility import live_GROMACS_log_reader
+
+    path = tmp_path / "md.log"
+    path.write_text("GROMACS header\n")
+    writer = RecordingWriter()
+    reader = live_GROMACS_log_reader("TEST", str(path), writer=writer, step_offset=1000)
+    text = BLOCK.format(step=0, time=0.0, temperature=300.0) + BLOCK.format(step=100, time=0.2, temperature=301.0)
+    # mdrun writes in pieces, a block cut in the middle of a line is held back
+    cut = text.index("3.00000e+02") + 4
+    with open(path, "a") as f:
+        f.write(text[:cut])
+    assert reader.read_log() == []
+    with open(path, "a") as f:
+        f.write(text[cut:])
+    records = reader.read_log()
+    assert [(step, energies["Temperature"]) for step, _, energies in records] == [(0, 300.0), (100, 301.0)]
+    assert reader.read_log() == []
+
+    # the averages at the end of the run are not a frame
+    with open(path, "a") as f:
+        f.write(AVERAGES)
+    assert reader.read_log() == []
+    assert reader.last_step == 100
+    assert ("TEST/Temperature", 1100, 301.0) in writer.scalars
+    assert reader.to_dataframe()["Step"].tolist() == [0, 100]
+
+
+def test_live_reader_restarts_when_the_log_is_replaced(tmp_path):
+    from xMD.utility import live_GROMACS_log_reader
+
+    path = tmp_path / "md.log"
+    write_log(path, [[0, 100]])
+    reader = live_GROMACS_log_reader("TEST", str(path))
+    assert [record[0] for record in reader.read_log()] == [0, 100]
+    # mdrun backs up the old log and starts a new one
+    os.rename(path, tmp_path / "#md.log.1#")
+    write_log(path, [[0]])
+    assert [record[0] for record in reader.read_log()] == [0]
+
+
+def test_live_reader_polls_in_the_background(tmp_path):
+    from xMD.utility import live_GROMACS_log_reader
+
+    path = tmp_path / "md.log"
+    seen = []
+
+    class Monitor():
+        def feed(self, records):
+            seen.extend(record[0] for record in records)
+
+    reader = live_GROMACS_log_reader("TEST", str(path), live=True, frequency=0.01, monitor=Monitor())
+    with reader:
+        write_log(path, [[0, 100]])
+        deadline = time.time() + 10
+        while seen != [0, 100] and time.time() < deadline:
+            time.sleep(0.01)
+        assert seen == [0, 100]
+        with open(path, "a") as f:
+            f.write(BLOCK.format(step=200, time=0.4, temperature=300.0))
+    # stopping reads what is left
+    assert seen == [0, 100, 200]
+    assert reader._thread is None
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from conftest import make_settings
+from xMD.MDP import diff_mdp, extension, read_mdp
+from xMD.xMD import xMD
+
+MD = """; production
+title    = production
+integrator = md
+nsteps   = 50000   ; 100 ps
+dt       = 0.002
+nstlist  = 10
+tcoupl   = V-rescale
+"""
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_read_mdp_normalises_names_and_values(tmp_path):
+    parameters = read_mdp(write(tmp_path, "md.mdp", MD + "ref_t = 300   300\n"))
+    assert parameters["nsteps"] == "50000"
+    assert parameters["ref-t"] == "300 300"
+    assert "; production" not in parameters
+
+
+def test_diff_mdp():
+    a = {"nsteps": "1000", "dt": "0.002", "title": "a", "tcoupl": "V-rescale"}
+    b = {"nsteps": "1000.0", "dt": "0.001", "title": "b", "tcoupl": "v-rescale", "define": "-DPOSRES"}
+    assert diff_mdp(a, b) == {"define": (None, "-DPOSRES"), "dt": ("0.002", "0.001")}
+    assert diff_mdp(a, a) == {}
+
+
+def test_extension_of_a_longer_run(tmp_path):
+    short = write(tmp_path, "short.mdp", MD.replace("50000", "5000"))
+    long = write(tmp_path, "long.mdp", MD.replace("title    = production", "title = long").replace("nstlist  = 10", "nstlist = 20"))
+    assert extension(short, long) == {"extend_ps": 100.0, "nsteps": 50000, "mdrun_opts": ["-nstlist", "20"]}
+
+
+@pytest.mark.parametrize("change", [
+    # restrained equilibration followed by unrestrained production
+    ("integrator = md", "integrator = md\ndefine = -DPOSRES"),
+    ("integrator = md", "integrator = md\ninclude = -I../ligand"),
+    ("dt       = 0.002", "dt = 0.001"),
+    ("nsteps   = 50000", "nsteps = -1"),
+])
+def test_segments_that_need_grompp_are_not_extended(tmp_path, change):
+    previous = write(tmp_path, "previous.mdp", MD.replace(*change))
+    mdp = write(tmp_path, "md.mdp", MD)
+    if change[1].startswith("nsteps"):
+        previous, mdp = mdp, previous
+    assert extension(previous, mdp) is None
+
+
+def run_segments(project, mdp_texts):
+    for name, text in mdp_texts.items():
+        (project / "config" / name).write_text(text)
+    experiment = xMD(make_settings(mdrun_supervised=False, extend_segments=True), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    experiment.run_experiment(search="APO", config_files=list(mdp_texts))
+    return experiment
+
+
+def gmx_commands(calls):
+    return [line.split()[0] for line in calls.read_text().splitlines() if not line.startswith("trjconv")]
+
+
+def test_run_extends_only_segments_with_the_same_system(project, fake_gmx):
+    posres = MD.replace("integrator = md", "integrator = md\ndefine = -DPOSRES")
+    run_segments(project, {"posres.mdp": posres, "md.mdp": MD, "md_long.mdp": MD.replace("50000", "100000")})
+    assert gmx_commands(fake_gmx) == ["grompp", "mdrun", "grompp", "mdrun", "convert-tpr", "mdrun"]
+    convert_tpr, = [line.split() for line in fake_gmx.read_text().splitlines() if line.startswith("convert-tpr")]
+    assert convert_tpr[convert_tpr.index("-extend") + 1] == "200.0"
+    assert os.path.basename(convert_tpr[convert_tpr.index("-s") + 1]) == "APO_md_TEST_1.tpr"
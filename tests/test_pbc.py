@@ -0,0 +1,89 @@
+import numpy as np
+
+from xMD.PBC import bond_tree, make_molecules_whole
+from xMD.Topology import Topology, parse_topology
+
+TOPOLOGY = """[ moleculetype ]
+BRANCH 3
+
+[ atoms ]
+1 CT 1 LIG C1 1 0.0 12.0
+2 CT 1 LIG C2 1 0.0 12.0
+3 CT 1 LIG C3 1 0.0 12.0
+
+[ bonds ]
+1 2 1
+1 3 1
+
+[ moleculetype ]
+SOL 2
+
+[ atoms ]
+1 OW 1 SOL OW 1 -0.8 16.0
+2 HW 1 SOL HW1 1 0.4 1.0
+3 HW 1 SOL HW2 1 0.4 1.0
+
+[ settles ]
+1 1 0.09572 0.15139
+
+[ moleculetype ]
+NA 1
+
+[ atoms ]
+1 NA 1 NA NA 1 1.0 23.0
+
+[ system ]
+test
+
+[ molecules ]
+BRANCH 1
+SOL 2
+NA 1
+"""
+
+BOX = 3.0
+
+
+def read_test_topology(tmp_path):
+    path = tmp_path / "test.top"
+    path.write_text(TOPOLOGY)
+    return parse_topology(str(path), include_dirs=[])
+
+
+def test_topology_bonds(tmp_path):
+    topology = read_test_topology(tmp_path)
+    np.testing.assert_array_equal(topology.molecule_starts(), [0, 3, 6, 9])
+    np.testing.assert_array_equal(topology.system_bonds(),
+                                  [[0, 1], [0, 2], [3, 4], [3, 5], [6, 7], [6, 8]])
+
+    cache = str(tmp_path / "cache.npz")
+    topology.save(cache)
+    np.testing.assert_array_equal(Topology.load(cache).system_bonds(), topology.system_bonds())
+
+
+def test_bonded_atoms_are_joined_not_consecutive_ones(tmp_path):
+    topology = read_test_topology(tmp_path)
+    # the branch atoms 2 and 3 are both bonded to atom 1 but 2.4 nm apart, more than half the box
+    whole = np.array([[2.9, 1.0, 1.0], [4.1, 1.0, 1.0], [1.7, 1.0, 1.0],
+                      [2.95, 2.0, 2.0], [3.04, 2.0, 2.0], [2.92, 2.09, 2.0],
+                      [0.5, 0.5, 0.5], [0.41, 0.5, 0.5], [0.53, 0.59, 0.5],
+                      [1.5, 1.5, 1.5]])
+    wrapped = whole % BOX
+    coords = np.stack([wrapped, wrapped]).astype(np.float32)
+    boxes = np.tile(np.eye(3, dtype=np.float32) * BOX, (2, 1, 1))
+
+    starts = topology.molecule_starts()
+    tree = bond_tree(len(whole), topology.system_bonds(), starts)
+    result = make_molecules_whole(coords, boxes, starts, tree)
+    np.testing.assert_allclose(result[1], whole, atol=1e-5)
+
+    # joining consecutive atoms breaks the branched molecule
+    consecutive = make_molecules_whole(coords, boxes, starts)
+    assert abs(consecutive[0, 2, 0] - whole[2, 0]) > 1.0
+
+
+def test_unbonded_atoms_hang_from_their_molecule():
+    # atom 2 has no bonds (a virtual site), atom 4 is a single atom molecule
+    tree = bond_tree(5, [[0, 1], [3, 1]], np.array([0, 4]))
+    edges = {int(child): int(parent) for parents, children in tree for parent, child in zip(parents, children)}
+    assert edges == {1: 0, 3: 1, 2: 0}
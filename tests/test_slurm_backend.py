@@ -0,0 +1,100 @@
+import os
+import time
+
+from conftest import make_settings
+from xMD.Campaign import Campaign, CampaignJob
+from xMD.Slurm_Backend import (LocalSlurm, SlurmArrayBackend, expand_array_ids, format_time,
+                               pack_jobs, run_task)
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def job(rep, minutes=None, cores=1, priority=0):
+    return CampaignJob("TEST", rep, ["md.mdp"], "T", cores=cores, priority=priority, minutes=minutes,
+                       search="APO", monitor=False)
+
+
+def keys(tasks):
+    return [[job.rep for job in task] for task in tasks]
+
+
+def test_short_jobs_are_packed_first_fit_decreasing():
+    jobs = [job(1, 30), job(2, 50), job(3, 20), job(4, 40), job(5, 600), job(6)]
+    tasks = pack_jobs(jobs, max_minutes=90, short_minutes=60)
+    assert keys(tasks) == [[5], [6], [2, 4], [1, 3]]
+
+
+def test_packing_keeps_core_counts_and_priorities_apart():
+    jobs = [job(1, 10, cores=2), job(2, 10, cores=4), job(3, 10, cores=2), job(4, 10, priority=5)]
+    tasks = pack_jobs(jobs, max_minutes=60, short_minutes=30)
+    assert keys(tasks) == [[4], [1, 3], [2]]
+
+
+def test_time_and_array_formats():
+    assert format_time(90) == "01:30:00"
+    assert format_time(25 * 60 + 0.5) == "1-01:00:30"
+    assert expand_array_ids("[0-3,7%2]") == [0, 1, 2, 3, 7]
+    assert expand_array_ids("5") == [5]
+
+
+def make_backend(tmp_path, **kwargs):
+    return SlurmArrayBackend(make_settings(mdrun_supervised=False), interface=LocalSlurm(),
+                             work_dir=str(tmp_path / "slurm"), cores_per_task=2,
+                             modules=[], conda_env=None, **kwargs)
+
+
+def test_array_runs_with_local_slurm(project, fake_gmx, tmp_path, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", REPO)
+    campaign = Campaign(make_settings(), total_cores=2)
+    for rep in (1, 2, 3):
+        campaign.add_job(job(rep, minutes=5))
+    backend = make_backend(tmp_path, short_minutes=10, max_minutes=10, max_running=1)
+    backend.submit(campaign)
+    assert keys(backend.tasks) == [[1, 2], [3]]
+    with open(os.path.join(backend.work_dir, "xMD.sbatch")) as f:
+        script = f.read()
+    assert "#SBATCH --array=0-1%1" in script
+    assert "#SBATCH --time=00:10:00" in script
+
+    states = backend.wait(poll=0.1, timeout=120)
+    assert states == {0: "COMPLETED", 1: "COMPLETED"}
+    assert set(backend.jobs_status().values()) == {"COMPLETED"}
+    results = backend.results()
+    assert sorted(results["rep"]) == [1, 2, 3]
+    assert set(results["status"]) == {"complete"}
+    assert sorted(results["array_task"]) == [0, 0, 1]
+    assert os.path.exists(os.path.join(backend.work_dir, f"xMD_{backend.job_id}_1.out"))
+
+
+def test_cancel_stops_running_tasks(project, fake_gmx, tmp_path, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", REPO)
+    monkeypatch.setenv("FAKE_MDRUN_TIME", "30")
+    campaign = Campaign(make_settings(), total_cores=2)
+    campaign.add_job(job(1))
+    backend = make_backend(tmp_path)
+    backend.submit(campaign)
+    deadline = time.time() + 30
+    while backend.status()[0] != "RUNNING" and time.time() < deadline:
+        time.sleep(0.05)
+    backend.cancel()
+    assert backend.wait(poll=0.1, timeout=30) == {0: "CANCELLED"}
+
+
+def test_run_task_runs_packed_jobs_and_records_metrics(project, fake_gmx, tmp_path, monkeypatch):
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", "3")
+    monkeypatch.setenv("SLURM_ARRAY_JOB_ID", "42")
+    monkeypatch.setenv("FAKE_MDRUN_FAIL", "1")
+    backend = make_backend(tmp_path)
+    os.makedirs(backend.work_dir)
+    backend.spec_path = os.path.join(backend.work_dir, "spec.json")
+    backend.metrics_path = os.path.join(backend.work_dir, "metrics.jsonl")
+    backend.write_spec("xMD", [[job(1), job(2)]])
+
+    # a failing job does not stop the one packed after it
+    assert run_task(backend.spec_path, 0) == 2
+    results = backend.results()
+    assert list(results["rep"]) == [1, 2]
+    assert list(results["slurm_job"]) == ["42", "42"]
+    mdrun_calls = [line.split() for line in fake_gmx.read_text().splitlines() if line.startswith("mdrun")]
+    assert len(mdrun_calls) == 2
+    assert all(call[call.index("-nt") + 1] == "3" for call in mdrun_calls)
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from conftest import make_settings
+from xMD.Staging import PARTIAL_SUFFIX, STAGING_MANIFEST, LocalTransport, Stager, StagingError
+
+
+class CorruptingTransport(LocalTransport):
+    """Flips the first byte of every copy of files named corrupt*."""
+    def copy(self, source, destination, offset=0):
+        copied = super().copy(source, destination, offset)
+        if os.path.basename(source).startswith("corrupt"):
+            with open(destination, "r+b") as f:
+                first = f.read(1)
+                f.seek(0)
+                f.write(bytes([first[0] ^ 0xff]))
+        return copied
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / "scratch"
+    (root / "R_1").mkdir(parents=True)
+    (root / "R_1" / "traj.xtc").write_bytes(os.urandom(1 << 16))
+    (root / "R_1" / "md.log").write_text("log\n")
+    (root / "R_1" / "#md.log.1#").write_text("backup\n")
+    return root
+
+
+def stage(source, destination, transport=None):
+    return Stager(transport, max_workers=2, verbose=False).stage(str(source), str(destination))
+
+
+def actions(report):
+    return {record["path"]: record["action"] for record in report["files"]}
+
+
+def test_copies_then_skips_unchanged_files(source, tmp_path):
+    home = tmp_path / "home"
+    report = stage(source, home)
+    assert actions(report) == {"R_1/traj.xtc": "copied", "R_1/md.log": "copied"}
+    assert (home / "R_1" / "traj.xtc").read_bytes() == (source / "R_1" / "traj.xtc").read_bytes()
+    assert not (home / "R_1" / "#md.log.1#").exists()
+    assert (home / STAGING_MANIFEST).exists()
+
+    report = stage(source, home)
+    assert actions(report) == {"R_1/traj.xtc": "unchanged", "R_1/md.log": "unchanged"}
+    assert report["copied_bytes"] == 0
+
+    # touched but not changed: compared by checksum and not copied
+    os.utime(source / "R_1" / "md.log", ns=(1, 1))
+    assert actions(stage(source, home))["R_1/md.log"] == "same content"
+
+
+def test_interrupted_copy_resumes(source, tmp_path):
+    home = tmp_path / "home"
+    data = (source / "R_1" / "traj.xtc").read_bytes()
+    (home / "R_1").mkdir(parents=True)
+    (home / "R_1" / ("traj.xtc" + PARTIAL_SUFFIX)).write_bytes(data[:1000])
+
+    report = stage(source, home)
+    record, = [record for record in report["files"] if record["path"] == "R_1/traj.xtc"]
+    assert record["action"] == "resumed"
+    assert record["bytes"] == len(data) - 1000
+    assert (home / "R_1" / "traj.xtc").read_bytes() == data
+    assert not (home / "R_1" / ("traj.xtc" + PARTIAL_SUFFIX)).exists()
+
+
+def test_stale_partial_copy_is_replaced(source, tmp_path):
+    home = tmp_path / "home"
+    (home / "R_1").mkdir(parents=True)
+    (home / "R_1" / ("traj.xtc" + PARTIAL_SUFFIX)).write_bytes(b"\0" * 1000)
+
+    report = stage(source, home)
+    assert actions(report)["R_1/traj.xtc"] == "copied"
+    assert (home / "R_1" / "traj.xtc").read_bytes() == (source / "R_1" / "traj.xtc").read_bytes()
+
+
+def test_checksum_failure_raises_after_the_other_files(source, tmp_path):
+    home = tmp_path / "home"
+    (source / "R_1" / "corrupt.xtc").write_bytes(b"frames")
+    with pytest.raises(StagingError) as error:
+        stage(source, home, CorruptingTransport())
+    report = error.value.report
+    assert [failure["path"] for failure in report["errors"]] == ["R_1/corrupt.xtc"]
+    assert "Checksum" in report["errors"][0]["error"]
+    assert actions(report) == {"R_1/traj.xtc": "copied", "R_1/md.log": "copied"}
+    assert not (home / "R_1" / "corrupt.xtc").exists()
+
+    # the failed file is retried by the next transfer, the others are skipped
+    report = stage(source, home)
+    assert actions(report)["R_1/corrupt.xtc"] == "copied"
+    assert actions(report)["R_1/traj.xtc"] == "unchanged"
+
+
+def test_destination_is_relative_to_the_data_directory(project, tmp_path):
+    from xMD.xMD import xMD
+
+    home = tmp_path / "home"
+    experiment = xMD(make_settings(staging_directory=str(home)), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    rep_dir = os.path.join(experiment.dirs[experiment.settings.data_directory], "R_1")
+    with open(os.path.join(rep_dir, "md.log"), "w") as f:
+        f.write("log\n")
+
+    report = experiment.load_trajectory_files(rep=1)
+    relpath = os.path.relpath(rep_dir, experiment.settings.data_directory)
+    assert report["destination"] == os.path.join(str(home), relpath)
+    assert (home / relpath / "md.log").exists()
+
+    # the same replicate by absolute path
+    report = experiment.load_trajectory_files(data_dir=os.path.abspath(rep_dir))
+    assert report["destination"] == os.path.join(str(home), relpath)
+
+    with pytest.raises(ValueError, match="not in the data directory"):
+        experiment.load_trajectory_files(data_dir=str(tmp_path / "elsewhere"))
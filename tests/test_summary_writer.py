@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import random
+import subprocess
+
+from xMD.utility import BufferedSummaryWriter, ScalarBuffer, live_GROMACS_log_reader
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RecordingWriter():
+    """Stands in for the tensorboardX SummaryWriter, recording what reaches it."""
+    instances = []
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.scalars = []
+        self.calls = []
+        self.closed = False
+        RecordingWriter.instances.append(self)
+
+    def add_scalar(self, tag, value, step, walltime=None):
+        self.scalars.append((tag, step, value))
+
+    def add_histogram(self, *args, **kwargs):
+        self.calls.append(("add_histogram", args))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def make_writer(**kwargs):
+    RecordingWriter.instances = []
+    return BufferedSummaryWriter(flush_secs=3600, writer_class=RecordingWriter, **kwargs)
+
+
+def written(log_dir):
+    writer, = [writer for writer in RecordingWriter.instances if writer.log_dir == log_dir]
+    return writer
+
+
+def test_stride_keeps_every_nth_point_of_matching_tags():
+    shared = make_writer(downsample={"energy/*": ("stride", 3)})
+    run = shared.run("run")
+    for step in range(10):
+        run.add_scalar("energy/Temperature", 300.0 + step, step)
+        run.add_scalar("performance/ns_per_day", 50.0, step)
+    shared.close()
+    steps = [step for tag, step, _ in written("run").scalars if tag == "energy/Temperature"]
+    assert steps == [0, 3, 6, 9]
+    assert sum(tag == "performance/ns_per_day" for tag, _, _ in written("run").scalars) == 10
+    assert shared.dropped == 6
+    assert shared.written == 14
+
+
+def test_reservoir_keeps_a_sample_in_step_order():
+    shared = make_writer(downsample={"energy/*": ("reservoir", 5)})
+    run = shared.run("run")
+    for step in range(100):
+        run.add_scalar("energy/Pressure", float(step), step)
+    shared.close()
+    steps = [step for _, step, _ in written("run").scalars]
+    assert len(steps) == 5
+    assert steps == sorted(set(steps))
+    assert all(value == step for _, step, value in written("run").scalars)
+    assert shared.dropped == 95
+
+
+def test_reservoir_samples_uniformly():
+    random.seed(0)
+    counts = [0] * 10
+    for _ in range(2000):
+        buffer = ScalarBuffer(reservoir=2)
+        for step in range(10):
+            buffer.append(step, 0.0, 0.0)
+        for step in buffer.points()[0]:
+            counts[step] += 1
+    # each point is kept with probability 2/10
+    assert all(300 < count < 500 for count in counts)
+
+
+def test_close_writes_everything_buffered():
+    shared = make_writer()
+    first, second = shared.run("first"), shared.run("second")
+    first.add_scalar("energy/Temperature", 300.0, 0)
+    first.add_histogram("rmsf", [0.1, 0.2], 0)
+    second.add_scalar("energy/Temperature", 310.0, 0)
+    assert RecordingWriter.instances == []
+
+    first.close()
+    assert written("first").scalars == [("energy/Temperature", 0, 300.0)]
+    assert written("first").calls[0][0] == "add_histogram"
+    assert written("first").closed
+
+    shared.close()
+    assert written("second").scalars == [("energy/Temperature", 0, 310.0)]
+    assert written("second").closed
+    assert not shared._thread.is_alive()
+
+
+def test_buffer_is_flushed_once_full():
+    shared = BufferedSummaryWriter(flush_secs=3600, max_buffer=5, writer_class=RecordingWriter)
+    RecordingWriter.instances = []
+    run = shared.run("run")
+    for step in range(5):
+        run.add_scalar("energy/Temperature", 300.0, step)
+    deadline = time.time() + 10
+    while (not RecordingWriter.instances or len(RecordingWriter.instances[0].scalars) < 5) \
+            and time.time() < deadline:
+        time.sleep(0.01)
+    try:
+        assert len(written("run").scalars) == 5
+    finally:
+        shared.close()
+
+
+LOG_BLOCK = """           Step           Time
+{step:>15d}{time:>15.5f}
+
+   Energies (kJ/mol)
+    Temperature
+    3.00000e+02
+
+"""
+
+
+def test_log_reader_leaves_the_buffered_writer_to_flush_on_its_schedule(tmp_path, monkeypatch):
+    shared = make_writer()
+    flushes = []
+    monkeypatch.setattr(shared, "flush", lambda: flushes.append(1))
+    log = tmp_path / "md.log"
+    reader = live_GROMACS_log_reader("TEST", str(log), writer=shared.run("run"))
+    for step in (0, 100, 200):
+        with open(log, "a") as f:
+            f.write(LOG_BLOCK.format(step=step, time=step * 0.002))
+        reader.read_log()
+    assert flushes == []
+    shared.close()
+    assert [step for _, step, _ in written("run").scalars] == [0, 100, 200]
+
+    # a plain SummaryWriter is flushed after each read
+    class PlainWriter():
+        def add_scalar(self, tag, value, global_step=None):
+            pass
+
+        def flush(self):
+            flushes.append(1)
+
+    reader = live_GROMACS_log_reader("TEST", str(log), writer=PlainWriter())
+    reader.read_log()
+    assert flushes == [1]
+
+
+def test_shared_writer_is_closed_at_exit(tmp_path):
+    script = (
+        "from xMD import utility\n"
+        "class Writer():\n"
+        "    def __init__(self, log_dir): pass\n"
+        "    def add_scalar(self, tag, value, step, walltime=None): print('scalar', tag, step)\n"
+        "    def flush(self): pass\n"
+        "    def close(self): print('closed')\n"
+        "shared = utility.get_summary_writer(flush_secs=3600)\n"
+        "shared.writer_class = Writer\n"
+        "shared.run('logs').add_scalar('energy/Temperature', 300.0, 5)\n")
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=REPO),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.split("\n")[:2] == ["scalar energy/Temperature 5", "closed"]
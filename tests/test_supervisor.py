@@ -0,0 +1,104 @@
+import os
+import time
+import signal
+import subprocess
+
+import pytest
+
+from xMD import Supervisor as supervisor_module
+from xMD.AuxMD import run_MD
+from xMD.Supervisor import MdrunProgress, Supervisor, run_mdrun
+
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    """A quiet supervisor that polls often, also used as the shared one."""
+    supervisor = Supervisor(writer_secs=3600, grace_secs=3, poll_secs=0.05, verbose=False)
+    monkeypatch.setattr(supervisor_module, "_supervisor", supervisor)
+    return supervisor
+
+
+def mdrun(tmp_path):
+    return ["gmx", "mdrun", "-v", "-deffnm", str(tmp_path / "seg_0")]
+
+
+def wait_for_progress(process, timeout=10):
+    deadline = process.started + timeout
+    while process.progress.step is None and not process.done.is_set():
+        process.done.wait(0.01)
+        assert process.started < deadline
+    assert process.progress.step is not None
+
+
+def test_progress_lines_are_parsed():
+    progress = MdrunProgress(dt_ps=0.002, nsteps=2000)
+    assert progress.feed("imb F  2% step 400, remaining wall clock time:    29 s", 10.0)
+    assert (progress.step, progress.eta_s, progress.fraction) == (400, 29.0, 0.2)
+    assert progress.ns_per_day is None
+    assert progress.feed("imb F  3% step 1400, will finish Sat Oct 17 14:03:12 2026", 12.0)
+    assert progress.steps_per_s == 500.0
+    # 500 steps/s of 2 fs
+    assert progress.ns_per_day == pytest.approx(86.4)
+    assert not progress.feed("Received the INT signal, stopping within 100 steps", 13.0)
+    assert progress.signal == "INT"
+    assert not progress.feed("Performance:       45.123        0.532", 14.0)
+    assert progress.ns_per_day == 45.123
+
+
+def test_finished_run_reports_its_progress(tmp_path, fake_gmx, supervisor):
+    process = supervisor.start(mdrun(tmp_path), nsteps=5000, dt_ps=0.002)
+    assert process.wait(30) == 0
+    status = process.status()
+    assert status["state"] == "finished"
+    assert (status["step"], status["fraction"]) == (4500, 0.9)
+    assert status["ns_per_day"] == 45.123
+    assert "Writing final coordinates." in process.tail()
+    assert process.usage is not None
+    assert supervisor.status()[-1]["name"] == "gmx mdrun"
+
+
+def test_cancel_stops_mdrun_with_sigint(tmp_path, fake_gmx, supervisor, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_TIME", "5")
+    process = supervisor.start(mdrun(tmp_path))
+    wait_for_progress(process)
+    process.cancel("converged")
+    assert process.wait(10) == 0
+    assert (process.state, process.cancel_reason) == ("cancelled", "converged")
+    assert process.progress.signal == "INT"
+    # mdrun wrote its checkpoint on the way out
+    assert os.path.exists(tmp_path / "seg_0.cpt")
+
+
+def test_cancel_kills_mdrun_that_ignores_sigint(tmp_path, fake_gmx, supervisor, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_TIME", "5")
+    monkeypatch.setenv("FAKE_MDRUN_IGNORE_INT", "1")
+    supervisor.grace_secs = 0.3
+    process = supervisor.start(mdrun(tmp_path))
+    wait_for_progress(process)
+    cancelled = time.monotonic()
+    process.cancel()
+    assert process.wait(10) == -signal.SIGKILL
+    assert process.state == "cancelled"
+    assert supervisor.grace_secs <= process.ended - cancelled < 3
+    assert not os.path.exists(tmp_path / "seg_0.cpt")
+
+
+def test_failed_run_raises_with_its_output(tmp_path, fake_gmx, supervisor, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_FAIL", "1")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_mdrun(mdrun(tmp_path), supervisor=supervisor)
+    assert error.value.returncode == 1
+    assert "fake failure" in error.value.output
+
+
+def test_timeout_keeps_the_checkpoint_and_removes_the_structure(tmp_path, fake_gmx, supervisor, monkeypatch):
+    monkeypatch.setenv("FAKE_MDRUN_TIME", "5")
+    mdp = tmp_path / "md.mdp"
+    mdp.write_text("nsteps = 5000\ndt = 0.002\n")
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_MD(str(mdp), "in.gro", "topol.top", str(tmp_path / "seg_0.tpr"), "gmx", supervise=True, timeout=0.5)
+    status = supervisor.status()[-1]
+    assert (status["state"], status["nsteps"]) == ("timed out", 5000)
+    # the next attempt continues from the checkpoint, the stopped run's structure would mark the segment complete
+    assert os.path.exists(tmp_path / "seg_0.cpt")
+    assert not os.path.exists(tmp_path / "seg_0.gro")
@@ -0,0 +1,66 @@
+import glob
+import json
+import threading
+import contextvars
+
+from conftest import make_settings
+from xMD.Tracing import Tracer, get_tracer, set_tracer, span
+from xMD.xMD import xMD
+
+
+def test_tracers_are_not_shared_between_threads():
+    tracers = {}
+    barrier = threading.Barrier(2)
+
+    def run(name):
+        tracer = Tracer(name)
+        set_tracer(tracer)
+        # both threads have set their tracer before either records a span
+        barrier.wait()
+        with span("work", thread=name):
+            pass
+        tracers[name] = tracer
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert get_tracer() is None
+    assert sorted(tracers) == ["a", "b"]
+    for name, tracer in tracers.items():
+        assert [event["args"]["thread"] for event in tracer.events] == [name]
+
+
+def test_copied_context_keeps_the_callers_tracer():
+    tracer = Tracer()
+    previous = set_tracer(tracer)
+    try:
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(get_tracer()))
+        thread.start()
+        thread.join()
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(lambda: seen.append(get_tracer()),))
+        thread.start()
+        thread.join()
+        assert seen == [None, tracer]
+    finally:
+        set_tracer(previous)
+
+
+def test_concurrent_replicates_write_their_own_traces(project, fake_gmx):
+    experiment = xMD(make_settings(mdrun_supervised=False, trace=True), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    experiment.run_replicates(reps=[1, 2], n_parallel=2, total_cores=2,
+                              search="APO", config_files=["md.mdp"], monitor=False)
+
+    traces = sorted(glob.glob(str(project / "**" / "trace_*.json"), recursive=True))
+    assert len(traces) == 2
+    for path in traces:
+        with open(path) as f:
+            events = [event for event in json.load(f)["traceEvents"] if event["ph"] == "X"]
+        reps = [event["args"]["rep"] for event in events if event["name"] == "run_experiment"]
+        assert len(reps) == 1
+        assert path.split("/")[-2].endswith(str(reps[0]))
+        assert sum(event["name"] == "gmx mdrun" for event in events) == 1
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from conftest import make_settings
+from xMD.Trajectory_Catalog import CATALOG_NAME, TrajectoryCatalog
+
+OLD = 1_000_000_000 * 10**9
+
+
+def make_replicate(root, names, rep_dir="R_1"):
+    path = root / "TEST" / "T" / rep_dir
+    path.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        (path / name).write_text(name)
+    return path
+
+
+def age(path):
+    """Sets the mtime of path far in the past, so the catalog trusts its cached listing."""
+    os.utime(path, ns=(OLD, OLD))
+
+
+def test_query_and_latest_segment(tmp_path):
+    make_replicate(tmp_path, ["APO_md_TEST_0.xtc", "APO_md_TEST_2.xtc", "APO_md_TEST_10.xtc", "APO_md_TEST_2.gro",
+                              "APO_md_TEST_2-nojump.xtc", "#APO_md_TEST_2.log.1#", "topol.top"])
+    make_replicate(tmp_path, ["APO_md_TEST_0.xtc"], "R_2")
+    catalog = TrajectoryCatalog(str(tmp_path))
+
+    assert catalog.replicates("TEST", "T") == ["R_1", "R_2"]
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 10
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc", variant="-nojump") == 2
+    assert catalog.latest_segment("TEST", "T", "R_1", "OTHER", kind="xtc") is None
+    assert catalog.latest_segment("TEST", "T", "R_3", "APO_md_TEST") is None
+
+    files = catalog.query("TEST", "T", "R_1", kind="xtc", prefix="APO_md_TEST")
+    assert sorted((file["segment"], file["variant"] or "") for file in files) == [(0, ""), (2, ""), (2, "-nojump"),
+                                                                                (10, "")]
+    assert {file["replicate"] for file in catalog.query(kind="xtc")} == {"R_1", "R_2"}
+    replicate = catalog.replicate("TEST", "T", "R_1")
+    assert replicate["topol.top"] == {"size": len("topol.top"), "kind": "top"}
+    assert "#APO_md_TEST_2.log.1#" not in replicate
+    assert catalog.dirs[os.path.join("TEST", "T", "R_1")]["backups"] == 1
+
+
+def test_directories_are_rescanned_only_when_they_change(tmp_path):
+    rep = make_replicate(tmp_path, ["APO_md_TEST_0.xtc"])
+    age(rep)
+    catalog = TrajectoryCatalog(str(tmp_path))
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 0
+
+    # a file added without changing the directory mtime is not seen, so the listing was cached
+    (rep / "APO_md_TEST_1.xtc").write_text("")
+    age(rep)
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 0
+    os.utime(rep)
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 1
+
+    # a directory changed within the mtime resolution is always listed again
+    (rep / "APO_md_TEST_2.xtc").write_text("")
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 2
+    (rep / "APO_md_TEST_3.xtc").write_text("")
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 3
+
+
+def test_catalog_is_shared_through_its_file(tmp_path):
+    rep = make_replicate(tmp_path, ["APO_md_TEST_0.xtc"])
+    age(rep)
+    TrajectoryCatalog(str(tmp_path)).refresh()
+    assert (tmp_path / CATALOG_NAME).exists()
+
+    # another process starts from the saved listing
+    (rep / "APO_md_TEST_1.xtc").write_text("")
+    age(rep)
+    catalog = TrajectoryCatalog(str(tmp_path))
+    assert catalog.latest_segment("TEST", "T", "R_1", "APO_md_TEST", kind="xtc") == 0
+    # a removed replicate is dropped
+    for name in os.listdir(rep):
+        os.remove(rep / name)
+    os.rmdir(rep)
+    assert catalog.replicate("TEST", "T", "R_1") == {}
+    assert os.path.join("TEST", "T", "R_1") not in TrajectoryCatalog(str(tmp_path)).dirs
+
+
+def test_experiment_lookups_use_the_catalog(project):
+    from xMD.xMD import xMD
+
+    experiment = xMD(make_settings(), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    rep_dir = os.path.join(experiment.dirs[experiment.settings.data_directory], "R_1")
+    # the latest segment is the latest final structure, settings.search_traj
+    for name in ("APO_md_TEST_0.gro", "APO_md_TEST_2.gro", "APO_md_TEST_10.gro", "APO_md_TEST_11.xtc",
+                 "APO_md_TEST_0-nojump.xtc", "APO_md_TEST_10-nojump.xtc", "APO_md_TEST_2-nojump.xtc"):
+        with open(os.path.join(rep_dir, name), "w") as f:
+            f.write("")
+
+    assert experiment.find_latest_trajectory() == 10
+    # in segment order, not name order
+    assert [os.path.basename(path) for path in experiment.segment_trajectories(variant="-nojump")] == [
+        "APO_md_TEST_0-nojump.xtc", "APO_md_TEST_2-nojump.xtc", "APO_md_TEST_10-nojump.xtc"]
+    assert experiment.check_all_trajectory_files(traj_extension=".xtc")["R_1"] == [
+        "APO_md_TEST_0-nojump.xtc", "APO_md_TEST_10-nojump.xtc", "APO_md_TEST_11.xtc", "APO_md_TEST_2-nojump.xtc"]
+    with pytest.raises(FileNotFoundError):
+        experiment.find_latest_trajectory(rep=2)
@@ -0,0 +1,135 @@
+import os
+import threading
+
+import pytest
+
+from conftest import make_settings
+from xMD import xMD as xmd_module
+from xMD.xMD import xMD
+
+
+def run(project, monkeypatch, resume=False, pipeline=False):
+    experiment = xMD(make_settings(mdrun_supervised=False), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    offsets = []
+    prepare_log_reader = experiment.prepare_log_reader
+
+    def record_offset(tpr_path, step_offset=0, log_path=None, monitor=None):
+        offsets.append((os.path.basename(tpr_path), step_offset))
+        return prepare_log_reader(tpr_path, step_offset, log_path, monitor)
+
+    monkeypatch.setattr(experiment, "prepare_log_reader", record_offset)
+    experiment.run_experiment(search="APO", config_files=["md.mdp", "md2.mdp", "md.mdp"],
+                              monitor=True, pipeline=pipeline, resume=resume)
+    return experiment, offsets
+
+
+def test_segments_run_in_order(project, monkeypatch, fake_gmx):
+    experiment, offsets = run(project, monkeypatch)
+    assert offsets == [("APO_md_TEST_0.tpr", 0), ("APO_md_TEST_1.tpr", 1000), ("APO_md_TEST_2.tpr", 2000)]
+    assert [segment["status"] for segment in experiment.segments] == ["complete"] * 3
+
+
+def test_resume_skips_complete_segments_and_keeps_the_step_offset(project, monkeypatch, fake_gmx):
+    experiment, _ = run(project, monkeypatch)
+    rep_dir = os.path.dirname(experiment.segments[-1]["tpr"])
+    # the last segment was interrupted after writing a checkpoint
+    os.remove(os.path.join(rep_dir, "APO_md_TEST_2.gro"))
+    fake_gmx.write_text("")
+
+    _, offsets = run(project, monkeypatch, resume=True)
+    assert offsets == [("APO_md_TEST_2.tpr", 2000)]
+    mdrun, = [line for line in fake_gmx.read_text().splitlines() if line.startswith("mdrun")]
+    assert "-cpi" in mdrun.split()
+
+
+def gmx_commands(calls):
+    return [line.split()[0] for line in calls.read_text().splitlines()]
+
+
+def test_resume_does_not_convert_analysed_segments_again(project, monkeypatch, fake_gmx):
+    experiment, _ = run(project, monkeypatch, pipeline=True)
+    last_tpr = experiment.segments[-1]["tpr"]
+    # mol/center and nojump passes and the pdb of each segment
+    assert gmx_commands(fake_gmx).count("trjconv") == 9
+    fake_gmx.write_text("")
+
+    _, offsets = run(project, monkeypatch, resume=True, pipeline=True)
+    assert offsets == []
+    assert gmx_commands(fake_gmx) == []
+
+    # a segment whose nojump pass was lost is converted again
+    os.remove(last_tpr.replace(".tpr", "-nojump.xtc"))
+    _, offsets = run(project, monkeypatch, resume=True)
+    assert offsets == []
+    assert gmx_commands(fake_gmx) == ["trjconv"] * 3
+
+
+def test_pipeline_analyses_each_segment_while_the_next_runs(project, monkeypatch, fake_gmx):
+    started = {}
+    analysed = []
+    run_MD = xmd_module.run_MD
+
+    def record_start(mdp, input_path, topo_path, tpr_path, *args, **kwargs):
+        started.setdefault(os.path.basename(tpr_path), threading.Event()).set()
+        return run_MD(mdp, input_path, topo_path, tpr_path, *args, **kwargs)
+
+    monkeypatch.setattr(xmd_module, "run_MD", record_start)
+    experiment = xMD(make_settings(mdrun_supervised=False), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    analyse_segment = experiment.analyse_segment
+
+    def wait_for_next(tpr_path):
+        name = os.path.basename(tpr_path)
+        following = "APO_md_TEST_%d.tpr" % (int(name[:-len(".tpr")].rsplit("_", 1)[1]) + 1)
+        if following != "APO_md_TEST_3.tpr":
+            # the next segment starts before this one's analysis finishes
+            assert started.setdefault(following, threading.Event()).wait(10)
+        analysed.append((name, threading.current_thread() is threading.main_thread()))
+        return analyse_segment(tpr_path)
+
+    monkeypatch.setattr(experiment, "analyse_segment", wait_for_next)
+    experiment.run_experiment(search="APO", config_files=["md.mdp", "md2.mdp", "md.mdp"], pipeline=True)
+    assert analysed == [("APO_md_TEST_%d.tpr" % i, False) for i in range(3)]
+    assert sum(line.startswith("trjconv") for line in fake_gmx.read_text().splitlines()) == 9
+
+
+def test_pipeline_raises_the_errors_of_the_analysis(project, monkeypatch, fake_gmx):
+    experiment = xMD(make_settings(mdrun_supervised=False), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+
+    def fail(tpr_path):
+        raise RuntimeError("analysis failed: " + os.path.basename(tpr_path))
+
+    monkeypatch.setattr(experiment, "analyse_segment", fail)
+    with pytest.raises(RuntimeError, match="APO_md_TEST_0"):
+        experiment.run_experiment(search="APO", config_files=["md.mdp", "md2.mdp"], pipeline=True)
+    # the segments still ran
+    assert sum(line.startswith("mdrun") for line in fake_gmx.read_text().splitlines()) == 2
+
+
+def test_replicates_run_on_disjoint_pinned_cores(project, fake_gmx):
+    experiment = xMD(make_settings(mdrun_supervised=False), "T", "TEST", 1)
+    experiment.create_directory_structure(overwrite=True)
+    experiment.mdrun_opts = ["-dlb", "yes"]
+    result = experiment.run_replicates(reps=[1, 2, 3], n_parallel=2, total_cores=4,
+                                       search="APO", config_files=["md.mdp"], monitor=False)
+
+    offsets = {}
+    for line in fake_gmx.read_text().splitlines():
+        command = line.split()
+        if command[0] == "mdrun":
+            assert command[command.index("-nt") + 1] == "2"
+            assert "-pin" in command and "-dlb" in command
+            rep = os.path.basename(os.path.dirname(command[command.index("-deffnm") + 1]))
+            offsets[rep] = command[command.index("-pinoffset") + 1]
+    assert sorted(offsets) == ["R_1", "R_2", "R_3"]
+    # the first two start together, so they get the two core sets; the third reuses a freed one
+    assert {offsets["R_1"], offsets["R_2"]} == {"0", "2"}
+    assert offsets["R_3"] in ("0", "2")
+    # the caller's options are not changed by the replicates
+    assert experiment.mdrun_opts == ["-dlb", "yes"]
+
+    assert result["replicates"] == {1: 45.123, 2: 45.123, 3: 45.123}
+    assert result["aggregate"] == pytest.approx(2 * 45.123)
+    assert result["aggregate_estimated"]
@@ -0,0 +1,169 @@
+import time
+
+import numpy as np
+import pytest
+
+from xMD import XTC
+from xMD.XTC import XTCReader, XTCWriter
+
+mdtraj_xtc = pytest.importorskip("mdtraj.formats.xtc")
+
+
+def make_frames(n_frames=12, n_atoms=300, seed=0):
+    rng = np.random.default_rng(seed)
+    # a chain of small steps, so the runs of small differences are used as in a real protein
+    base = np.cumsum(rng.normal(0.0, 0.1, (n_atoms, 3)), axis=0).astype(np.float32) + 3.0
+    coords = np.stack([base + rng.normal(0.0, 0.02, base.shape).astype(np.float32) for _ in range(n_frames)])
+    boxes = np.tile(np.diag([6.0, 6.5, 7.0]).astype(np.float32), (n_frames, 1, 1))
+    times = np.arange(n_frames, dtype=np.float32) * 10.0
+    steps = np.arange(n_frames, dtype=np.int32) * 5000
+    return steps, times, boxes, coords
+
+
+@pytest.fixture
+def reference(tmp_path):
+    """An xtc written by the xdrfile library of mdtraj."""
+    path = str(tmp_path / "reference.xtc")
+    steps, times, boxes, coords = make_frames()
+    with mdtraj_xtc.XTCTrajectoryFile(path, "w") as f:
+        f.write(coords, time=times, step=steps, box=boxes)
+    return path
+
+
+@pytest.fixture
+def python_codec(monkeypatch):
+    monkeypatch.setattr(XTC, "_compiled_xtc", lambda: None)
+
+
+def read_all(path, **kwargs):
+    with XTCReader(path) as reader:
+        chunks = list(reader.iter_chunks(**kwargs))
+        precision = reader.precision
+    return [np.concatenate(parts) for parts in zip(*chunks)], precision
+
+
+def test_python_decoder_matches_reference(reference, python_codec):
+    (steps, times, boxes, coords), precision = read_all(reference, chunk_size=5)
+    with mdtraj_xtc.XTCTrajectoryFile(reference) as f:
+        xyz, ref_times, ref_steps, ref_boxes = f.read()
+    assert precision == 1000.0
+    np.testing.assert_array_equal(coords, xyz)
+    np.testing.assert_array_equal(steps, ref_steps)
+    np.testing.assert_array_equal(times, ref_times)
+    np.testing.assert_array_equal(boxes, ref_boxes)
+
+
+def test_python_encoder_is_byte_identical(tmp_path, reference, python_codec):
+    out = str(tmp_path / "python.xtc")
+    with XTCWriter(out) as writer:
+        writer.write_chunk(*make_frames())
+    with open(out, "rb") as a, open(reference, "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_compiled_encoder_appends_chunks(tmp_path, reference):
+    steps, times, boxes, coords = make_frames()
+    out = str(tmp_path / "compiled.xtc")
+    with XTCWriter(out) as writer:
+        writer.write_chunk(steps[:5], times[:5], boxes[:5], coords[:5])
+        writer.write_chunk(steps[5:], times[5:], boxes[5:], coords[5:])
+    with open(out, "rb") as a, open(reference, "rb") as b:
+        assert a.read() == b.read()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["compiled.xtc", "reference.xtc"]
+
+
+def test_compiled_and_python_paths_agree(reference, monkeypatch):
+    compiled, precision = read_all(reference, chunk_size=4, stride=3)
+    assert precision == 1000.0
+    monkeypatch.setattr(XTC, "_compiled_xtc", lambda: None)
+    python, _ = read_all(reference, chunk_size=4, stride=3)
+    assert len(compiled[0]) == 4
+    for a, b in zip(compiled, python):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_compiled_path_starts_at_current_frame(reference):
+    with XTCReader(reference) as reader:
+        reader.skip_frame()
+        reader.skip_frame()
+        steps = np.concatenate([chunk[0] for chunk in reader.iter_chunks(chunk_size=3)])
+        assert reader.read_frame() is None
+    np.testing.assert_array_equal(steps, np.arange(2, 12) * 5000)
+
+
+def test_round_trip_at_lower_precision(tmp_path):
+    steps, times, boxes, coords = make_frames()
+    out = str(tmp_path / "low.xtc")
+    with XTCWriter(out, precision=100.0) as writer:
+        writer.write_chunk(steps, times, boxes, coords)
+    (_, _, _, decoded), precision = read_all(out)
+    assert precision == 100.0
+    assert np.abs(decoded - coords).max() <= 0.5 / 100.0 + 1e-6
+
+
+def test_small_frames_are_stored_uncompressed(tmp_path, python_codec):
+    coords = np.random.default_rng(1).uniform(0.0, 3.0, (2, 5, 3)).astype(np.float32)
+    out = str(tmp_path / "small.xtc")
+    with XTCWriter(out) as writer:
+        for i, frame in enumerate(coords):
+            writer.write_frame(frame, step=i, time=float(i))
+    (_, _, _, decoded), _ = read_all(out)
+    np.testing.assert_array_equal(decoded, coords)
+
+
+def test_compiled_codec_is_faster(tmp_path, monkeypatch):
+    path = str(tmp_path / "large.xtc")
+    steps, times, boxes, coords = make_frames(n_frames=10, n_atoms=5000)
+    with mdtraj_xtc.XTCTrajectoryFile(path, "w") as f:
+        f.write(coords, time=times, step=steps, box=boxes)
+
+    def decode_time():
+        start = time.perf_counter()
+        read_all(path)
+        return time.perf_counter() - start
+
+    decode_time()
+    compiled = min(decode_time() for _ in range(3))
+    monkeypatch.setattr(XTC, "_compiled_xtc", lambda: None)
+    python = decode_time()
+    print(f"decode: compiled {compiled * 1e3:.1f} ms, python {python * 1e3:.1f} ms")
+    assert compiled * 5 < python
+
+
+def test_nojump_segments_are_unwrapped_across_joins(tmp_path):
+    from xMD.PBC import NoJump
+    from xMD.XTC import concatenate_xtc
+
+    # atoms drifting through a 3 nm box, wrapped into it as mdrun writes them
+    n_frames, n_atoms, box = 20, 12, 3.0
+    rng = np.random.default_rng(2)
+    start = rng.uniform(0.0, box, (n_atoms, 3))
+    velocity = rng.normal(0.0, 0.15, (n_atoms, 3))
+    unwrapped = (start + velocity * np.arange(n_frames)[:, None, None]).astype(np.float32)
+    wrapped = unwrapped % box
+    boxes = np.tile(np.eye(3, dtype=np.float32) * box, (n_frames, 1, 1))
+    steps = np.arange(n_frames) * 100
+    times = np.arange(n_frames, dtype=np.float32)
+
+    paths = []
+    for i, frames in enumerate((slice(0, 10), slice(10, 20))):
+        path = str(tmp_path / f"segment_{i}-nojump.xtc")
+        # each segment is unwrapped on its own, as trjconv -pbc nojump does
+        coords = NoJump()(wrapped[frames], boxes[frames])
+        with XTCWriter(path) as writer:
+            writer.write_chunk(steps[frames], times[frames], boxes[frames], coords)
+        paths.append(path)
+
+    expected = NoJump()(wrapped, boxes)
+    joined = concatenate_xtc(paths, str(tmp_path / "all-nojump.xtc"), nojump=True)
+    (_, _, _, coords), _ = read_all(str(tmp_path / "all-nojump.xtc"))
+    np.testing.assert_allclose(coords, expected, atol=2e-3)
+    np.testing.assert_allclose(np.stack([frame.coords for frame in joined]), expected, atol=2e-3)
+    strided = np.concatenate([chunk[3] for chunk in joined.iter_chunks(chunk_size=4, stride=3)])
+    np.testing.assert_allclose(strided, expected[::3], atol=2e-3)
+
+    # copying the frames keeps the jump at the join
+    copied_view = concatenate_xtc(paths, str(tmp_path / "copied.xtc"))
+    (_, _, _, copied), _ = read_all(str(tmp_path / "copied.xtc"))
+    assert len(copied_view) == n_frames
+    assert np.abs(copied - expected).max() > 1.0
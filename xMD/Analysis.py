@@ -0,0 +1,234 @@
+# Structural analysis of trajectories: RMSD, RMSF, radius of gyration and residue contacts
+# Trajectories are read in chunks of frames and each chunk is analysed with vectorised numpy
+# (the RMSD fit is a batched Kabsch over the whole chunk), so memory use does not depend on the
+# trajectory length. Segments are split into frame ranges that run in a process pool, and the
+# partial results (per-frame values, sums for the RMSF and contact counts) are reduced at the end.
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from .XTC import XTCReader
+from .Structure import read_structure
+
+# masses from the first letter of the atom name, for the radius of gyration
+ELEMENT_MASSES = {"H": 1.008, "C": 12.011, "N": 14.007, "O": 15.999, "S": 32.06, "P": 30.974}
+
+
+def atom_masses(names):
+    return np.array([ELEMENT_MASSES.get(name.lstrip("0123456789")[:1], 12.011) for name in names])
+
+
+def kabsch_align(coords, reference):
+    """
+    Fits every frame of coords (n_frames, n_atoms, 3) onto reference (n_atoms, 3), which must be centred.
+    Returns the fitted coordinates and the RMSD of each frame after the fit.
+    """
+    x = coords - coords.mean(axis=1, keepdims=True)
+    # one 3x3 covariance matrix and SVD per frame
+    h = np.einsum("fni,nj->fij", x, reference)
+    u, _, vt = np.linalg.svd(h)
+    # no reflections
+    d = np.sign(np.linalg.det(u @ vt))
+    u[:, :, -1] *= d[:, None]
+    fitted = x @ (u @ vt)
+    rmsd = np.sqrt(((fitted - reference) ** 2).sum(axis=2).mean(axis=1))
+    return fitted, rmsd
+
+
+def radius_of_gyration(coords, masses):
+    """Returns the mass weighted radius of gyration of each frame of coords (n_frames, n_atoms, 3)."""
+    weights = masses / masses.sum()
+    centre = np.einsum("fni,n->fi", coords, weights)
+    return np.sqrt(np.einsum("fn,n->f", ((coords - centre[:, None]) ** 2).sum(axis=2), weights))
+
+
+def residue_contacts(coords, cutoff=0.8, min_separation=3):
+    """
+    Returns the contact maps (n_frames, n_res, n_res) of coords, one atom (e.g. CA) per residue.
+    Residues are in contact if the atoms are within cutoff nm and at least min_separation apart in sequence.
+    """
+    n = coords.shape[1]
+    separation = np.abs(np.arange(n)[:, None] - np.arange(n)[None, :]) >= min_separation
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, without the (n_frames, n_res, n_res, 3) differences
+    norms = (coords ** 2).sum(axis=2)
+    squared = norms[:, :, None] + norms[:, None, :] - 2 * coords @ coords.transpose(0, 2, 1)
+    return (squared < cutoff ** 2) & separation
+
+
+class StructuralSelection():
+    """
+    The atoms analysed, taken from a structure with the same atoms as the trajectories:
+    fit_atoms (CA) are used for the RMSD fit, the RMSF and the contacts, protein_atoms for the Rg.
+    The coordinates of the structure are the reference of the RMSD.
+    """
+    def __init__(self, reference, fit_atoms, protein_atoms, masses, resids, resnames):
+        self.reference = reference
+        self.fit_atoms = fit_atoms
+        self.protein_atoms = protein_atoms
+        self.masses = masses
+        self.resids = resids
+        self.resnames = resnames
+
+    @classmethod
+    def from_structure(cls, path, fit_name="CA"):
+        structure = read_structure(path)
+        protein_atoms = structure.protein_atoms()
+        fit_atoms = protein_atoms[structure.names[protein_atoms] == fit_name]
+        if not len(fit_atoms):
+            fit_atoms = protein_atoms
+        reference = structure.coords[fit_atoms].astype(np.float64)
+        return cls(reference - reference.mean(axis=0),
+                   fit_atoms,
+                   protein_atoms,
+                   atom_masses(structure.names[protein_atoms]),
+                   structure.resids[fit_atoms],
+                   structure.resnames[fit_atoms])
+
+
+class StructuralPartial():
+    """
+    The partial results of one frame range, which are added together with merge:
+    the per-frame values, and the count, sum and sum of squares of the fitted coordinates and
+    the contact counts, from which the RMSF and contact frequencies of all the frames follow.
+    """
+    def __init__(self, n_fit):
+        self.frames = []
+        self.count = 0
+        self.sum = np.zeros((n_fit, 3))
+        self.sum_squares = np.zeros((n_fit, 3))
+        self.contacts = np.zeros((n_fit, n_fit), dtype=np.int64)
+
+    def add_chunk(self, steps, times, coords, selection, cutoff):
+        fit = coords[:, selection.fit_atoms].astype(np.float64)
+        fitted, rmsd = kabsch_align(fit, selection.reference)
+        rg = radius_of_gyration(coords[:, selection.protein_atoms].astype(np.float64), selection.masses)
+        contacts = residue_contacts(fit, cutoff)
+        self.count += len(fitted)
+        self.sum += fitted.sum(axis=0)
+        self.sum_squares += (fitted ** 2).sum(axis=0)
+        self.contacts += contacts.sum(axis=0)
+        # each contact is in the map twice
+        self.frames.append(pd.DataFrame({"Step": steps,
+                                         "Time": times.astype(np.float64),
+                                         "RMSD": rmsd,
+                                         "Rg": rg,
+                                         "Contacts": contacts.sum(axis=(1, 2)) // 2}))
+
+    def merge(self, other):
+        self.frames += other.frames
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.contacts += other.contacts
+        return self
+
+    def rmsf(self):
+        mean = self.sum / self.count
+        return np.sqrt(np.maximum(self.sum_squares / self.count - mean ** 2, 0.0).sum(axis=1))
+
+    def contact_frequency(self):
+        return self.contacts / max(self.count, 1)
+
+
+def plan_tasks(paths, keys, frames_per_task=None, n_tasks=1, chunk_size=50):
+    """
+    Splits trajectories into frame ranges of up to frames_per_task frames, by default into about
+    n_tasks ranges of whole chunks. Only the frame headers are read to find the ranges.
+    keys label each trajectory, e.g. (replicate, segment). The first frame of a segment is
+    dropped if it repeats the last frame of the previous one (a continued segment).
+    Returns a list of (key, path, offset, n_frames) tasks.
+    """
+    indexes = []
+    for path in paths:
+        with XTCReader(path) as reader:
+            indexes.append(reader.index())
+    if frames_per_task is None:
+        n_frames = sum(len(index["offsets"]) for index in indexes)
+        # whole chunks, so no frames are decoded past the end of a range
+        frames_per_task = max(1, -(-n_frames // (n_tasks * chunk_size))) * chunk_size
+
+    tasks = []
+    previous = {}
+    for key, path, index in zip(keys, paths, indexes):
+        offsets, steps = index["offsets"], index["steps"]
+        group = key[:-1]
+        start = 0
+        if len(steps) and group in previous and steps[0] != 0 and steps[0] == previous[group]:
+            start = 1
+        if len(steps):
+            previous[group] = steps[-1]
+        for first in range(start, len(offsets), frames_per_task):
+            tasks.append((key, path, int(offsets[first]), min(frames_per_task, len(offsets) - first)))
+    return tasks
+
+
+def analyse_frames(task, selection, chunk_size=50, cutoff=0.8):
+    """Analyses the frame range of one task. Returns (key, StructuralPartial)."""
+    key, path, offset, n_frames = task
+    partial = StructuralPartial(len(selection.fit_atoms))
+    with XTCReader(path) as reader:
+        reader.seek(offset)
+        remaining = n_frames
+        for steps, times, _, coords in reader.iter_chunks(min(chunk_size, n_frames)):
+            partial.add_chunk(steps[:remaining], times[:remaining], coords[:remaining], selection, cutoff)
+            remaining -= len(coords)
+            if remaining <= 0:
+                break
+    return key, partial
+
+
+def _analyse_frames(args):
+    return analyse_frames(*args)
+
+
+def analyse_trajectories(paths, keys, selection, names=("replicate", "segment"), max_workers=None,
+                         chunk_size=50, frames_per_task=None, cutoff=0.8):
+    """
+    Computes the per-frame RMSD, Rg and number of contacts, and the RMSF and contact frequencies,
+    of the trajectories in paths with one process per frame range.
+    keys label each trajectory with values for names, the RMSF and contacts are reduced over the
+    trajectories sharing the key without its last name (e.g. per replicate).
+    Returns (frames, rmsf, contact_maps): a DataFrame with one row per frame, a DataFrame with one
+    row per fit atom and reduced group, and {group: contact frequency map}.
+    """
+    if max_workers is None:
+        max_workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    keys = [tuple(key) if isinstance(key, (tuple, list)) else (key,) for key in keys]
+    # a few tasks per worker keeps the workers busy to the end
+    tasks = plan_tasks(paths, keys, frames_per_task, 4 * max_workers, chunk_size)
+
+    arguments = [(task, selection, chunk_size, cutoff) for task in tasks]
+    if max_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+            results = list(executor.map(_analyse_frames, arguments))
+    else:
+        results = [_analyse_frames(argument) for argument in arguments]
+
+    frames = []
+    groups = {}
+    for key, partial in results:
+        for frame in partial.frames:
+            for position, (name, value) in enumerate(zip(names, key)):
+                frame.insert(position, name, value)
+            frames.append(frame)
+        partial.frames = []
+        group = key[:-1]
+        if group in groups:
+            groups[group].merge(partial)
+        else:
+            groups[group] = partial
+
+    if frames:
+        frames = pd.concat(frames, ignore_index=True).sort_values(list(names) + ["Step"], ignore_index=True)
+    else:
+        frames = pd.DataFrame(columns=list(names) + ["Step", "Time", "RMSD", "Rg", "Contacts"])
+    rmsf = []
+    for group, partial in groups.items():
+        table = pd.DataFrame({"resid": selection.resids, "resname": selection.resnames, "RMSF": partial.rmsf()})
+        for position, (name, value) in enumerate(zip(names, group)):
+            table.insert(position, name, value)
+        rmsf.append(table)
+    rmsf = pd.concat(rmsf, ignore_index=True) if rmsf else pd.DataFrame()
+    contact_maps = {group: partial.contact_frequency() for group, partial in groups.items()}
+    return frames, rmsf, contact_maps
@@ -0,0 +1,155 @@
+# Archival of analysed segments
+# Replaces the trajectories of a segment (the mdrun output and the pbc intermediates) with two tiers:
+# every frame of the protein only, and every stride-th frame of the whole system at a lower precision.
+# Both are written in one pass over the pbc corrected trajectory. A manifest records what was kept
+# (with sha256 digests) and what was removed. Nothing is removed unless the protein tier holds every
+# frame of the raw trajectory, and the manifest is written as pending before the first file goes.
+import os
+import json
+import time
+import numpy as np
+
+from .XTC import XTCReader, XTCWriter
+from .Structure import read_structure, write_pdb
+from .Artifact_Store import file_digest
+
+ARCHIVE_VERSION = 2
+
+
+def archive_paths(base, protein_variant="-protein", system_variant="-system"):
+    """Returns the paths of the archive tiers and manifest of the segment base (path without extension)."""
+    return {"protein": base + protein_variant + ".xtc",
+            "protein_pdb": base + protein_variant + ".pdb",
+            "system": base + system_variant + ".xtc",
+            "manifest": base + "-archive.json"}
+
+
+def write_archive(traj_file, structure_path, base, stride=10, protein_precision=1000.0,
+                  system_precision=100.0, chunk_size=100, atoms=None):
+    """
+    Writes the protein tier (every frame of the atoms, by default the non-solvent atoms of the structure)
+    and the system tier (every stride-th frame of all atoms) of traj_file, reading it once.
+    structure_path has the same atoms as traj_file; the first frame of the tier atoms is written as its pdb.
+    Precisions are in 1/nm as for xtc, 100 keeps 0.01 nm.
+    Returns the paths and the number of frames in each tier.
+    """
+    paths = archive_paths(base)
+    structure = read_structure(structure_path)
+    if atoms is None:
+        atoms = structure.protein_atoms()
+    protein_frames = system_frames = 0
+    index = 0
+    with XTCReader(traj_file) as reader, \
+            XTCWriter(paths["protein"], protein_precision) as protein, \
+            XTCWriter(paths["system"], system_precision) as system:
+        for steps, times, boxes, coords in reader.iter_chunks(chunk_size):
+            if coords.shape[1] != structure.n_atoms:
+                raise ValueError(f"Structure has {structure.n_atoms} atoms, {traj_file} has {coords.shape[1]}")
+            if protein_frames == 0:
+                write_pdb(paths["protein_pdb"], structure.select(atoms), coords[0][atoms], boxes[0])
+            protein.write_chunk(steps, times, boxes, coords[:, atoms])
+            protein_frames += len(coords)
+            # the frame numbers of this chunk that fall on the stride
+            keep = np.flatnonzero((index + np.arange(len(coords))) % stride == 0)
+            system.write_chunk(steps[keep], times[keep], boxes[keep], coords[keep])
+            system_frames += len(keep)
+            index += len(coords)
+    return paths, {"protein": protein_frames, "system": system_frames}
+
+
+def _file_record(path):
+    return {"path": os.path.basename(path), "size": os.path.getsize(path), "sha256": file_digest(path)}
+
+
+def count_frames(path):
+    """Returns the number of frames of an xtc, from the frame headers."""
+    with XTCReader(path) as reader:
+        return len(reader.index()["offsets"])
+
+
+def _write_manifest(path, manifest):
+    tmp_path = path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _remove_files(manifest, directory):
+    """Removes the files the manifest lists as removed, skipping those already gone."""
+    for record in manifest["removed"]:
+        path = os.path.join(directory, record["path"])
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def archive_segment(base, source_variant, structure_path, remove_variants, keep_raw=True, stride=10,
+                    protein_precision=1000.0, system_precision=100.0, dry_run=False):
+    """
+    Archives the segment at base (the tpr path without .tpr): writes the tiers from base + source_variant + .xtc,
+    then removes the .trr, the variants in remove_variants, the GROMACS backups of the segment files and,
+    unless keep_raw, the raw trajectory. Structures, energies, logs, tprs and checkpoints are kept.
+    Raises ValueError without removing anything if the protein tier has fewer frames than the raw
+    trajectory (or the source, once the raw trajectory is gone).
+    Writes and returns the manifest. It is written as pending before any file is removed, so an
+    interrupted archive finishes its removals when run again; a complete one is not touched again.
+    With dry_run the tiers are written but nothing is removed.
+    """
+    paths = archive_paths(base)
+    directory, name = os.path.split(base)
+    if os.path.exists(paths["manifest"]):
+        with open(paths["manifest"]) as f:
+            manifest = json.load(f)
+        if manifest.get("complete", True):
+            return manifest
+        # interrupted while removing: the tiers were written and checked
+        _remove_files(manifest, directory)
+        manifest["complete"] = True
+        _write_manifest(paths["manifest"], manifest)
+        return manifest
+
+    traj_file = base + source_variant + ".xtc"
+    start = time.time()
+    _, frames = write_archive(traj_file, structure_path, base, stride, protein_precision, system_precision)
+
+    # e.g. trjconv -dump writes a single frame, which is no replacement for the trajectory
+    reference = base + ".xtc" if os.path.exists(base + ".xtc") else traj_file
+    expected = count_frames(reference)
+    archived = count_frames(paths["protein"])
+    if archived != expected:
+        raise ValueError(f"The protein tier of {name} has {archived} frames, {os.path.basename(reference)} "
+                         f"has {expected}. Not removing any trajectories.")
+
+    candidates = [base + variant + ".xtc" for variant in remove_variants] + [base + ".trr"]
+    if not keep_raw:
+        candidates.append(base + ".xtc")
+    # trjconv and mdrun back up overwritten files as #name.N#
+    candidates += [os.path.join(directory, file) for file in os.listdir(directory)
+                   if file.startswith("#" + name + "-") or file.startswith("#" + name + ".")]
+
+    removed = [{"path": os.path.basename(path), "size": os.path.getsize(path)}
+               for path in candidates if os.path.exists(path) and path not in paths.values()]
+
+    kept = [dict(_file_record(paths[tier]), tier=tier) for tier in ("protein", "protein_pdb", "system")]
+    manifest = {"version": ARCHIVE_VERSION,
+                "segment": os.path.basename(base),
+                "source": os.path.basename(traj_file),
+                "time": time.time(),
+                "wall_time": time.time() - start,
+                "stride": stride,
+                "protein_precision": protein_precision,
+                "system_precision": system_precision,
+                "frames": frames,
+                "source_frames": expected,
+                "kept": kept,
+                "removed": removed,
+                "kept_bytes": sum(record["size"] for record in kept),
+                "removed_bytes": sum(record["size"] for record in removed),
+                "dry_run": dry_run,
+                "complete": False}
+    if dry_run:
+        return manifest
+    _write_manifest(paths["manifest"], manifest)
+    _remove_files(manifest, directory)
+    manifest["complete"] = True
+    _write_manifest(paths["manifest"], manifest)
+    return manifest
@@ -0,0 +1,244 @@
+# Content addressed store for input files and grompp outputs
+import os
+import shutil
+import hashlib
+import time
+
+_digests = {}
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Returns the sha256 of a file.
+    Digests are cached by inode, size and mtime so unchanged files are only read once per process.
+    """
+    stat = os.stat(path)
+    cache_key = (os.path.realpath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    digest = _digests.get(cache_key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        _digests[cache_key] = digest
+    return digest
+
+
+class ArtifactStore():
+    """
+    Stores files under the sha256 of their contents.
+    Inputs are materialised into replicate directories as hardlinks (or reflinks/copies
+    if the store is on a different filesystem), so every replicate shares one copy.
+    grompp outputs are indexed by a key built from the hashes of the grompp inputs,
+    so an identical mdp/gro/top combination reuses the cached .tpr.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.tpr_index = os.path.join(root, "tpr")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.tpr_index, exist_ok=True)
+
+    def hash_file(self, path):
+        """Returns the sha256 of a file."""
+        return file_digest(path)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def put(self, path):
+        """
+        Adds a file to the store and returns its digest.
+        """
+        digest = self.hash_file(path)
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = object_path + ".tmp" + str(os.getpid())
+            shutil.copyfile(path, tmp_path)
+            # stored objects are shared between replicates so must not be edited in place
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, object_path)
+        return digest
+
+    def materialise(self, digest, destination):
+        """
+        Places the object at destination as a hardlink, falling back to a reflink or copy.
+        Returns the method used.
+        """
+        object_path = self.object_path(digest)
+        if os.path.exists(destination):
+            if os.path.samefile(object_path, destination):
+                self.touch(digest)
+                return "existing"
+            os.remove(destination)
+
+        try:
+            os.link(object_path, destination)
+            method = "hardlink"
+        except OSError:
+            method = "reflink" if reflink(object_path, destination) else "copy"
+            if method == "copy":
+                shutil.copyfile(object_path, destination)
+        self.touch(digest)
+        return method
+
+    def touch(self, digest):
+        """Marks the object as used for the eviction order."""
+        os.utime(self.object_path(digest))
+
+    def grompp_key(self, md_mdp, input_path, topo_path, ref_path=None, args=()):
+        """
+        Returns the cache key for a grompp call.
+        The key covers the mdp, structures, topology, the local files the topology includes and the args.
+        """
+        sha = hashlib.sha256()
+        paths = [md_mdp, input_path, topo_path, ref_path or input_path]
+        paths += topology_includes(topo_path)
+        for path in paths:
+            sha.update(self.hash_file(path).encode())
+        sha.update(" ".join(args).encode())
+        return sha.hexdigest()
+
+    def get_tpr(self, key, tpr_path):
+        """
+        Materialises the cached tpr for key at tpr_path.
+        Returns False if there is no cached tpr.
+        """
+        index_path = os.path.join(self.tpr_index, key)
+        if not os.path.exists(index_path):
+            return False
+        with open(index_path) as f:
+            digest = f.read().strip()
+        if not self.has(digest):
+            os.remove(index_path)
+            return False
+        self.materialise(digest, tpr_path)
+        return True
+
+    def put_tpr(self, key, tpr_path):
+        """Adds a grompp output to the store under key."""
+        digest = self.put(tpr_path)
+        index_path = os.path.join(self.tpr_index, key)
+        with open(index_path + ".tmp", "w") as f:
+            f.write(digest)
+        os.replace(index_path + ".tmp", index_path)
+        return digest
+
+    def size(self):
+        """Returns the total size of the stored objects in bytes."""
+        return sum(os.stat(path).st_size for path, _ in self._iter_objects())
+
+    def _iter_objects(self):
+        for prefix in os.scandir(self.objects):
+            if prefix.is_dir():
+                for entry in os.scandir(prefix.path):
+                    if ".tmp" not in entry.name:
+                        yield entry.path, prefix.name + entry.name
+
+    def gc(self, max_age=None, max_bytes=None, dry_run=False):
+        """
+        Evicts objects from the store.
+        Objects no longer linked from any replicate or tpr index entry are removed once they
+        are older than max_age seconds (immediately if max_age is None).
+        If the cached tprs still take more than max_bytes the least recently used are removed.
+        Objects hardlinked into replicate directories take no extra space and are kept.
+        Returns the list of removed digests.
+        """
+        indexed = set()
+        for entry in os.scandir(self.tpr_index):
+            with open(entry.path) as f:
+                indexed.add(f.read().strip())
+
+        now = time.time()
+        objects = []
+        removed = []
+        for path, digest in self._iter_objects():
+            stat = os.stat(path)
+            if stat.st_nlink > 1:
+                continue
+            if digest not in indexed:
+                if max_age is None or now - stat.st_mtime > max_age:
+                    removed.append((path, digest, stat.st_size))
+            else:
+                objects.append((stat.st_mtime, path, digest, stat.st_size))
+
+        if max_bytes is not None:
+            total = sum(size for _, _, _, size in objects)
+            for _, path, digest, size in sorted(objects):
+                if total <= max_bytes:
+                    break
+                removed.append((path, digest, size))
+                total -= size
+
+        for path, digest, size in removed:
+            print("Evicting: ", digest, size, "bytes")
+            if not dry_run:
+                os.remove(path)
+
+        # drop index entries whose tpr was evicted
+        if not dry_run:
+            evicted = {digest for _, digest, _ in removed}
+            for entry in os.scandir(self.tpr_index):
+                with open(entry.path) as f:
+                    if f.read().strip() in evicted:
+                        os.remove(entry.path)
+        return [digest for _, digest, _ in removed]
+
+
+def topology_includes(topo_path):
+    """
+    Returns the #include files of a topology that exist next to it.
+    Force field files found through GMXLIB are not included.
+    """
+    topo_dir = os.path.dirname(topo_path)
+    includes = []
+    with open(topo_path, "rb") as f:
+        for line in f:
+            if line.startswith(b"#include"):
+                name = line.split(b'"')[1].decode() if b'"' in line else ""
+                path = os.path.join(topo_dir, name)
+                if name and os.path.isfile(path):
+                    includes.append(path)
+    return includes
+
+
+def reflink(source, destination):
+    """
+    Tries to clone source to destination with the FICLONE ioctl (btrfs/xfs).
+    Returns whether it succeeded.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Garbage collect an xMD artifact store")
+    parser.add_argument("root", help="Artifact store directory")
+    parser.add_argument("--max-age", dest="max_age", type=float,
+                        help="Keep unused objects younger than this many seconds")
+    parser.add_argument("--max-bytes", dest="max_bytes", type=int,
+                        help="Evict least recently used objects above this size")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true")
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.root)
+    removed = store.gc(args.max_age, args.max_bytes, args.dry_run)
+    print(f"Removed {len(removed)} objects, store size: {store.size()} bytes")
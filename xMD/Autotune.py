@@ -0,0 +1,283 @@
+# mdrun layout autotuning with short probe runs
+# A probe grompps config/md_short.mdp once for the system, then runs mdrun with each
+# thread/rank/PME layout of a grid and reads ns/day from the Performance footer of the log.
+# The best layout is cached per (system size, cores, gpu, hardware fingerprint) and every
+# probe is kept in a benchmark history so the performance can be tracked over time.
+import os
+import json
+import time
+import shutil
+import hashlib
+import platform
+import subprocess
+
+from .AuxMD import available_cores, run_grompp, gpu_options
+from .MD_Log import parse_gromacs_performance
+
+TUNING_CACHE_VERSION = 1
+# mdrun options set by a layout, replaced when a layout is applied
+LAYOUT_OPTIONS = {"-nt": 1, "-ntmpi": 1, "-ntomp": 1, "-npme": 1, "-nstlist": 1}
+
+
+def hardware_fingerprint():
+    """
+    Returns (fingerprint, description) of the CPU model, core count and GPUs of this node.
+    """
+    cpu = platform.processor() or platform.machine()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    gpus = []
+    if shutil.which("nvidia-smi"):
+        try:
+            output = subprocess.run(["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
+                                    capture_output=True, text=True, timeout=10).stdout
+            gpus = [line.strip() for line in output.splitlines() if line.strip()]
+        except (OSError, subprocess.SubprocessError):
+            pass
+    description = {"cpu": cpu, "machine": platform.machine(), "cores": available_cores(), "gpus": gpus}
+    fingerprint = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()[:12]
+    return fingerprint, description
+
+
+def count_atoms(structure_path):
+    """Returns the number of atoms of a .gro file from its header, or of a .top from its molecules."""
+    if structure_path.endswith(".top"):
+        from .Topology import read_topology
+        return read_topology(structure_path).n_atoms
+    with open(structure_path) as f:
+        f.readline()
+        return int(f.readline())
+
+
+def size_bucket(n_atoms):
+    """Rounds the atom count to two significant figures, so similar systems share a layout."""
+    digits = max(len(str(n_atoms)) - 2, 0)
+    return int(round(n_atoms, -digits))
+
+
+def layout_grid(cores, gmx="gmx", gpu=False, nstlist=(None, 40)):
+    """
+    Returns the layouts to probe on cores cores as dicts of ntmpi, ntomp, npme and nstlist.
+    gmx_mpi runs a single rank here, so only the OpenMP threads and nstlist are varied.
+    """
+    layouts = []
+    if gmx == "gmx_mpi":
+        rank_counts = [1]
+    else:
+        rank_counts = [ranks for ranks in range(1, cores + 1) if cores % ranks == 0 and cores // ranks <= 16]
+        if gpu:
+            rank_counts = [ranks for ranks in rank_counts if ranks <= 4]
+    for ranks in rank_counts:
+        if gpu:
+            # with -pme gpu only one rank can do PME
+            pme_ranks = [-1] if ranks == 1 else [1]
+        elif ranks >= 4:
+            pme_ranks = [-1, 0, ranks // 4]
+        else:
+            pme_ranks = [-1]
+        for npme in pme_ranks:
+            for n in nstlist:
+                layouts.append({"ntmpi": ranks, "ntomp": cores // ranks, "npme": npme, "nstlist": n})
+    return layouts
+
+
+def layout_options(layout, gmx="gmx"):
+    """Returns the mdrun options of a layout."""
+    if gmx == "gmx_mpi":
+        options = ["-ntomp", str(layout["ntomp"])]
+    else:
+        options = ["-ntmpi", str(layout["ntmpi"]), "-ntomp", str(layout["ntomp"])]
+        if layout["npme"] != -1:
+            options += ["-npme", str(layout["npme"])]
+    if layout["nstlist"] is not None:
+        options += ["-nstlist", str(layout["nstlist"])]
+    return options
+
+
+def option_cores(mdrun_opts):
+    """Returns the number of cores given to mdrun by -nt or -ntmpi/-ntomp in mdrun_opts, or None."""
+    def value(flag):
+        return int(mdrun_opts[mdrun_opts.index(flag) + 1]) if flag in mdrun_opts else None
+    if value("-nt") is not None:
+        return value("-nt")
+    if value("-ntomp") is not None:
+        return value("-ntomp") * (value("-ntmpi") or 1)
+    return None
+
+
+def remove_layout_options(mdrun_opts):
+    """Returns mdrun_opts without its thread, rank and nstlist options. Pinning is kept."""
+    options = []
+    skip = 0
+    for option in mdrun_opts:
+        if skip:
+            skip -= 1
+        elif option in LAYOUT_OPTIONS:
+            skip = LAYOUT_OPTIONS[option]
+        else:
+            options.append(option)
+    return options
+
+
+def apply_layout(mdrun_opts, layout, gmx="gmx"):
+    """Returns mdrun_opts with its thread and rank options replaced by the layout's."""
+    return remove_layout_options(mdrun_opts) + layout_options(layout, gmx)
+
+
+class MDRunTuner():
+    """
+    Cache of the best mdrun layout per system size and node, with the history of every probe.
+    The cache is a JSON file at cache_path, the history is appended to the .benchmarks.jsonl next to it.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.history_path = os.path.splitext(cache_path)[0] + ".benchmarks.jsonl"
+        self.fingerprint, self.hardware = hardware_fingerprint()
+        self.cache = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == TUNING_CACHE_VERSION:
+            self.cache = data["layouts"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = self.cache_path + ".tmp" + str(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"version": TUNING_CACHE_VERSION, "layouts": self.cache}, f, indent=1)
+        os.replace(tmp_path, self.cache_path)
+
+    def key(self, n_atoms, cores, gpu=False, gmx="gmx"):
+        return "|".join([str(size_bucket(n_atoms)), str(cores), "gpu" if gpu else "cpu", gmx, self.fingerprint])
+
+    def best(self, n_atoms, cores, gpu=False, gmx="gmx"):
+        """Returns the cached best layout, or None if this system size has not been tuned here."""
+        entry = self.cache.get(self.key(n_atoms, cores, gpu, gmx))
+        return None if entry is None else entry["layout"]
+
+    def record(self, result):
+        os.makedirs(os.path.dirname(os.path.abspath(self.history_path)), exist_ok=True)
+        with open(self.history_path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+    def tune(self,
+             probe_mdp,
+             structure_path,
+             topo_path,
+             work_dir,
+             gmx="gmx",
+             gpu=False,
+             cores=None,
+             layouts=None,
+             nsteps=None,
+             pin_opts=None,
+             artifact_store=None):
+        """
+        Runs one probe per layout and caches the fastest.
+        The probe tpr is made once from probe_mdp; nsteps overrides its length.
+        pin_opts (e.g. -pin on -pinoffset) are added to every probe.
+        Returns the probe results, fastest first. Layouts that fail to run get ns_per_day None.
+        """
+        if cores is None:
+            cores = available_cores()
+        if layouts is None:
+            layouts = layout_grid(cores, gmx, gpu)
+        os.makedirs(work_dir, exist_ok=True)
+        n_atoms = count_atoms(structure_path)
+        key = self.key(n_atoms, cores, gpu, gmx)
+        session = time.time()
+
+        tpr_path = os.path.join(work_dir, "probe.tpr")
+        run_grompp(["gmx", "grompp",
+                    "-f", probe_mdp,
+                    "-c", structure_path,
+                    "-p", topo_path,
+                    "-o", tpr_path,
+                    "-r", structure_path,
+                    "-maxwarn", "1"], artifact_store)
+
+        results = []
+        for i, layout in enumerate(layouts):
+            deffnm = os.path.join(work_dir, f"probe_{i}")
+            mdrun_command = [gmx, "mdrun", "-s", tpr_path, "-deffnm", deffnm,
+                             "-resethway", "-noconfout"]
+            if nsteps is not None:
+                mdrun_command += ["-nsteps", str(nsteps)]
+            if gpu:
+                # as run_MD does for gpu runs
+                mdrun_command += gpu_options(pin_opts)
+            mdrun_command += (pin_opts or []) + layout_options(layout, gmx)
+            print("Probe: ", mdrun_command)
+
+            start = time.time()
+            performance = None
+            try:
+                subprocess.run(mdrun_command, check=True, capture_output=True)
+                performance = parse_gromacs_performance(deffnm + ".log")
+            except subprocess.CalledProcessError as error:
+                print("Probe failed: ", error.stderr.decode(errors="replace")[-500:])
+            result = {"key": key,
+                      "session": session,
+                      "time": time.time(),
+                      "n_atoms": n_atoms,
+                      "cores": cores,
+                      "gpu": gpu,
+                      "gmx": gmx,
+                      "fingerprint": self.fingerprint,
+                      "hardware": self.hardware,
+                      "mdp": os.path.basename(probe_mdp),
+                      "layout": layout,
+                      "wall_time": time.time() - start,
+                      "ns_per_day": performance[0] if performance else None}
+            self.record(result)
+            results.append(result)
+
+        results.sort(key=lambda result: -(result["ns_per_day"] or 0.0))
+        if results and results[0]["ns_per_day"] is not None:
+            self.cache[key] = {"layout": results[0]["layout"],
+                               "ns_per_day": results[0]["ns_per_day"],
+                               "n_atoms": n_atoms,
+                               "hardware": self.hardware,
+                               "time": session}
+            self.save()
+            print(f"Best layout for {key}: ", results[0]["layout"], results[0]["ns_per_day"], "ns/day")
+        return results
+
+    def history(self):
+        """Returns every probe run so far as a DataFrame."""
+        import pandas as pd
+
+        if not os.path.exists(self.history_path):
+            return pd.DataFrame()
+        with open(self.history_path) as f:
+            return pd.DataFrame([json.loads(line) for line in f])
+
+    def regressions(self, tolerance=0.1):
+        """
+        Compares the best ns/day of the latest tuning session of every key to the best of the
+        sessions before it. Returns {key: (previous, latest)} for those more than tolerance slower.
+        """
+        history = self.history()
+        if history.empty:
+            return {}
+        regressions = {}
+        best = history.dropna(subset=["ns_per_day"]).groupby(["key", "session"])["ns_per_day"].max()
+        for key, sessions in best.groupby(level="key"):
+            if len(sessions) < 2:
+                continue
+            latest = sessions.iloc[-1]
+            previous = sessions.iloc[:-1].max()
+            if latest < (1 - tolerance) * previous:
+                regressions[key] = (float(previous), float(latest))
+        return regressions
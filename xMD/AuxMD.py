@@ -4,8 +4,7 @@ from copy import deepcopy
 import glob
 import shutil
 import subprocess
-import pandas as pd
-import argparse
+from .Tracing import span, run_command
 
 
 def run_MD(md_mdp: str, 
@@ -13,43 +12,270 @@ def run_MD(md_mdp: str,
            topo_path: str, 
            tpr_path: str, 
            gmx: str,
-           gpu: bool = False):
-    
-    grompp_command = ["gmx", "grompp", 
-                    "-f", md_mdp, 
-                    "-c", input_path, 
-                    "-p", topo_path, 
-                    "-o", tpr_path, 
-                    "-r", input_path, 
-                    "-maxwarn", "1",
-                    "-v"]
-    subprocess.run(grompp_command, check=True)
+           gpu: bool = False,
+           mdrun_opts: list = None,
+           checkpoint: str = None,
+           artifact_store=None,
+           extend_from: str = None,
+           extend_ps: float = None,
+           supervise: bool = False,
+           timeout: float = None,
+           writer=None,
+           step_offset: int = 0,
+           on_start=None):
+    """
+    Runs grompp and mdrun for one segment.
+    If a checkpoint is given the existing tpr is continued from it with mdrun -cpi instead.
+    If extend_from (the tpr of the previous segment) is given, grompp is skipped: that tpr is
+    extended by extend_ps and mdrun continues from the checkpoint of the previous segment.
+    If an artifact store is given, a tpr cached for identical grompp inputs is reused.
+    With supervise, mdrun is watched by the shared Supervisor: its progress goes to writer
+    and it is stopped (with a checkpoint) after timeout seconds, raising subprocess.TimeoutExpired.
+    on_start is called with the supervised process, e.g. ConvergenceMonitor.attach to stop it early.
+    Returns the path of the output structure.
+    """
+    deffnm = tpr_path.replace(".tpr","")
+    if extend_from is not None and checkpoint is None:
+        extend_tpr(extend_from, tpr_path, extend_ps)
+        checkpoint = extend_from.replace(".tpr", ".cpt")
+    elif checkpoint is None:
+        grompp_command = ["gmx", "grompp", 
+                        "-f", md_mdp, 
+                        "-c", input_path, 
+                        "-p", topo_path, 
+                        "-o", tpr_path, 
+                        "-r", input_path, 
+                        "-maxwarn", "1",
+                        "-v"]
+        run_grompp(grompp_command, artifact_store)
     ### TODO add try except for gmx vs gmx_mpi
-    mdrun_command = [gmx, "mdrun", "-v", "-deffnm", tpr_path.replace(".tpr","")]
-    # trying out different gpu options
-    if gpu: 
-        mdrun_command.extend(["-pin", "on", "-pme", "gpu", "-pmefft", "gpu"])
+    mdrun_command = [gmx, "mdrun", "-v", "-deffnm", deffnm]
+    if checkpoint is not None:
+        mdrun_command.extend(["-cpi", checkpoint])
+        # the outputs of an extended segment have different names to those in the checkpoint,
+        # so they are written as .partNNNN files and collected once mdrun finishes
+        if extend_from is not None or part_files(deffnm):
+            mdrun_command.append("-noappend")
+    mdrun_command.extend(gpu_options(mdrun_opts) if gpu else [])
+    if mdrun_opts:
+        mdrun_command.extend(mdrun_opts)
     
     print(mdrun_command)
-    subprocess.run(mdrun_command, check=True)
+    if supervise:
+        from .Supervisor import run_mdrun
+        from .MDP import read_mdp
+
+        try:
+            parameters = read_mdp(md_mdp)
+        except OSError:
+            parameters = {}
+        # steps of an extended segment continue from the previous one, so its fraction done is unknown
+        nsteps = int(parameters["nsteps"]) if "nsteps" in parameters and extend_from is None else None
+        try:
+            run_mdrun(mdrun_command,
+                      name=os.path.basename(deffnm),
+                      nsteps=nsteps if nsteps is not None and nsteps > 0 else None,
+                      dt_ps=float(parameters.get("dt", 0.001)),
+                      timeout=timeout,
+                      writer=writer,
+                      step_offset=step_offset,
+                      on_start=on_start)
+        except subprocess.TimeoutExpired:
+            collect_parts(deffnm)
+            # mdrun writes the final structure when it is stopped, the segment continues from its checkpoint
+            if os.path.exists(deffnm + ".gro"):
+                os.remove(deffnm + ".gro")
+            raise
+    else:
+        run_command(mdrun_command)
+    collect_parts(deffnm)
 
     input_path = tpr_path.replace(".tpr",".gro")
     return input_path
 
 
+def gpu_options(mdrun_opts: list = None):
+    """
+    Returns the options that put PME on the gpu, leaving out those already in mdrun_opts
+    (e.g. the pinning of run_replicates), as mdrun rejects an option given twice.
+    """
+    options = []
+    for flag, value in (("-pin", "on"), ("-pme", "gpu"), ("-pmefft", "gpu")):
+        if flag not in (mdrun_opts or []):
+            options.extend([flag, value])
+    return options
+
+
+def aggregate_performance(rates: list, n_parallel: int, n_jobs: int):
+    """
+    Returns the ns/day of the node over jobs that ran n_parallel at a time, and whether it is an estimate.
+    If every job ran at once their Performance ns/day add up. Otherwise the mean rate times n_parallel
+    is only an estimate, as the jobs did not all run alongside each other.
+    """
+    rates = [rate for rate in rates if rate is not None]
+    if not rates:
+        return None, False
+    if n_jobs <= n_parallel:
+        return sum(rates), False
+    return sum(rates) / len(rates) * n_parallel, True
+
+
+def run_grompp(grompp_command: list, artifact_store=None):
+    """
+    Runs grompp, or materialises the tpr from the artifact store if the
+    mdp, structure and topology hash the same as an earlier call.
+    mdps with random seeds (e.g. gen-seed -1) always run grompp, so each replicate gets its own
+    velocities and thermostat seed rather than a copy of the first replicate's tpr.
+    """
+    from .MDP import read_mdp, random_seeds
+
+    def arg(flag):
+        return grompp_command[grompp_command.index(flag) + 1]
+
+    if artifact_store is None or random_seeds(read_mdp(arg("-f"))):
+        run_command(grompp_command)
+        return
+
+    tpr_path = arg("-o")
+    # the key covers the file contents, not the file names
+    key = artifact_store.grompp_key(arg("-f"), arg("-c"), arg("-p"), arg("-r"),
+                                    ["-maxwarn", arg("-maxwarn")])
+    with span("tpr cache lookup", "io"):
+        cached = artifact_store.get_tpr(key, tpr_path)
+    if cached:
+        print("Reusing cached tpr: ", tpr_path)
+        return
+
+    run_command(grompp_command)
+    artifact_store.put_tpr(key, tpr_path)
+
+
+def extend_tpr(previous_tpr: str, tpr_path: str, extend_ps: float):
+    """
+    Writes tpr_path as previous_tpr with the run extended by extend_ps picoseconds.
+    Continued from the checkpoint of previous_tpr, mdrun then runs only the extension.
+    """
+    print(f"Extending {previous_tpr} by {extend_ps} ps instead of running grompp")
+    run_command(["gmx", "convert-tpr",
+                 "-s", previous_tpr,
+                 "-extend", str(extend_ps),
+                 "-o", tpr_path])
+
+
+def part_files(deffnm: str):
+    """Returns {extension: [paths]} of the .partNNNN output files of deffnm, in part order."""
+    parts = {}
+    for path in sorted(glob.glob(deffnm + ".part[0-9][0-9][0-9][0-9].*")):
+        extension = path[len(deffnm) + len(".part0000"):]
+        parts.setdefault(extension, []).append(path)
+    return parts
+
+
+def part_number(path: str):
+    """Returns the part number of a .partNNNN output file."""
+    return int(path.rsplit(".part", 1)[1][:4])
+
+
+def collect_parts(deffnm: str):
+    """
+    Joins the .partNNNN files written by mdrun -noappend into the usual deffnm.<ext> files,
+    so a continued segment looks like any other. Trajectories and energies are concatenated
+    (an interrupted continuation has several parts), for other files the last part is kept.
+    """
+    for extension, paths in part_files(deffnm).items():
+        out_path = deffnm + extension
+        if len(paths) == 1:
+            os.replace(paths[0], out_path)
+            continue
+        if extension == ".xtc":
+            from .XTC import concatenate_xtc
+            concatenate_xtc(paths, out_path)
+        elif extension == ".edr":
+            run_command(["gmx", "eneconv", "-f"] + paths + ["-o", out_path])
+        elif extension == ".trr":
+            run_command(["gmx", "trjcat", "-f"] + paths + ["-o", out_path])
+        elif extension == ".log":
+            with open(out_path, "wb") as out:
+                for path in paths:
+                    with open(path, "rb") as f:
+                        shutil.copyfileobj(f, out)
+        else:
+            os.replace(paths[-1], out_path)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def available_cores():
+    """
+    Returns the number of cores this process is allowed to run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def partition_cores(n_jobs: int,
+                    total_cores: int = None,
+                    pin_stride: int = 1):
+    """
+    Splits the cores of the node into n_jobs disjoint, contiguous core sets.
+    Returns a list of (pin_offset, n_threads) tuples, one per job.
+    """
+    if total_cores is None:
+        total_cores = available_cores()
+    usable = total_cores // pin_stride
+    if n_jobs < 1 or n_jobs > usable:
+        raise ValueError(f"Cannot split {total_cores} cores between {n_jobs} jobs.")
+
+    n_threads = usable // n_jobs
+    return [(i * n_threads * pin_stride, n_threads) for i in range(n_jobs)]
+
+
+def mdrun_thread_options(n_threads: int,
+                         pin_offset: int,
+                         gmx: str = "gmx",
+                         pin_stride: int = 1):
+    """
+    Returns the mdrun options to run on n_threads cores starting at pin_offset.
+    gmx_mpi cannot use thread-MPI, so a single rank is given n_threads OpenMP threads.
+    """
+    if gmx == "gmx_mpi":
+        thread_opts = ["-ntomp", str(n_threads)]
+    else:
+        thread_opts = ["-nt", str(n_threads)]
+    return thread_opts + ["-pin", "on",
+                          "-pinoffset", str(pin_offset),
+                          "-pinstride", str(pin_stride)]
+
+
 def traj_to_pdb(traj_file: str,
                 tpr_path: str,
-                pdb_path: str):
+                pdb_path: str,
+                backend: str = "gmx"):
+    """
+    Writes the protein atoms of every frame of the trajectory to a multi-model pdb.
+    With the numpy backend, tpr_path must be a .gro/.pdb structure and no subprocess is used.
+    """
+    if backend == "numpy":
+        from .Structure import read_structure, write_pdb_models
+        from .XTC import XTCReader
+
+        with span("traj_to_pdb", "analysis", traj_file=traj_file):
+            structure = read_structure(tpr_path)
+            protein = structure.protein_atoms()
+            with XTCReader(traj_file) as reader:
+                # decoded a chunk at a time, with the compiled codec if mdtraj is installed
+                frames = (coords for _, _, _, chunk in reader.iter_chunks() for coords in chunk[:, protein])
+                write_pdb_models(pdb_path, structure.select(protein), frames)
+        print("PDB file written to: ", pdb_path)
+        return
+
     pdbout_command = ["gmx", "trjconv", 
                         "-f", traj_file,
                         "-s", tpr_path,
                         "-o", pdb_path]
 
-    subprocess.run(pdbout_command, input=b"1\n", check=True)
+    run_command(pdbout_command, input=b"1\n", name="gmx trjconv pdb")
     print("PDB file written to: ", pdb_path)  
-    
-      
-
-def PBC_conversion():
-
-    pass
@@ -0,0 +1,308 @@
+# Campaigns: a matrix of pdbcodes x replicates x config sets run as a queue of jobs
+# The jobs run on a bounded process pool. Each job gets its own disjoint set of cores
+# and runs in its own process, so a failing job does not affect the others.
+import os
+import sys
+import json
+import time
+import heapq
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .AuxMD import available_cores, mdrun_thread_options
+
+
+class CampaignJob():
+    """
+    One replicate of one config set for one structure.
+    Jobs with a higher priority are started first.
+    minutes is the expected run time, used to pack short jobs into batch allocations.
+    run_kwargs are passed on to xMD.run_experiment.
+    """
+    def __init__(self,
+                 pdbcode: str,
+                 rep: int,
+                 config_files: list,
+                 name: str,
+                 cores: int = 1,
+                 priority: int = 0,
+                 minutes: float = None,
+                 **run_kwargs):
+        self.pdbcode = pdbcode
+        self.rep = rep
+        self.config_files = list(config_files)
+        self.name = name
+        self.cores = cores
+        self.priority = priority
+        self.minutes = minutes
+        self.run_kwargs = run_kwargs
+        self.attempts = 0
+
+    @property
+    def key(self):
+        return "/".join([self.pdbcode, self.name, "R_" + str(self.rep)])
+
+    def __repr__(self):
+        return f"CampaignJob({self.key}, cores={self.cores}, priority={self.priority})"
+
+
+def _redirect_output(log_path):
+    """Sends the stdout and stderr of this process (and its subprocesses) to log_path."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    return saved
+
+
+def _restore_output(saved):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(saved[0], 1)
+    os.dup2(saved[1], 2)
+    os.close(saved[0])
+    os.close(saved[1])
+
+
+def run_campaign_job(settings, job, mdrun_opts, env=None, log_path=None):
+    """
+    Runs one job in a worker process and returns its metrics.
+    Exceptions are caught and returned so the worker stays usable for the next job.
+    """
+    from .xMD import xMD
+
+    start = time.time()
+    cpu_start = os.times()
+    result = {"key": job.key,
+              "pdbcode": job.pdbcode,
+              "name": job.name,
+              "rep": job.rep,
+              "cores": job.cores,
+              "priority": job.priority,
+              "pid": os.getpid(),
+              "mdrun_opts": mdrun_opts,
+              "start": start}
+    saved_env = {}
+    for key, value in (env or {}).items():
+        saved_env[key] = os.environ.get(key)
+        os.environ[key] = value
+    saved_output = _redirect_output(log_path) if log_path is not None else None
+    try:
+        experiment = xMD(settings, job.name, job.pdbcode, job.rep)
+        experiment.mdrun_opts = experiment.mdrun_opts + mdrun_opts
+        experiment.create_directory_structure(overwrite=True)
+        experiment.run_experiment(config_files=job.config_files, rep=job.rep, **job.run_kwargs)
+        result["ns_per_day"] = experiment.replicate_performance(job.rep)
+        result["manifest"] = experiment.save_experiment()
+        result["status"] = "complete"
+    except Exception as error:
+        result["status"] = "failed"
+        result["error"] = "".join(traceback.format_exception_only(type(error), error)).strip()
+        result["traceback"] = traceback.format_exc()
+    finally:
+        if saved_output is not None:
+            _restore_output(saved_output)
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    cpu_end = os.times()
+    result["end"] = time.time()
+    result["run_time"] = result["end"] - start
+    # user + system time of this worker and the gmx processes it waited for
+    result["cpu_time"] = sum(cpu_end[:4]) - sum(cpu_start[:4])
+    return result
+
+
+class Campaign():
+    """
+    Runs a queue of CampaignJobs on a bounded pool of worker processes.
+    The node's cores are handed out as disjoint, contiguous sets: a job starts as soon as
+    its core budget is free, highest priority first. Lower priority jobs that fit are started
+    in the gaps left by a job that does not fit yet, so cores are not left idle.
+    A job that raises is recorded as failed; a worker that dies takes down the pool, which is
+    restarted and the jobs that were running are retried up to max_attempts times.
+    gmx_path is a directory put first on PATH in the workers, e.g. to use a stand-in gmx.
+    Metrics for each job are appended to metrics_path (JSON lines) as jobs finish.
+    """
+    def __init__(self,
+                 settings,
+                 total_cores: int = None,
+                 max_workers: int = None,
+                 pin_stride: int = 1,
+                 gmx_path: str = None,
+                 env: dict = None,
+                 metrics_path: str = None,
+                 log_dir: str = None,
+                 max_attempts: int = 2):
+        self.settings = settings
+        self.total_cores = total_cores if total_cores is not None else available_cores()
+        self.max_workers = max_workers
+        self.pin_stride = pin_stride
+        self.env = dict(env or {})
+        if gmx_path is not None:
+            self.env["PATH"] = os.path.abspath(gmx_path) + os.pathsep + os.environ.get("PATH", "")
+        self.metrics_path = metrics_path
+        self.log_dir = log_dir
+        self.max_attempts = max_attempts
+        self.jobs = []
+        self.results = []
+        self.summary = None
+
+    def add_job(self, job: CampaignJob):
+        if job.cores * self.pin_stride > self.total_cores:
+            raise ValueError(f"{job} needs more than the {self.total_cores} cores of the campaign.")
+        self.jobs.append(job)
+        return job
+
+    def add_matrix(self,
+                   pdbcodes: list,
+                   replicates,
+                   config_sets: dict,
+                   cores: int = 1,
+                   priority=0,
+                   minutes: float = None,
+                   **run_kwargs):
+        """
+        Adds a job for every pdbcode x replicate x config set.
+        replicates is a number of replicates or a list of replicate numbers.
+        config_sets maps the experiment name to its list of mdp files.
+        priority is a number or a function of (pdbcode, rep, name).
+        """
+        if isinstance(replicates, int):
+            replicates = range(1, replicates + 1)
+        jobs = []
+        for pdbcode in pdbcodes:
+            for name, config_files in config_sets.items():
+                for rep in replicates:
+                    job_priority = priority(pdbcode, rep, name) if callable(priority) else priority
+                    jobs.append(self.add_job(CampaignJob(pdbcode, rep, config_files, name,
+                                                         cores=cores, priority=job_priority,
+                                                         minutes=minutes, **run_kwargs)))
+        return jobs
+
+    def _allocate(self, free, cores):
+        """Returns the pin offset of the first run of free cores for the job, or None."""
+        run = 0
+        for i, is_free in enumerate(free):
+            run = run + 1 if is_free else 0
+            if run == cores:
+                start = i - cores + 1
+                for j in range(start, i + 1):
+                    free[j] = False
+                return start
+        return None
+
+    def _record(self, result):
+        self.results.append(result)
+        if self.metrics_path is not None:
+            with open(self.metrics_path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+        print(f"Job {result['key']} {result['status']} in {result['run_time']:.1f} s "
+              f"(waited {result['queue_wait']:.1f} s)")
+
+    def run(self):
+        """
+        Runs all the jobs and returns their metrics as a DataFrame.
+        The campaign totals are stored in self.summary.
+        """
+        import pandas as pd
+
+        slots = self.total_cores // self.pin_stride
+        free = [True] * slots
+        max_workers = self.max_workers
+        if max_workers is None:
+            max_workers = max(1, slots // min(job.cores for job in self.jobs)) if self.jobs else 1
+        # ties keep the order the jobs were added in
+        order = itertools.count()
+        pending = [(-job.priority, next(order), job) for job in self.jobs]
+        heapq.heapify(pending)
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        campaign_start = time.time()
+        running = {}
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            while pending or running:
+                # start every job that fits, in priority order
+                skipped = []
+                while pending and len(running) < max_workers:
+                    entry = heapq.heappop(pending)
+                    job = entry[2]
+                    offset = self._allocate(free, job.cores)
+                    if offset is None:
+                        skipped.append(entry)
+                        continue
+                    job.attempts += 1
+                    mdrun_opts = mdrun_thread_options(job.cores, offset * self.pin_stride,
+                                                      "gmx_mpi" if self.settings.gmx_mpi_on else "gmx",
+                                                      self.pin_stride)
+                    log_path = None
+                    if self.log_dir is not None:
+                        log_path = os.path.join(self.log_dir, job.key.replace("/", "_") + ".out")
+                    future = executor.submit(run_campaign_job, self.settings, job,
+                                             mdrun_opts, self.env, log_path)
+                    running[future] = (job, offset)
+                for entry in skipped:
+                    heapq.heappush(pending, entry)
+
+                if not running:
+                    raise RuntimeError("No pending job fits in the free cores.")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    job, offset = running.pop(future)
+                    free[offset:offset + job.cores] = [True] * job.cores
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        if job.attempts < self.max_attempts:
+                            heapq.heappush(pending, (-job.priority, next(order), job))
+                            continue
+                        now = time.time()
+                        result = {"key": job.key, "pdbcode": job.pdbcode, "name": job.name,
+                                  "rep": job.rep, "cores": job.cores, "priority": job.priority,
+                                  "status": "failed", "error": "worker process died",
+                                  "start": now, "end": now, "run_time": 0.0, "cpu_time": 0.0}
+                    result["attempts"] = job.attempts
+                    result["queue_wait"] = result["start"] - campaign_start
+                    self._record(result)
+                if broken:
+                    # the other running jobs were lost with the pool
+                    for future, (job, offset) in running.items():
+                        free[offset:offset + job.cores] = [True] * job.cores
+                        heapq.heappush(pending, (-job.priority, next(order), job))
+                    running = {}
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = ProcessPoolExecutor(max_workers=max_workers)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        wall_time = time.time() - campaign_start
+        metrics = pd.DataFrame(self.results)
+        self.summary = self.summarise(metrics, wall_time)
+        print("Campaign summary: ", self.summary)
+        return metrics
+
+    def summarise(self, metrics, wall_time):
+        """Returns the throughput, queue wait and core utilisation of a finished campaign."""
+        complete = metrics[metrics["status"] == "complete"] if len(metrics) else metrics
+        busy_core_time = (metrics["run_time"] * metrics["cores"]).sum() if len(metrics) else 0.0
+        rates = complete["ns_per_day"].dropna() if "ns_per_day" in complete else []
+        return {"jobs": len(metrics),
+                "complete": len(complete),
+                "failed": len(metrics) - len(complete),
+                "wall_time": wall_time,
+                "jobs_per_hour": len(complete) / wall_time * 3600 if wall_time > 0 else None,
+                "mean_queue_wait": float(metrics["queue_wait"].mean()) if len(metrics) else None,
+                "max_queue_wait": float(metrics["queue_wait"].max()) if len(metrics) else None,
+                "core_utilisation": float(busy_core_time / (wall_time * self.total_cores)) if wall_time > 0 else None,
+                "mean_ns_per_day": float(sum(rates) / len(rates)) if len(rates) else None}
@@ -0,0 +1,286 @@
+# Online convergence detection for equilibration segments
+# Observables (energy terms from the live log reader, and the RMSD of the trajectory being written)
+# are reduced to block averages as they arrive. The last n_blocks block means give the mean, its
+# standard error and the drift (the least squares slope over the window), kept as running sums so
+# each sample costs O(1). Once every criterion of a segment holds, its mdrun is stopped at a
+# checkpoint through the supervisor and run_MD_step goes on to the next segment.
+import os
+import math
+import fnmatch
+import struct
+import numpy as np
+from collections import deque
+
+from .XTC import XTCReader
+
+
+class BlockStatistics():
+    """
+    Block averages of a stream of samples over a sliding window of the last n_blocks blocks.
+    Values are shifted by the first sample so the running sums keep their precision.
+    The drift test needs a window of at least 3 blocks.
+    """
+    def __init__(self, block_size=10, n_blocks=10):
+        if not isinstance(block_size, int) or block_size < 1:
+            raise ValueError(f"block_size must be a positive integer, not {block_size!r}")
+        if not isinstance(n_blocks, int) or n_blocks < 3:
+            raise ValueError(f"n_blocks must be an integer of at least 3, not {n_blocks!r}")
+        self.block_size = block_size
+        self.n_blocks = n_blocks
+        self.blocks = deque()
+        self.shift = None
+        self.block_sum = 0.0
+        self.block_count = 0
+        self.n_samples = 0
+        self.next_block = 0
+        # sums over the window of the block index k and block mean m
+        self.sum_k = self.sum_kk = self.sum_m = self.sum_mm = self.sum_km = 0.0
+
+    def add(self, value):
+        """Adds one sample. Returns True if it completed a block."""
+        if self.shift is None:
+            self.shift = value
+        self.n_samples += 1
+        self.block_sum += value - self.shift
+        self.block_count += 1
+        if self.block_count < self.block_size:
+            return False
+        self._add_block(self.next_block, self.block_sum / self.block_count)
+        self.next_block += 1
+        self.block_sum = 0.0
+        self.block_count = 0
+        if len(self.blocks) > self.n_blocks:
+            k, m = self.blocks.popleft()
+            self._update(k, m, -1)
+        return True
+
+    def _add_block(self, k, m):
+        self.blocks.append((k, m))
+        self._update(k, m, 1)
+
+    def _update(self, k, m, sign):
+        self.sum_k += sign * k
+        self.sum_kk += sign * k * k
+        self.sum_m += sign * m
+        self.sum_mm += sign * m * m
+        self.sum_km += sign * k * m
+
+    @property
+    def full(self):
+        return len(self.blocks) == self.n_blocks
+
+    @property
+    def mean(self):
+        if not self.blocks:
+            return None
+        return self.shift + self.sum_m / len(self.blocks)
+
+    def _moments(self):
+        n = len(self.blocks)
+        skk = self.sum_kk - self.sum_k ** 2 / n
+        smm = max(self.sum_mm - self.sum_m ** 2 / n, 0.0)
+        skm = self.sum_km - self.sum_k * self.sum_m / n
+        return n, skk, smm, skm
+
+    @property
+    def sem(self):
+        """Standard error of the window mean from the spread of the block means."""
+        if len(self.blocks) < 2:
+            return None
+        n, _, smm, _ = self._moments()
+        return math.sqrt(smm / (n - 1) / n)
+
+    @property
+    def slope(self):
+        """Change of the block means per block."""
+        if len(self.blocks) < 2:
+            return None
+        _, skk, _, skm = self._moments()
+        return skm / skk
+
+    @property
+    def drift(self):
+        """Change of the fitted line across the window."""
+        slope = self.slope
+        return None if slope is None else slope * (len(self.blocks) - 1)
+
+    @property
+    def drift_t(self):
+        """The slope over its standard error, large if the drift is significant."""
+        if len(self.blocks) < 3:
+            return None
+        n, skk, smm, skm = self._moments()
+        slope = skm / skk
+        residual = max(smm - slope * skm, 0.0) / (n - 2)
+        if residual == 0.0:
+            return 0.0 if slope == 0.0 else math.inf
+        return slope / math.sqrt(residual / skk)
+
+
+class Criterion():
+    """
+    The convergence test of one observable over a full window of block averages.
+    Every limit that is given must hold: max_drift (|drift| across the window), max_sem (standard error
+    of the mean) and max_drift_t (|slope| / standard error of the slope). Without limits the drift
+    must not be significant (max_drift_t=2).
+    """
+    def __init__(self, term, block_size=10, n_blocks=10, max_drift=None, max_sem=None, max_drift_t=None):
+        self.term = term
+        self.stats = BlockStatistics(block_size, n_blocks)
+        self.max_drift = max_drift
+        self.max_sem = max_sem
+        if max_drift is None and max_sem is None and max_drift_t is None:
+            max_drift_t = 2.0
+        self.max_drift_t = max_drift_t
+        self.converged = False
+
+    def add(self, value):
+        if self.stats.add(value):
+            self.converged = self.test()
+        return self.converged
+
+    def test(self):
+        stats = self.stats
+        if not stats.full:
+            return False
+        if self.max_drift is not None and abs(stats.drift) > self.max_drift:
+            return False
+        if self.max_sem is not None and stats.sem > self.max_sem:
+            return False
+        if self.max_drift_t is not None and abs(stats.drift_t) > self.max_drift_t:
+            return False
+        return True
+
+    def state(self):
+        stats = self.stats
+        return {"term": self.term,
+                "samples": stats.n_samples,
+                "mean": stats.mean,
+                "sem": stats.sem,
+                "drift": stats.drift,
+                "drift_t": stats.drift_t,
+                "converged": self.converged}
+
+
+def make_whole(coords, box):
+    """
+    Joins consecutive atoms (e.g. the CA atoms of a chain) by their minimum image
+    in a rectangular box, so a protein split across the periodic boundary is whole.
+    """
+    lengths = np.diag(box)
+    if not np.all(lengths > 0):
+        return coords
+    bonds = np.diff(coords, axis=0)
+    bonds -= np.round(bonds / lengths) * lengths
+    return np.concatenate([coords[:1], coords[0] + np.cumsum(bonds, axis=0)])
+
+
+class TrajectoryRMSD():
+    """
+    The CA RMSD to structure_path of the frames appended to the xtc mdrun is writing.
+    Each poll decodes only the complete frames written since the last one.
+    """
+    def __init__(self, xtc_path, structure_path, fit_name="CA"):
+        from .Analysis import StructuralSelection
+
+        self.path = xtc_path
+        self.selection = StructuralSelection.from_structure(structure_path, fit_name)
+        self.offset = 0
+        self.failed = False
+
+    def poll(self):
+        """Returns [(step, rmsd)] of the new frames."""
+        from .Analysis import kabsch_align
+
+        if self.failed or not os.path.exists(self.path):
+            return []
+        size = os.path.getsize(self.path)
+        steps, coords = [], []
+        with XTCReader(self.path) as reader:
+            reader.seek(self.offset)
+            while True:
+                start = self.offset
+                try:
+                    skipped = reader.skip_frame()
+                except (struct.error, ValueError):
+                    break
+                # the last frame may still be being written
+                if skipped is None or start + skipped[1] > size:
+                    break
+                reader.seek(start)
+                frame = reader.read_frame()
+                self.offset = start + skipped[1]
+                if frame.coords.shape[0] <= self.selection.fit_atoms.max():
+                    print(f"Not computing the RMSD of {self.path}: it has fewer atoms than the structure")
+                    self.failed = True
+                    return []
+                steps.append(frame.step)
+                coords.append(make_whole(frame.coords[self.selection.fit_atoms].astype(np.float64), frame.box))
+        if not coords:
+            return []
+        _, rmsd = kabsch_align(np.stack(coords), self.selection.reference)
+        return list(zip(steps, rmsd.tolist()))
+
+
+class ConvergenceMonitor():
+    """
+    Watches the observables of one segment and stops its mdrun once every criterion holds.
+    criteria maps energy terms of the log (e.g. "Temperature", "Pressure", "Density") or "rmsd"
+    to the keyword arguments of Criterion. The records of the live log reader are passed to feed;
+    the RMSD is read from trajectory (a TrajectoryRMSD) at the same time.
+    The process to stop is given with attach once mdrun has started.
+    Raises ValueError if a criterion is invalid, or is on the RMSD without a trajectory to read it from.
+    """
+    def __init__(self, criteria, name="", trajectory=None):
+        self.name = name
+        self.criteria = {term: Criterion(term, **options) for term, options in criteria.items()}
+        if "rmsd" in self.criteria and trajectory is None:
+            raise ValueError(f"{name}: the rmsd criterion needs the trajectory and the reference structure")
+        self.trajectory = trajectory if "rmsd" in self.criteria else None
+        self.process = None
+        self.converged_step = None
+
+    @classmethod
+    def for_segment(cls, convergence, mdp, name="", xtc_path=None, structure_path=None):
+        """
+        Returns the monitor of the segment run with mdp, from convergence: {mdp file pattern: criteria}.
+        Returns None if no pattern matches the mdp file name.
+        """
+        for pattern, criteria in (convergence or {}).items():
+            if fnmatch.fnmatch(os.path.basename(mdp), pattern):
+                trajectory = None
+                if "rmsd" in criteria and xtc_path is not None and structure_path is not None:
+                    trajectory = TrajectoryRMSD(xtc_path, structure_path)
+                return cls(criteria, name, trajectory)
+        return None
+
+    def attach(self, process):
+        self.process = process
+        if self.converged_step is not None:
+            self.stop()
+
+    def feed(self, records):
+        """Adds the (step, time, energies) records of the log reader. Returns True once converged."""
+        if self.converged_step is not None:
+            return True
+        step = None
+        for step, _, energies in records:
+            for term, criterion in self.criteria.items():
+                if term in energies:
+                    criterion.add(energies[term])
+        if self.trajectory is not None:
+            for step_rmsd, rmsd in self.trajectory.poll():
+                self.criteria["rmsd"].add(rmsd)
+                step = step_rmsd if step is None else max(step, step_rmsd)
+        if step is not None and all(criterion.converged for criterion in self.criteria.values()):
+            self.converged_step = step
+            print(f"{self.name} converged at step {step}: ", self.summary())
+            self.stop()
+        return self.converged_step is not None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.cancel("converged")
+
+    def summary(self):
+        return {term: criterion.state() for term, criterion in self.criteria.items()}
@@ -2,12 +2,15 @@
 import os
 from copy import deepcopy
 import glob
-import pandas as pd
 import time
 import shutil
 import pickle
 from abc import ABC, abstractmethod
 from .MD_Settings import Settings
+from .Artifact_Store import ArtifactStore, file_digest
+from . import Manifest
+from .Tracing import span
+from .Trajectory_Catalog import get_catalog
 ### Abstract method for the MD and Docking experiment classes
 
 class Experiment(ABC):
@@ -23,7 +26,12 @@ class Experiment(ABC):
             self.name = name
         else:
             self.name = self.settings.trial_name
-        self.dataframe  = pd.DataFrame()
+        # created on first use, so pandas is only imported once there are results
+        self._dataframe = None
+        self._dataframe_path = None
+        self.manifest_path = None
+        self.segments = []
+        self.artifacts = {}
         self.dirs = {dir : None for dir in self.settings.dirs_to_create}
         self.trajectories = {}
         self.rep_no : int = None
@@ -36,6 +44,34 @@ class Experiment(ABC):
             self.settings.pdbcode = pdbcode
         self.generate_path_structure(self.name)
 
+    @property
+    def dataframe(self):
+        """
+        The tabular results of the experiment.
+        After loading from a manifest it is read from its sidecar on first use.
+        """
+        if self._dataframe is None:
+            if self._dataframe_path is not None:
+                self._dataframe = Manifest.load_sidecar(self._dataframe_path)
+            else:
+                import pandas as pd
+                self._dataframe = pd.DataFrame()
+        return self._dataframe
+
+    @dataframe.setter
+    def dataframe(self, dataframe):
+        self._dataframe = dataframe
+
+    def __setstate__(self, state):
+        # experiments pickled before the dataframe was lazily loaded
+        if "dataframe" in state:
+            state["_dataframe"] = state.pop("dataframe")
+        state.setdefault("_dataframe_path", None)
+        state.setdefault("manifest_path", None)
+        state.setdefault("segments", [])
+        state.setdefault("artifacts", {})
+        self.__dict__.update(state)
+
 
     def generate_path_structure(self, trial_name=None):
         """
@@ -83,61 +119,124 @@ class Experiment(ABC):
     @abstractmethod
     def save_experiment(self, save_name=None):
         """
-        Writes the settings of the experiment (contents of class) to a pickle file. Logs???
+        Writes the settings of the experiment (contents of class) to a manifest in the logs directory.
+        The manifest holds the settings, directories, segments and input file hashes.
+        The dataframe is written to a columnar sidecar next to it, only if it was loaded or changed.
+        Saving again appends to the same manifest. Returns the manifest path.
         """
-        unix_time = int(time.time())
-        if save_name is not None:
-            save_name = save_name+"_"+str(unix_time)+".pkl"
-            save_path = os.path.join(self.settings.logs_directory, save_name)
+        if save_name is None:
+            save_name = self.name
+        log_dir = self.dirs[self.settings.logs_directory]
+        os.makedirs(log_dir, exist_ok=True)
+        save_path = os.path.join(log_dir, save_name + Manifest.MANIFEST_EXTENSION)
+
+        self.update_artifacts()
+        if self._dataframe is not None and len(self._dataframe):
+            self._dataframe_path = os.path.join(log_dir, save_name + ".dataframe" + Manifest.SIDECAR_EXTENSION)
+            Manifest.save_sidecar(self._dataframe_path, self._dataframe)
+
+        state = Manifest.experiment_state(self)
+        state["dataframe"] = self._dataframe_path
+        if os.path.exists(save_path):
+            Manifest.append_manifest(save_path, {"state": state})
+        else:
+            Manifest.write_manifest(save_path, state)
+        self.manifest_path = save_path
+        print("Saving experiment to: ", save_path)
+        return save_path
 
-            with open(save_path, 'wb') as f:
-                pickle.dump(self, f)
-                print("Saving experiment to: ", save_path)
-                return save_path
-            
+    def update_artifacts(self):
+        """
+        Records the sha256 of the config and topology files used by the experiment.
+        """
+        for file in self.config_files:
+            path = os.path.join(self.settings.config, file)
+            if os.path.exists(path):
+                self.artifacts[path] = file_digest(path)
+        for file in self.topology_files:
+            path = os.path.join(self.settings.topology, file)
+            if os.path.exists(path):
+                self.artifacts[path] = file_digest(path)
+        return self.artifacts
+
+    def record_segment(self, traj_no, mdp, tpr_path, status="complete"):
+        """
+        Records a finished segment, and appends it to the manifest if the experiment has been saved.
+        """
+        segment = {"traj_no": int(traj_no),
+                   "mdp": mdp,
+                   "tpr": tpr_path,
+                   "status": status,
+                   "time": time.time()}
+        self.segments = [s for s in self.segments if s["traj_no"] != segment["traj_no"]]
+        self.segments.append(segment)
+        if self.manifest_path is not None and os.path.exists(self.manifest_path):
+            Manifest.append_manifest(self.manifest_path, {"segment": segment})
+        return segment
+
+    def restore_experiment(self, state):
+        """
+        Builds an experiment from a manifest state without running __init__.
+        The dataframe sidecar is only read when the dataframe is first used.
+        """
+        from . import MD_Settings
+
+        settings = getattr(MD_Settings, state["settings_class"]).__new__(
+            getattr(MD_Settings, state["settings_class"]))
+        settings.__dict__.update(state["settings"])
+
+        experiment = type(self).__new__(type(self))
+        experiment.__dict__.update(state["attributes"])
+        experiment.settings = settings
+        experiment.writer = None
+        experiment._dataframe = None
+        experiment._dataframe_path = state.get("dataframe")
+        return experiment
 
     ### TODO changed to abstract method - will this save settings? need to also be able to save and load a human readable file
     # @abstractmethod
     def load_experiment(self, latest=False, idx=None, load_path=None):
         """
-        Loads the settings of the experiment from a pickle file.
+        Loads the experiment from a manifest (or a pickle from older versions).
         """
-        if load_path is not None:
-            print("Attempting to load experiment from: ", load_path)
+        if load_path is None:
+            # If no explicit path is provided
+            search_dir = self.dirs[self.settings.logs_directory]
+            print("Searching for experiment files in: ", search_dir)
+
+            files = (glob.glob(os.path.join(search_dir, "*" + Manifest.MANIFEST_EXTENSION))
+                     + glob.glob(os.path.join(search_dir, "*.pkl")))
+            print("Found files: ", files)
+
+            if not files:
+                print("No experiment files found.")
+                raise FileNotFoundError
+            files = sorted(files, key=os.path.getmtime)
+            if latest is True:
+                print("Loading latest experiment.")
+                load_path = files[-1]
+            elif idx is not None:
+                print(f"Loading {idx} experiment.")
+                load_path = files[idx]
+            else:
+                print("Loading first experiment.")
+                load_path = files[0]
+
+        print("Loading experiment from: ", load_path)
+        if load_path.endswith(".pkl"):
             with open(load_path, 'rb') as f:
-                print("Loading experiment from: ", load_path)
                 return pickle.load(f)
-            # print("Loaded object type:", type(loaded_obj))
-            # return deepcopy(loaded_obj)
-        # If no explicit path is provided
-        search_dir = self.dirs[self.settings.logs_directory]
-        print("Searching for experiment files in: ", search_dir)
-
-        pkl_files = glob.glob(os.path.join(search_dir, "*.pkl"))
-        print("Found files: ", pkl_files)
-
-        if not pkl_files:
-            print("No experiment files found.")
-            raise FileNotFoundError
-        pkl_files = sorted(pkl_files, key=os.path.getctime)
-        if latest is True:
-            print("Loading latest experiment.")
-            file = pkl_files[-1]
-        elif idx is not None:
-            print(f"Loading {idx} experiment.")
-            file = pkl_files[idx]
-        else:
-            print("Loading first experiment.")
-            file = pkl_files[0]
 
-        load_path = file    
-        print("Loading experiment from: ", load_path)
-        with open(load_path, 'rb') as f:
-            return pickle.load(f)
-        # return deepcopy(loaded_obj)
+        experiment = self.restore_experiment(Manifest.read_manifest(load_path))
+        experiment.manifest_path = load_path
+        return experiment
 
 
     def create_directories(self):
+        with span("create_directories", "io"):
+            self._create_directories()
+
+    def _create_directories(self):
         # we are using the ABC method here
         data_dir = self.generate_path_structure()
         for dir in self.settings.dirs_to_create:
@@ -198,11 +297,24 @@ class Experiment(ABC):
         print("Loading topology files: ", self.topology_files)
 
 ### This is mostly to check remote directories: return to this later.
+    def get_catalog(self, data_dir=None):
+        """
+        Returns the trajectory catalog covering data_dir (root/pdbcode/trial),
+        with the pdbcode and trial name to look up in it.
+        """
+        if data_dir is None:
+            data_dir = self.dirs[self.settings.data_directory]
+        data_dir = os.path.normpath(data_dir)
+        pdb_dir, trial = os.path.split(data_dir)
+        root, pdbcode = os.path.split(pdb_dir)
+        return get_catalog(root), pdbcode, trial
+
     def check_all_trajectory_files(self, data_dir=None, traj_extension=None):
         """
         Checks if the trajectory files exist. 
         For a given trial goes into each replicate and checks for file with the correct extension.
         Adds the name to the trajectories dictionary. If a data dir is given, it will check it.
+        Uses the trajectory catalog, so unchanged directories are not listed again.
         """
         if data_dir is None:
             data_dir = self.dirs[self.settings.data_directory]
@@ -211,36 +323,58 @@ class Experiment(ABC):
             traj_extension = self.settings.search_traj
         print("Checking trajectory files in: ", data_dir)
 
-        for _dir in os.listdir(data_dir):
-            if os.path.isdir(os.path.join(data_dir, _dir)):
-                rep = _dir
-                self.trajectories[rep] = []
-
-                for file in os.listdir(os.path.join(data_dir, rep)):
-                    if traj_extension in file and "#" not in file:
-                        self.trajectories[rep].append(file)
+        catalog, pdbcode, trial = self.get_catalog(data_dir)
+        for rep in catalog.replicates(pdbcode, trial):
+            files = catalog.replicate(pdbcode, trial, rep)
+            self.trajectories[rep] = sorted(file for file in files if traj_extension in file)
         print("Trajectory files: ", self.trajectories)
         return self.trajectories
     
 
-### TODO later: This is for loading remote trajectories into local folder
-    def load_trajectory_files(self, data_dir=None):
+    def load_trajectory_files(self, data_dir=None, destination=None, rep=None, background=False):
         """
-        This is for syncing the trajectory files to the current experiment.
-        This is meant to be for when files need to be transferred from the scratch disk to the home disk.
-        This will copy all files from the data_dir to the data dict.
+        Syncs the trajectory files of the experiment from the scratch disk to the home disk.
+        data_dir defaults to the data directory (only replicate rep if given), destination to its path
+        relative to settings.data_directory under settings.staging_directory. Unchanged files are skipped,
+        copies are verified by checksum and interrupted copies resume.
+        Returns the staging report, or with background a future of it while the copy runs in a thread.
+        Raises StagingError (from the future with background) if files could not be staged.
         """
+        from .Staging import get_stager
 
-
-        ### One function for local copy
-
-        ### One function for remote copy
-
+        if data_dir is None:
+            data_dir = self.dirs[self.settings.data_directory]
+            if rep is not None:
+                data_dir = os.path.join(data_dir, self.settings.rep_directory + str(rep))
+        if destination is None:
+            staging_directory = getattr(self.settings, "staging_directory", None)
+            if staging_directory is None:
+                raise ValueError("Set settings.staging_directory or give a destination to stage to.")
+            relpath = os.path.relpath(os.path.abspath(data_dir), os.path.abspath(self.settings.data_directory))
+            if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                raise ValueError(f"{data_dir} is not in the data directory {self.settings.data_directory}, "
+                                 "give a destination to stage it to.")
+            destination = os.path.join(staging_directory, relpath)
+
+        stager = get_stager(getattr(self.settings, "staging_workers", 4))
+        if background:
+            return stager.start(data_dir, destination)
+        with span("load_trajectory_files", "io", source=data_dir):
+            return stager.stage(data_dir, destination)
+
+    def get_artifact_store(self):
+        """
+        Returns the artifact store set in the settings, or None if it is not used.
+        """
+        if getattr(self.settings, "artifact_store", None) is None:
+            return None
+        return ArtifactStore(self.settings.artifact_store)
 
     def load_input_files(self, rep=None):
         """
         Copies the topology files for the trial.
         Files must be local.
+        With an artifact store the files are stored once and hardlinked into the replicate.
         """
         if rep is None:
             rep = self.rep_no
@@ -248,13 +382,18 @@ class Experiment(ABC):
         if rep is None:
             raise ValueError("Replicate number not set.")
 
+        store = self.get_artifact_store()
         for file in self.topology_files:
             file_path = os.path.join(self.settings.topology, file)
             ### TODO refactor this to use self.dirs
             destination = os.path.join(self.dirs[self.settings.data_directory],
                                        self.settings.rep_directory + str(rep),
                                        file)
-            shutil.copyfile(file_path, destination)
+            with span("load input file", "io", file=file):
+                if store is None:
+                    shutil.copyfile(file_path, destination)
+                else:
+                    store.materialise(store.put(file_path), destination)
   
     def set_replicate(self, rep=None):
         """
@@ -282,7 +421,7 @@ class Experiment(ABC):
     def find_latest_trajectory(self, suffix=None, rep=None):
         """
         Finds the latest trajectory for the current trial. Uses the trajectory settings.
-        Does not check converted trajectories.
+        Does not check converted trajectories. Looked up in the trajectory catalog.
         """
         if suffix is None:
             suffix = self.settings.suffix
@@ -293,15 +432,12 @@ class Experiment(ABC):
         if rep is None:
             raise ValueError("Replicate number not set.")
 
-        self.check_all_trajectory_files()
-
-        trajectory_files = self.trajectories[self.settings.rep_directory + str(rep)]
-        #remove entries which dont contain the suffix
-        trajectory_files = [file for file in trajectory_files if suffix in file]
-
-        #sort the files by the number at the end
-        trajectory_files = sorted(trajectory_files, 
-                                  key=lambda x: int(x.split("_")[-1].split(".")[0]))
-
-        # return traj_no
-        return int(trajectory_files[-1].split("_")[-1].split(".")[0])
+        catalog, pdbcode, trial = self.get_catalog()
+        prefix = "_".join([suffix, self.settings.pdbcode])
+        traj_no = catalog.latest_segment(pdbcode, trial,
+                                         self.settings.rep_directory + str(rep),
+                                         prefix,
+                                         kind=self.settings.search_traj.lstrip("."))
+        if traj_no is None:
+            raise FileNotFoundError(f"No {prefix} trajectories for replicate {rep}.")
+        return traj_no
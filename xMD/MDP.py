@@ -0,0 +1,99 @@
+# Reading and comparing GROMACS .mdp files
+# Used to decide whether a segment can continue the previous one by extending its tpr
+# (gmx convert-tpr -extend with mdrun -cpi) instead of running grompp again,
+# and whether a cached tpr can be shared between replicates.
+
+# parameters that do not change the simulated system
+# (define and include change the topology grompp reads, e.g. -DPOSRES restraints, so they count)
+IGNORED_PARAMETERS = {"title"}
+# parameters that can change between segments without a new grompp:
+# the run length is set with convert-tpr and nstlist with mdrun -nstlist
+EXTENDABLE_PARAMETERS = {"nsteps", "nstlist"}
+# coupling algorithms that draw random numbers from ld-seed
+STOCHASTIC_COUPLING = {"v-rescale", "andersen", "andersen-massive", "c-rescale"}
+
+
+def normalise_key(key):
+    """grompp accepts both - and _ in parameter names."""
+    return key.strip().lower().replace("_", "-")
+
+
+def read_mdp(path):
+    """
+    Reads an mdp file into a dict of normalised parameter names and values (as strings).
+    Comments and blank lines are ignored, whitespace within values is collapsed.
+    """
+    parameters = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split(";", 1)[0]
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            parameters[normalise_key(key)] = " ".join(value.split())
+    return parameters
+
+
+def random_seeds(parameters):
+    """
+    Returns True if grompp or mdrun pick a new random seed on every call for these parameters (a dict
+    from read_mdp): generated velocities with gen-seed -1, or a stochastic integrator, thermostat or
+    barostat with ld-seed -1. A tpr from such an mdp must not be reused for another replicate.
+    """
+    def value(key, default):
+        return parameters.get(key, default).lower()
+
+    if value("gen-vel", "no") == "yes" and int(float(value("gen-seed", "-1"))) == -1:
+        return True
+    stochastic = (value("integrator", "md") in ("sd", "bd")
+                  or any(coupling in STOCHASTIC_COUPLING for coupling in value("tcoupl", "no").split())
+                  or value("pcoupl", "no") in STOCHASTIC_COUPLING)
+    return stochastic and int(float(value("ld-seed", "-1"))) == -1
+
+
+def _same_value(a, b):
+    if a == b:
+        return True
+    # 1000 and 1000.0, yes and Yes
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return a is not None and b is not None and a.lower() == b.lower()
+
+
+def diff_mdp(a, b):
+    """
+    Returns {parameter: (value in a, value in b)} for the parameters that differ.
+    a and b are paths or dicts from read_mdp. A parameter missing from one file has the value None.
+    """
+    if isinstance(a, str):
+        a = read_mdp(a)
+    if isinstance(b, str):
+        b = read_mdp(b)
+    return {key: (a.get(key), b.get(key)) for key in sorted(set(a) | set(b))
+            if key not in IGNORED_PARAMETERS and not _same_value(a.get(key), b.get(key))}
+
+
+def extension(previous_mdp, mdp):
+    """
+    Returns how to continue the segment run with previous_mdp as a segment with mdp:
+    None if grompp is needed (any other parameter differs), otherwise a dict with
+    extend_ps, the time to add to the previous tpr, and mdrun_opts for the remaining differences.
+    """
+    previous = read_mdp(previous_mdp)
+    parameters = read_mdp(mdp)
+    differences = diff_mdp(previous, parameters)
+    if not set(differences) <= EXTENDABLE_PARAMETERS:
+        return None
+    try:
+        nsteps = int(parameters["nsteps"])
+        dt = float(parameters.get("dt", "0.001"))
+    except (KeyError, ValueError):
+        return None
+    if nsteps < 0:
+        # an infinite run cannot be extended
+        return None
+    mdrun_opts = []
+    if "nstlist" in differences and parameters.get("nstlist") is not None:
+        mdrun_opts += ["-nstlist", parameters["nstlist"]]
+    return {"extend_ps": nsteps * dt, "nsteps": nsteps, "mdrun_opts": mdrun_opts}
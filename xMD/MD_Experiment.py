@@ -4,19 +4,19 @@ import glob
 import shutil
 import subprocess
 from abc import ABC, abstractmethod
-import pandas as pd
-import argparse
 import time
 import pickle
+from contextlib import contextmanager
 from .Experiment_ABC import Experiment
 from .MD_Settings import GROMACS_Settings
+from .Tracing import Tracer, get_tracer, set_tracer, span, run_command
 
 class MD_Experiment(Experiment):
     def __init__(self,settings: GROMACS_Settings, name=None, pdbcode=None, rep=None):
         super().__init__(settings, name, pdbcode, rep)
+        self.writer = None
+        self.mdrun_opts = []
         self.set_mdrun_gmx()
-        if __name__ == "__main__":
-            self.args = self.check_args()
         self.set_environs()
 
     def set_mdrun_gmx(self, mpi_on: bool = None):
@@ -29,10 +29,13 @@ class MD_Experiment(Experiment):
             self.gmx = ("gmx","gmx_mpi")
 
 
-    def check_args(self):
+    def check_args(self, argv=None):
         """
-        Checks the arguments for the trial.
+        Checks the arguments for the trial, from argv or the command line.
+        The xmd command line (python -m xMD) has its own parser.
         """
+        import argparse
+
         parser = argparse.ArgumentParser()
 
         parser.add_argument("-R", "--replicate", 
@@ -40,10 +43,9 @@ class MD_Experiment(Experiment):
                             help="Replicate number", type=int,
                             default=0)
         
-        ### TODO setup traj continuation
-        # parser.add_argument("-T", "--trajectory", 
-        #                     dest="traj_no", 
-        #                     help="Trajectory number", type=int)
+        parser.add_argument("-T", "--trajectory", 
+                            dest="traj_no", 
+                            help="Trajectory number", type=int)
                             
         
         parser.add_argument("-P", "--pdbcode", 
@@ -63,15 +65,15 @@ class MD_Experiment(Experiment):
                             help="search string for the top files", type=str)
 
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
 
         print("Arguments: ", args)
 
         if args.replicate is not None:
             self.set_replicate(args.replicate)
 
-        # if args.traj_no is not None:
-        #     self.traj_no = args.traj_no
+        if args.traj_no is not None:
+            self.set_trajectory_number(args.traj_no)
 
         if args.pdbcode is not None:
             self.settings.pdbcode = args.pdbcode
@@ -90,11 +92,23 @@ class MD_Experiment(Experiment):
     def pbc_conversion(self, tpr_path):
         """
         Converts the trajectory file to correct for pbc.
+        Uses trjconv unless settings.trajectory_backend is "numpy", which converts in-process
+        and makes molecules whole along the bonds of the topology.
         Returns the corrected trajectory file name.
         """
         traj_file = tpr_path.replace(".tpr", ".xtc")
         traj_file1 = traj_file.split(".")[-2] + self.settings.pbc_extensions[0] + ".xtc"
         traj_file2 = traj_file.split(".")[-2] + self.settings.pbc_extensions[1] + ".xtc"
+
+        if getattr(self.settings, "trajectory_backend", "gmx") == "numpy":
+            from .PBC import pbc_convert
+            # both passes in one read of the trajectory, without the intermediate file
+            pdb_file = traj_file2.replace(".xtc", ".pdb")
+            print("Running in-process pbc conversion: ", traj_file, "->", traj_file2)
+            with span("pbc_convert", "analysis", traj_file=traj_file):
+                pbc_convert(traj_file, tpr_path.replace(".tpr", ".gro"), traj_file2, pdb_file,
+                            topology=self.get_topology())
+            return traj_file2, pdb_file
         
         trjconv_command1 = ["gmx", "trjconv",
                              "-f", traj_file, 
@@ -110,10 +124,10 @@ class MD_Experiment(Experiment):
                              "-dump", "0"]
         
         print("Running trjconv command 1: ", trjconv_command1)
-        subprocess.run(trjconv_command1, input=b"1\n0\n", check=True)
+        run_command(trjconv_command1, input=b"1\n0\n", name="gmx trjconv " + " ".join(self.settings.pbc_commands[0]))
 
         print("Running trjconv command 2: ", trjconv_command2)
-        subprocess.run(trjconv_command2, input=b"1\n0\n", check=True)
+        run_command(trjconv_command2, input=b"1\n0\n", name="gmx trjconv " + " ".join(self.settings.pbc_commands[1]))
 
         pdb_file = traj_file2.replace(".xtc", ".pdb")
         
@@ -128,16 +142,297 @@ class MD_Experiment(Experiment):
 
         return traj_file2, pdb_file
 
+    def segment_status(self, tpr_path):
+        """
+        Returns the state of the segment written to tpr_path:
+        "complete" if mdrun wrote the final structure,
+        "checkpoint" if it was interrupted after writing a checkpoint,
+        otherwise "new".
+        """
+        deffnm = tpr_path.replace(".tpr", "")
+        if os.path.exists(deffnm + ".gro"):
+            return "complete"
+        if os.path.exists(tpr_path) and os.path.exists(deffnm + ".cpt"):
+            return "checkpoint"
+        return "new"
+
+    def analysis_complete(self, tpr_path):
+        """
+        Checks whether the pbc converted files of the segment exist, or the segment was archived.
+        With the gmx backend these are the trajectories of both trjconv passes, with the numpy
+        backend the converted trajectory and its pdb.
+        """
+        if os.path.exists(tpr_path.replace(".tpr", "-archive.json")):
+            return True
+        traj_file = tpr_path.replace(".tpr", ".xtc")
+        traj_file1 = traj_file.split(".")[-2] + self.settings.pbc_extensions[0] + ".xtc"
+        traj_file2 = traj_file.split(".")[-2] + self.settings.pbc_extensions[1] + ".xtc"
+        if getattr(self.settings, "trajectory_backend", "gmx") == "numpy":
+            return os.path.exists(traj_file2) and os.path.exists(traj_file2.replace(".xtc", ".pdb"))
+        return os.path.exists(traj_file1) and os.path.exists(traj_file2)
+
 ### TODO sort out the trajfile naming
     def prepare_analysis(self, tpr_path):
         """
         This will prepare the analysis for the trial.
         """
         traj_file2, pdb_file = self.pbc_conversion(tpr_path)
-        # TODO: concatenate trajecotry files 
+        # segments are joined on request with concatenate_segments
 
         return traj_file2, pdb_file
 
+    def segment_trajectories(self, rep=None, variant=None):
+        """
+        Returns the segment trajectories of a replicate in segment order.
+        variant selects the converted files, e.g. "-nojump".
+        """
+        if rep is None:
+            rep = self.rep_no
+        catalog, pdbcode, trial = self.get_catalog()
+        rep_dir = self.settings.rep_directory + str(rep)
+        prefix = "_".join([self.settings.suffix, self.settings.pdbcode])
+        files = catalog.query(pdbcode, trial, rep_dir, kind="xtc", prefix=prefix)
+        files = sorted((file for file in files if file["variant"] == variant), key=lambda file: file["segment"])
+        return [os.path.join(self.dirs[self.settings.data_directory], rep_dir, file["name"]) for file in files]
+
+    def concatenate_segments(self, rep=None, variant=None, virtual=False):
+        """
+        Joins the segment trajectories of a replicate into <suffix>_<pdbcode>_all<variant>.xtc
+        by copying the compressed frames, dropping the frames repeated at segment boundaries and
+        renumbering restarted segments so time runs on. The -pbc nojump variant is unwrapped across
+        the joins too, which decodes its frames. With virtual=True nothing is written and
+        the joined view is returned for reading. Returns the output path and the view.
+        """
+        from .XTC import ConcatenatedXTC
+
+        if rep is None:
+            rep = self.rep_no
+        paths = self.segment_trajectories(rep, variant)
+        if not paths:
+            raise FileNotFoundError(f"No segment trajectories in replicate {rep}")
+        view = ConcatenatedXTC(paths, nojump="nojump" in (variant or ""))
+        if virtual:
+            return None, view
+        out_path = os.path.join(self.dirs[self.settings.data_directory],
+                                self.settings.rep_directory + str(rep),
+                                "_".join([self.settings.suffix, self.settings.pdbcode, "all"]) + (variant or "") + ".xtc")
+        with span("concatenate_segments", "io", segments=len(paths)):
+            view.write(out_path)
+        print(f"Joined {len(paths)} segments ({len(view)} frames) into: ", out_path)
+        return out_path, view
+
+    def load_energy_logs(self, rep=None):
+        """
+        Parses the mdrun log files of a replicate into self.dataframe.
+        Each row is one energy frame, labelled with the replicate and segment number.
+        Rows previously loaded for the replicate are replaced.
+        """
+        import pandas as pd
+        from .MD_Log import parse_gromacs_energy_logs
+
+        if rep is None:
+            rep = self.rep_no
+
+        rep_dir = os.path.join(self.dirs[self.settings.data_directory],
+                               self.settings.rep_directory + str(rep))
+        prefix = "_".join([self.settings.suffix, self.settings.pdbcode]) + "_"
+
+        segments = {}
+        for file in os.listdir(rep_dir):
+            segment = file[len(prefix):-len(".log")]
+            if file.startswith(prefix) and file.endswith(".log") and segment.isdigit():
+                segments[int(segment)] = os.path.join(rep_dir, file)
+        segment_numbers = sorted(segments)
+        print("Loading energy logs: ", [segments[i] for i in segment_numbers])
+
+        energies = parse_gromacs_energy_logs([segments[i] for i in segment_numbers],
+                                             keys=segment_numbers)
+        energies.insert(0, "replicate", int(rep))
+
+        if "replicate" in self.dataframe:
+            self.dataframe = self.dataframe[self.dataframe["replicate"] != int(rep)]
+        self.dataframe = pd.concat([self.dataframe, energies], ignore_index=True)
+        return self.dataframe
+
+    def analyse_structure(self, reps=None, variant=None, reference=None, max_workers=None, chunk_size=50):
+        """
+        Computes the RMSD (CA fit to reference), radius of gyration and residue contacts of every frame
+        of the converted segment trajectories of reps, and the RMSF and contact frequencies per replicate.
+        The frames are analysed in parallel processes and merged into self.dataframe by replicate, segment and step.
+        variant defaults to the last pbc step, or the first with the gmx backend, whose last trjconv pass
+        only dumps the first frame. reference defaults to the first frame pdb of the first segment
+        (written by the numpy backend), or else the structure mdrun wrote at the end of it.
+        Returns the per-frame DataFrame. The RMSF is kept in self.rmsf and the contact maps in self.contact_maps.
+        """
+        import pandas as pd
+        from .Analysis import StructuralSelection, analyse_trajectories
+
+        if reps is None:
+            reps = [self.rep_no]
+        if variant is None:
+            if getattr(self.settings, "trajectory_backend", "gmx") == "numpy":
+                variant = self.settings.pbc_extensions[-1]
+            else:
+                variant = self.settings.pbc_extensions[0]
+        paths, keys = [], []
+        for rep in reps:
+            for path in self.segment_trajectories(rep, variant):
+                paths.append(path)
+                keys.append((int(rep), int(path[:-len(variant + ".xtc")].rsplit("_", 1)[1])))
+        if not paths:
+            raise FileNotFoundError(f"No {variant} trajectories in replicates {reps}")
+        if reference is None:
+            reference = paths[0].replace(".xtc", ".pdb")
+            if not os.path.exists(reference):
+                reference = paths[0][:-len(variant + ".xtc")] + ".gro"
+
+        with span("analyse_structure", "analysis", segments=len(paths)):
+            selection = StructuralSelection.from_structure(reference)
+            frames, rmsf, contact_maps = analyse_trajectories(paths, keys, selection,
+                                                              max_workers=max_workers,
+                                                              chunk_size=chunk_size,
+                                                              cutoff=getattr(self.settings, "contact_cutoff", 0.8))
+        print(f"Analysed {len(frames)} frames of {len(paths)} segments")
+
+        # replace the results of an earlier analysis of these replicates
+        columns = ["RMSD", "Rg", "Contacts"]
+        dataframe = self.dataframe
+        if "replicate" in dataframe and len(dataframe):
+            analysed = dataframe["replicate"].isin([int(rep) for rep in reps])
+            others, dataframe = dataframe[~analysed], dataframe[analysed]
+            if set(columns) <= set(dataframe.columns):
+                structure_only = dataframe.drop(columns=["replicate", "segment", "Step", "Time"] + columns).isna().all(axis=1)
+                dataframe = dataframe[~structure_only].drop(columns=columns)
+            dataframe = dataframe.merge(frames, on=["replicate", "segment", "Step"], how="outer", suffixes=("", "_frame"))
+            dataframe["Time"] = dataframe["Time"].fillna(dataframe.pop("Time_frame"))
+            dataframe = dataframe.sort_values(["replicate", "segment", "Step"], ignore_index=True)
+            self.dataframe = pd.concat([others, dataframe], ignore_index=True)
+        else:
+            self.dataframe = pd.concat([dataframe, frames], ignore_index=True)
+
+        previous = getattr(self, "rmsf", None)
+        if previous is not None and "replicate" in previous:
+            rmsf = pd.concat([previous[~previous["replicate"].isin(rmsf["replicate"])], rmsf], ignore_index=True)
+        self.rmsf = rmsf
+        self.contact_maps = dict(getattr(self, "contact_maps", None) or {})
+        self.contact_maps.update({group[0]: frequency for group, frequency in contact_maps.items()})
+        return frames
+
+    def archive_replicate(self, rep=None, dry_run=False):
+        """
+        Archives the analysed segments of a replicate: a full rate protein trajectory (<segment>-protein.xtc)
+        and a strided full system trajectory (<segment>-system.xtc) replace the mdrun trajectory and the
+        pbc intermediates, and <segment>-archive.json records what was kept and removed.
+        The tiers are written from the last pbc variant, or from the first with the gmx backend, whose
+        last trjconv pass only dumps the first frame. Segments whose tiers do not hold every frame of the
+        trajectory are left as they are.
+        Returns one row per segment with the bytes kept and removed.
+        """
+        import pandas as pd
+        from .Archive import archive_segment
+
+        if rep is None:
+            rep = self.rep_no
+        if getattr(self.settings, "trajectory_backend", "gmx") == "numpy":
+            source_variant = self.settings.pbc_extensions[-1]
+        else:
+            source_variant = self.settings.pbc_extensions[0]
+        manifests = []
+        for traj_file in self.segment_trajectories(rep, source_variant):
+            base = traj_file[:-len(source_variant + ".xtc")]
+            structure_path = traj_file.replace(".xtc", ".pdb")
+            if not os.path.exists(structure_path):
+                structure_path = base + ".gro"
+            with span("archive_segment", "io", traj_file=traj_file):
+                try:
+                    manifest = archive_segment(base,
+                                               source_variant,
+                                               structure_path,
+                                               self.settings.pbc_extensions,
+                                               keep_raw=getattr(self.settings, "archive_keep_raw", True),
+                                               stride=getattr(self.settings, "archive_stride", 10),
+                                               protein_precision=getattr(self.settings, "archive_protein_precision", 1000.0),
+                                               system_precision=getattr(self.settings, "archive_system_precision", 100.0),
+                                               dry_run=dry_run)
+                except ValueError as error:
+                    print("WARNING: not archiving segment: ", error)
+                    continue
+            manifests.append(manifest)
+        summary = pd.DataFrame([{"segment": manifest["segment"],
+                                 "kept_bytes": manifest["kept_bytes"],
+                                 "removed_bytes": manifest["removed_bytes"],
+                                 "protein_frames": manifest["frames"]["protein"],
+                                 "system_frames": manifest["frames"]["system"]} for manifest in manifests])
+        if len(summary):
+            print(f"Archived {len(summary)} segments of replicate {rep}: kept {summary['kept_bytes'].sum() / 1e6:.1f} MB, "
+                  f"removed {summary['removed_bytes'].sum() / 1e6:.1f} MB")
+        return summary
+
+    def replicate_performance(self, rep=None):
+        """
+        Returns the mean ns/day of the finished segments of a replicate, or None.
+        """
+        from .MD_Log import parse_gromacs_performance
+
+        if rep is None:
+            rep = self.rep_no
+
+        rep_dir = os.path.join(self.dirs[self.settings.data_directory],
+                               self.settings.rep_directory + str(rep))
+        prefix = "_".join([self.settings.suffix, self.settings.pdbcode]) + "_"
+        performance = []
+        for file in os.listdir(rep_dir):
+            if file.startswith(prefix) and file.endswith(".log") and "#" not in file:
+                result = parse_gromacs_performance(os.path.join(rep_dir, file))
+                if result is not None:
+                    performance.append(result[0])
+        if not performance:
+            return None
+        return sum(performance) / len(performance)
+
+    def get_topology(self, topo_path=None):
+        """
+        Returns the parsed topology of the trial (molecule types, counts and charges),
+        read from its binary cache when the .top has been parsed before.
+        Includes are searched for in settings.environ_path (GMXLIB) as grompp does.
+        """
+        from .Topology import read_topology, default_include_dirs
+
+        if topo_path is None:
+            if not self.topology_files:
+                self.prepare_input_files(self.settings.search)
+            topo_files = [f for f in self.topology_files if f.endswith(".top")]
+            topo_path = os.path.join(self.settings.topology, topo_files[0])
+        include_dirs = [self.settings.environ_path] + default_include_dirs()
+        return read_topology(topo_path, include_dirs)
+
+    def get_mdrun_tuner(self):
+        """
+        Returns the mdrun layout tuner set in the settings, or None if it is not used.
+        """
+        from .Autotune import MDRunTuner
+
+        if getattr(self.settings, "mdrun_tuning", None) is None:
+            return None
+        return MDRunTuner(self.settings.mdrun_tuning)
+
+    def tuned_mdrun_opts(self, input_path):
+        """
+        Returns the mdrun options with the cached best layout for this system applied,
+        or the options unchanged if the system has not been tuned for these cores.
+        """
+        from .Autotune import count_atoms, option_cores, apply_layout
+        from .AuxMD import available_cores
+
+        tuner = self.get_mdrun_tuner()
+        if tuner is None or not input_path.endswith(".gro"):
+            return self.mdrun_opts
+        cores = option_cores(self.mdrun_opts) or available_cores()
+        layout = tuner.best(count_atoms(input_path), cores, self.settings.gpu, self.gmx[0])
+        if layout is None:
+            return self.mdrun_opts
+        return apply_layout(self.mdrun_opts, layout, self.gmx[0])
+
     def prepare_simulation(self, search=None, config_files: list = None, topology_files: list = None):
         """
         This will prepare the simulation for the trial.
@@ -147,23 +442,13 @@ class MD_Experiment(Experiment):
         self.load_input_files()
 
     def save_experiment(self, save_name=None):
-        super().save_experiment(save_name=save_name)
-
-        unix_time = int(time.time())
         if save_name is None:
             save_name = [self.settings.parent,
                         self.settings.pdbcode, 
                         self.name,
-                        str(self.rep_no),
-                        str(unix_time)]
-            save_name = "_".join(save_name)+".pkl"
-            
-            log_dir = self.dirs[self.settings.logs_directory]
-            
-            save_path = os.path.join(log_dir, save_name)
-
-            with open(save_path, 'wb') as f:
-                pickle.dump(self, f)
+                        str(self.rep_no)]
+            save_name = "_".join(save_name)
+        save_path = super().save_experiment(save_name=save_name)
         print("Saved experiment to: ", save_path)
         return save_path
 
@@ -176,11 +461,87 @@ class MD_Experiment(Experiment):
         print("Environment variables set: ", self.settings.environ, self.settings.environ_path)
 
         
-    def prepare_TB_writer(self):
+    def prepare_TB_writer(self, rep=None):
         """
         This will prepare the TB writer for the trial.
+        Each replicate logs to its own directory in the logs directory.
+        With settings.tb_buffered the replicates share one buffered writer, written by a background thread.
+        """
+        from .utility import SummaryWriter, get_summary_writer
+
+        if rep is None:
+            rep = self.rep_no
+
+        log_dir = os.path.join(self.dirs[self.settings.logs_directory],
+                               self.settings.rep_directory + str(rep))
+        if getattr(self.settings, "tb_buffered", False):
+            shared = get_summary_writer(flush_secs=getattr(self.settings, "tb_flush_secs", 10),
+                                        max_buffer=getattr(self.settings, "tb_max_buffer", 10000),
+                                        downsample=getattr(self.settings, "tb_downsample", None))
+            self.writer = shared.run(log_dir)
+        else:
+            self.writer = SummaryWriter(log_dir=log_dir)
+        print("Tensorboard logging to: ", log_dir)
+        return self.writer
+
+    @contextmanager
+    def trace_experiment(self):
+        """
+        Traces the stages run inside the with block if settings.trace is set.
+        The trace is written to the logs directory as Chrome trace JSON and to tensorboard.
+        If a tracer is already active (e.g. set by the caller) the stages are added to it instead.
+        """
+        if not getattr(self.settings, "trace", False) or get_tracer() is not None:
+            with span("run_experiment", rep=self.rep_no):
+                yield get_tracer()
+            return
+
+        from .utility import SummaryWriter
+
+        tracer = Tracer("_".join([self.settings.pdbcode, self.name, str(self.rep_no)]))
+        previous = set_tracer(tracer)
+        try:
+            with tracer.span("run_experiment", rep=self.rep_no):
+                yield tracer
+        finally:
+            set_tracer(previous)
+            log_dir = os.path.join(self.dirs[self.settings.logs_directory],
+                                   self.settings.rep_directory + str(self.rep_no))
+            os.makedirs(log_dir, exist_ok=True)
+            tracer.write_chrome_trace(os.path.join(log_dir, "trace_" + str(int(tracer.epoch)) + ".json"))
+            writer = SummaryWriter(log_dir=log_dir)
+            tracer.write_tensorboard(writer)
+            writer.close()
+            print(tracer.summary())
+
+    def close_TB_writer(self):
+        """
+        Closes the TB writer so that the experiment can be pickled.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def prepare_log_reader(self, tpr_path, step_offset=0, log_path=None, monitor=None):
+        """
+        Creates a live reader for the log file mdrun writes for this tpr (or for log_path).
+        The energies go to the TB writer and to monitor (a ConvergenceMonitor) if given.
+        Returns None if there is neither.
         """
-        pass
+        from .utility import live_GROMACS_log_reader
+
+        if self.writer is None and monitor is None:
+            return None
+
+        if log_path is None:
+            log_path = tpr_path.replace(".tpr", ".log")
+        return live_GROMACS_log_reader(name=self.settings.pdbcode,
+                                       log_file=log_path,
+                                       writer=self.writer,
+                                       live=True,
+                                       frequency=self.settings.monitor_frequency,
+                                       step_offset=step_offset,
+                                       monitor=monitor)
 
     @abstractmethod
     def run_MD_step(self):
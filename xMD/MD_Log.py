@@ -0,0 +1,215 @@
+# Parsers for the log files written by GROMACS mdrun
+import os
+import numpy as np
+import pandas as pd
+
+
+class GROMACS_energy_parser():
+    """
+    Incremental parser for the energy blocks written to a GROMACS .log file.
+    Lines are fed in as they become available and each completed block is returned
+    as a (step, time, {term: value}) tuple. Partially written blocks are held until
+    the rest of the block is fed in. The A V E R A G E S section is skipped; a log continued
+    with mdrun -cpi (appending) has more energy blocks after it, which start at the next Step Time header.
+    """
+    field_width = 15
+
+    def __init__(self):
+        self.state = "idle"
+        self.step = None
+        self.time = None
+        self.names = []
+        self.energies = {}
+
+    def split_fields(self, line):
+        """Splits a fixed width GROMACS energy line into its 15 character fields."""
+        line = line.rstrip("\r\n")
+        return [line[i:i + self.field_width].strip()
+                for i in range(0, len(line), self.field_width)]
+
+    def feed(self, lines):
+        """
+        Feeds complete lines to the parser.
+        Returns the list of energy blocks completed by these lines.
+        """
+        records = []
+        for line in lines:
+            record = self.feed_line(line)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def feed_line(self, line):
+        stripped = line.strip()
+        if "A V E R A G E S" in stripped:
+            # the averages are not a frame, ignore everything up to the next Step Time header
+            self.state = "idle"
+            return None
+
+        split = stripped.split()
+        if split == ["Step", "Time"]:
+            self.state = "step"
+            return None
+
+        if self.state == "step":
+            if stripped:
+                try:
+                    self.step = int(split[0])
+                    self.time = float(split[1])
+                    self.state = "wait"
+                except (ValueError, IndexError):
+                    self.state = "idle"
+        elif self.state == "wait":
+            if stripped.startswith("Energies"):
+                self.energies = {}
+                self.state = "names"
+        elif self.state == "names":
+            if stripped:
+                self.names = self.split_fields(line)
+                self.state = "values"
+            elif self.energies:
+                # a blank line closes the block
+                self.state = "idle"
+                return self.step, self.time, self.energies
+        elif self.state == "values":
+            for name, value in zip(self.names, self.split_fields(line)):
+                try:
+                    self.energies[name] = float(value)
+                except ValueError:
+                    pass
+            self.state = "names"
+        return None
+
+
+class GROMACS_energy_table():
+    """
+    Columnar store for the energies parsed from a GROMACS log.
+    Holds one float64 array per energy term, grown geometrically so that
+    appending a frame is amortised O(1). Terms missing from a frame are NaN.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.n_frames = 0
+        self.steps = np.empty(capacity, dtype=np.int64)
+        self.columns = {"Time": np.empty(capacity, dtype=np.float64)}
+
+    def __len__(self):
+        return self.n_frames
+
+    def _grow(self):
+        self.capacity *= 2
+        self.steps = np.resize(self.steps, self.capacity)
+        for term, column in self.columns.items():
+            self.columns[term] = np.resize(column, self.capacity)
+
+    def _add_column(self, term):
+        column = np.empty(self.capacity, dtype=np.float64)
+        column[:self.n_frames] = np.nan
+        self.columns[term] = column
+        return column
+
+    def append(self, step, time, energies):
+        """Appends one energy frame to the table."""
+        if self.n_frames == self.capacity:
+            self._grow()
+        i = self.n_frames
+        self.steps[i] = step
+        self.columns["Time"][i] = time
+        for term, value in energies.items():
+            column = self.columns.get(term)
+            if column is None:
+                column = self._add_column(term)
+            column[i] = value
+        self.n_frames += 1
+        # fill terms that were not in this frame
+        if len(energies) + 1 != len(self.columns):
+            for term, column in self.columns.items():
+                if term != "Time" and term not in energies:
+                    column[i] = np.nan
+
+    def extend(self, records):
+        """Appends (step, time, energies) records to the table."""
+        for step, time, energies in records:
+            self.append(step, time, energies)
+
+    def to_dataframe(self):
+        """Returns the table as a single dataframe with a Step column."""
+        n = self.n_frames
+        data = {"Step": self.steps[:n].copy()}
+        for term, column in self.columns.items():
+            data[term] = column[:n].copy()
+        return pd.DataFrame(data)
+
+
+def parse_gromacs_energy_log(filepath, chunk_size=1 << 20):
+    """
+    Parse a GROMACS log file to extract energy information at each step into a DataFrame.
+    The file is read in chunks of chunk_size bytes so the whole log is never held in memory.
+    Returns a dataframe with Step, Time and one float64 column per energy term.
+    """
+    parser = GROMACS_energy_parser()
+    table = GROMACS_energy_table()
+    remainder = b""
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            table.extend(parser.feed(line.decode(errors="replace") for line in lines))
+    if remainder:
+        table.extend(parser.feed([remainder.decode(errors="replace"), ""]))
+    return table.to_dataframe()
+
+
+def parse_gromacs_energy_logs(filepaths, keys=None, names=("segment",)):
+    """
+    Parses several GROMACS log files and concatenates them once at the end.
+    keys label the rows from each file, by default the file name.
+    """
+    if keys is None:
+        keys = [os.path.basename(path) for path in filepaths]
+    frames = [parse_gromacs_energy_log(path) for path in filepaths]
+    if not frames:
+        return pd.DataFrame()
+    dataframe = pd.concat(frames, keys=keys, names=list(names))
+    return dataframe.reset_index(level=list(names)).reset_index(drop=True)
+
+
+def last_energy_step(filepath, tail_bytes=1 << 16):
+    """
+    Returns the step of the last energy frame of a GROMACS log, or None if it has none.
+    Only the end of the file is read, unless it holds no complete frame.
+    """
+    parser = GROMACS_energy_parser()
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - tail_bytes))
+        # the first line may be cut, the parser waits for a Step Time header anyway
+        records = parser.feed(f.read().decode(errors="replace").splitlines() + [""])
+    if records:
+        return records[-1][0]
+    if size > tail_bytes:
+        dataframe = parse_gromacs_energy_log(filepath)
+        if len(dataframe):
+            return int(dataframe["Step"].iloc[-1])
+    return None
+
+
+def parse_gromacs_performance(filepath, tail_bytes=4096):
+    """
+    Reads the Performance line from the footer of a finished GROMACS log.
+    Only the end of the file is read. Returns (ns/day, hour/ns) or None if the run has not finished.
+    """
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - tail_bytes))
+        footer = f.read().decode(errors="replace")
+
+    for line in reversed(footer.splitlines()):
+        split = line.split()
+        if len(split) == 3 and split[0] == "Performance:":
+            return float(split[1]), float(split[2])
+    return None
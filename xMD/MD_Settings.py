@@ -5,7 +5,6 @@ Settings classes
 import platform
 import os
 from copy import deepcopy
-import pandas as pd
 
 
 class Settings:
@@ -35,6 +34,14 @@ class Settings:
         self.parent = None
         self.replicates = 5
         self.rep_directory = 'R_'
+        self.artifact_store = None # directory of the shared artifact store, None copies files
+        self.trace = False # write a trace of the time spent in each stage of run_experiment
+        self.staging_directory = None # home directory mirroring the data directory, None does not stage
+        self.staging_workers = 4 # parallel copies when staging
+        self.tb_buffered = True # replicates share one tensorboard writer that writes from a background thread
+        self.tb_flush_secs = 10 # seconds between writes of the buffered summaries
+        self.tb_max_buffer = 10000 # buffered scalars that trigger a write before tb_flush_secs
+        self.tb_downsample = None # tag pattern -> ("stride", n) or ("reservoir", k), e.g. {"*/Pres*": ("stride", 10)}
         self.dirs_to_create = [self.temporary_directory, 
                                self.logs_directory, 
                                self.data_directory,
@@ -57,9 +64,27 @@ class GROMACS_Settings(Settings):
         self.search_traj = ".gro"
         self.pbc_commands = [("-pbc", "mol", "-center"), ("-pbc", "nojump")]
         self.pbc_extensions = ["-"+ext[1] for ext in self.pbc_commands]
+        self.trajectory_backend = "gmx" # "numpy" processes trajectories in-process, "gmx" uses trjconv
         self.environ_path = os.getcwd()
         self.environ = "GMXLIB"
         self.gmx = ("gmx","gmx_mpi")
         self.gmx_mpi_on = True
         self.gpu = False
         self.mdrun_gpu_opt = ["-pin", "on", "-pme", "gpu", "-pmefft", "gpu"]
+        self.monitor_frequency = 5 # seconds between reads of the live log
+        self.mdrun_tuning = None # path of the mdrun layout cache, None uses the default layout
+        self.probe_mdp = "md_short.mdp" # config used for the autotuning probe runs
+        self.structure_analysis = False # compute RMSD, RMSF, Rg and contacts of the converted trajectories after each run
+        self.contact_cutoff = 0.8 # nm between CA atoms for a residue contact
+        self.archive = False # replace the trajectories of analysed segments with the archive tiers
+        self.archive_stride = 10 # frames between the frames of the full system tier
+        self.archive_protein_precision = 1000.0 # xtc precision (1/nm) of the protein tier
+        self.archive_system_precision = 100.0 # xtc precision (1/nm) of the full system tier
+        self.archive_keep_raw = True # keep the mdrun trajectory alongside the archive
+        self.extend_segments = True # continue segments whose mdp only changes nsteps/nstlist with convert-tpr instead of grompp
+        self.mdrun_supervised = True # run mdrun under the supervisor: progress, ETA and ns/day without blocking on its output
+        self.mdrun_timeout = None # seconds of wall time before a segment is stopped at a checkpoint, None for no limit
+        # stop segments early once their observables have converged: {mdp file pattern: {term: criterion}},
+        # terms are log energies or "rmsd", see Convergence.Criterion, e.g.
+        # {"nvt*.mdp": {"Temperature": {"max_drift": 2.0, "max_sem": 0.5}}, "npt*.mdp": {"Density": {"max_drift": 1.0}}}
+        self.convergence = None
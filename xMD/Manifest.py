@@ -0,0 +1,126 @@
+# Versioned experiment manifests with columnar sidecars for tabular state
+# A manifest is a JSON lines file: a header line, then state and segment records
+# that are appended as the experiment progresses. Reading folds the records in order.
+import os
+import json
+import time
+
+MANIFEST_VERSION = 1
+MANIFEST_EXTENSION = ".manifest.jsonl"
+SIDECAR_EXTENSION = ".npz"
+# state kept out of the manifest: bulky, unpicklable or recomputed on load
+EXCLUDED_ATTRIBUTES = {"_dataframe", "_dataframe_path", "writer", "args", "manifest_path"}
+
+
+def _jsonable(value):
+    try:
+        json.dumps(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def experiment_state(experiment):
+    """
+    Returns the JSON serialisable state of an experiment and its settings.
+    """
+    attributes = {key: value for key, value in vars(experiment).items()
+                  if key not in EXCLUDED_ATTRIBUTES and key != "settings" and _jsonable(value)}
+    settings = {key: value for key, value in vars(experiment.settings).items() if _jsonable(value)}
+    return {"class": type(experiment).__name__,
+            "settings_class": type(experiment.settings).__name__,
+            "settings": settings,
+            "attributes": attributes,
+            "saved": time.time()}
+
+
+def write_manifest(path, state):
+    """
+    Writes a new manifest holding one state record, atomically.
+    """
+    tmp_path = path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps({"version": MANIFEST_VERSION}) + "\n")
+        f.write(json.dumps({"state": state}) + "\n")
+    os.replace(tmp_path, path)
+
+
+def append_manifest(path, record):
+    """
+    Appends one record to a manifest as a single write, so readers never see half a record.
+    """
+    line = (json.dumps(record) + "\n").encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_manifest(path):
+    """
+    Reads a manifest and folds its records into one state dict.
+    Segment records are merged into state["segments"] by trajectory number.
+    Sidecars are not loaded.
+    """
+    state = {}
+    segments = {}
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get("version", 0) > MANIFEST_VERSION:
+            raise ValueError(f"{path} was written by a newer version of xMD.")
+        for line in f:
+            if not line.endswith("\n"):
+                # an append still in progress
+                break
+            record = json.loads(line)
+            if "state" in record:
+                state = record["state"]
+                for segment in state["attributes"].get("segments", []):
+                    segments[segment["traj_no"]] = segment
+            elif "segment" in record:
+                segments[record["segment"]["traj_no"]] = record["segment"]
+    if state:
+        state["attributes"]["segments"] = [segments[key] for key in sorted(segments)]
+    return state
+
+
+def compact_manifest(path):
+    """Rewrites a manifest as a single state record."""
+    state = read_manifest(path)
+    write_manifest(path, state)
+    return state
+
+
+def save_sidecar(path, dataframe):
+    """
+    Writes a dataframe column by column to an uncompressed .npz.
+    Object columns are stored as strings.
+    """
+    import numpy as np
+
+    columns = {}
+    for i, column in enumerate(dataframe.columns):
+        values = dataframe[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        columns[f"c{i}"] = values
+    columns["__columns__"] = np.array([str(column) for column in dataframe.columns])
+    tmp_path = path + ".tmp" + str(os.getpid()) + SIDECAR_EXTENSION
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+def load_sidecar(path, columns=None):
+    """
+    Loads a dataframe sidecar. With columns only those columns are read from disk.
+    """
+    import numpy as np
+    import pandas as pd
+
+    with np.load(path) as data:
+        names = data["__columns__"].tolist()
+        if columns is None:
+            columns = names
+        return pd.DataFrame({name: data[f"c{names.index(name)}"] for name in columns},
+                            columns=columns)
@@ -0,0 +1,161 @@
+# In-process periodic boundary corrections for trajectories
+# Reproduces the two trjconv passes in GROMACS_Settings.pbc_commands
+# (-pbc mol -center, then -pbc nojump) in one pass over the trajectory.
+import numpy as np
+from .XTC import XTCReader, XTCWriter
+from .Structure import read_structure, write_pdb
+
+def _minimum_image(vectors, box, inv_box):
+    """Applies the minimum image convention to (..., n, 3) vectors for (..., 3, 3) boxes."""
+    frac = vectors @ inv_box
+    return vectors - np.round(frac) @ box
+
+
+def bond_tree(n_atoms, bonds, molecule_starts):
+    """
+    A spanning tree of the bond graph for make_molecules_whole, grown breadth first from the
+    first atom of every molecule. Returns a list of (parents, children) index arrays, one per level.
+    Atoms that no bond reaches (ions, virtual sites) hang from the first atom of their molecule.
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    # both directions of every bond, sorted by the first atom
+    pairs = np.concatenate([bonds, bonds[:, ::-1]])
+    pairs = pairs[np.argsort(pairs[:, 0], kind="stable")]
+    neighbour_offsets = np.searchsorted(pairs[:, 0], np.arange(n_atoms + 1))
+    molecule_of = np.repeat(np.arange(len(molecule_starts)),
+                            np.diff(np.append(molecule_starts, n_atoms)))
+
+    levels = []
+    visited = np.zeros(n_atoms, dtype=bool)
+    frontier = np.asarray(molecule_starts, dtype=np.int64)
+    visited[frontier] = True
+    while True:
+        while len(frontier):
+            counts = neighbour_offsets[frontier + 1] - neighbour_offsets[frontier]
+            parents = np.repeat(frontier, counts)
+            positions = np.repeat(neighbour_offsets[frontier] - np.cumsum(counts) + counts, counts) \
+                + np.arange(counts.sum())
+            children = pairs[positions, 1]
+            new = ~visited[children]
+            children, first = np.unique(children[new], return_index=True)
+            parents = parents[new][first]
+            visited[children] = True
+            if len(children):
+                levels.append((parents, children))
+            frontier = children
+        remaining = np.flatnonzero(~visited)
+        if not len(remaining):
+            return levels
+        # the first unreached atom of each molecule starts a new part of the tree
+        _, first = np.unique(molecule_of[remaining], return_index=True)
+        frontier = remaining[first]
+        visited[frontier] = True
+        levels.append((np.asarray(molecule_starts)[molecule_of[frontier]], frontier))
+
+
+def make_molecules_whole(coords, box, molecule_starts, tree=None):
+    """
+    Makes the molecules whole. coords is (n_frames, n_atoms, 3), box is (n_frames, 3, 3).
+    With the tree of bond_tree every atom is unwrapped relative to the atom it is bonded to,
+    like trjconv -pbc mol does with the bonds of the tpr. Without it each atom is unwrapped
+    relative to the atom before it, which assumes consecutive atoms of a molecule are closer
+    than half a box length.
+    """
+    inv_box = np.linalg.inv(box)
+    if tree is not None:
+        coords = coords.astype(np.float64)
+        for parents, children in tree:
+            coords[:, children] = coords[:, parents] + _minimum_image(
+                coords[:, children] - coords[:, parents], box, inv_box)
+        return coords.astype(np.float32)
+
+    steps = np.zeros(coords.shape, dtype=np.float64)
+    steps[:, 1:] = _minimum_image(np.diff(coords, axis=1).astype(np.float64), box, inv_box)
+    steps[:, molecule_starts] = 0.0
+
+    # cumulative displacement since the first atom of each molecule
+    molecule_index = np.repeat(np.arange(len(molecule_starts)),
+                               np.diff(np.append(molecule_starts, coords.shape[1])))
+    first_atom = molecule_starts[molecule_index]
+    displacement = np.cumsum(steps, axis=1)
+    displacement -= displacement[:, first_atom]
+    return (coords[:, first_atom] + displacement).astype(np.float32)
+
+
+def center_group(coords, box, group):
+    """Translates the frames so the geometric centre of group is at the box centre."""
+    box_center = 0.5 * box.sum(axis=1)
+    shift = box_center - coords[:, group].mean(axis=1)
+    return coords + shift[:, None, :].astype(np.float32)
+
+
+def put_molecules_in_box(coords, box, molecule_starts):
+    """Shifts each molecule by box vectors so its geometric centre lies in the unit cell."""
+    n_atoms = coords.shape[1]
+    counts = np.diff(np.append(molecule_starts, n_atoms))
+    centers = np.add.reduceat(coords.astype(np.float64), molecule_starts, axis=1) / counts[None, :, None]
+    shifts = np.floor(centers @ np.linalg.inv(box)) @ box
+    return coords - np.repeat(shifts, counts, axis=1).astype(np.float32)
+
+
+class NoJump():
+    """
+    Removes jumps across the box boundary between consecutive frames,
+    like trjconv -pbc nojump. Keeps the previous unwrapped frame between chunks.
+    """
+    def __init__(self):
+        self.previous = None
+
+    def __call__(self, coords, box):
+        coords = coords.astype(np.float64)
+        inv_box = np.linalg.inv(box)
+        start = 0
+        if self.previous is None:
+            self.previous = coords[0]
+            start = 1
+        for i in range(start, len(coords)):
+            coords[i] = self.previous + _minimum_image(coords[i] - self.previous, box[i], inv_box[i])
+            self.previous = coords[i]
+        return coords.astype(np.float32)
+
+
+def pbc_convert(traj_file, structure, out_traj, out_pdb=None,
+                chunk_size=100, molecule_starts=None, group=None, topology=None):
+    """
+    Makes molecules whole, centres the solute and puts molecules in the box (-pbc mol -center),
+    then removes jumps (-pbc nojump), in a single pass over traj_file in chunks of frames.
+    structure is a .gro/.pdb with the same atoms as the trajectory and gives the centring group
+    (the non-solvent atoms) unless group is given.
+    topology (a Topology) gives the molecules and the bonds they are made whole along. Without it the
+    molecules are guessed from the residues of structure (or given as molecule_starts) and joined atom
+    by atom in file order.
+    Writes the corrected trajectory to out_traj and the first frame to out_pdb.
+    """
+    structure = read_structure(structure)
+    tree = None
+    if topology is not None:
+        if topology.n_atoms != structure.n_atoms:
+            raise ValueError(f"Topology has {topology.n_atoms} atoms, the structure has {structure.n_atoms}")
+        molecule_starts = topology.molecule_starts()
+        tree = bond_tree(structure.n_atoms, topology.system_bonds(), molecule_starts)
+    elif molecule_starts is None:
+        print("No topology given for the pbc conversion, joining molecules by consecutive atoms")
+        molecule_starts = structure.molecule_starts()
+    if group is None:
+        group = structure.protein_atoms()
+    nojump = NoJump()
+    first_chunk = True
+
+    with XTCReader(traj_file) as reader, XTCWriter(out_traj) as writer:
+        for steps, times, boxes, coords in reader.iter_chunks(chunk_size):
+            if coords.shape[1] != structure.n_atoms:
+                raise ValueError(f"Structure has {structure.n_atoms} atoms, {traj_file} has {coords.shape[1]}")
+            coords = make_molecules_whole(coords, boxes, molecule_starts, tree)
+            coords = center_group(coords, boxes, group)
+            coords = put_molecules_in_box(coords, boxes, molecule_starts)
+            coords = nojump(coords, boxes)
+            if out_pdb is not None and first_chunk:
+                write_pdb(out_pdb, structure, coords[0], boxes[0])
+            first_chunk = False
+            writer.write_chunk(steps, times, boxes, coords, reader.precision)
+    return out_traj, out_pdb
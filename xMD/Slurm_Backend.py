@@ -0,0 +1,372 @@
+# SLURM job-array backend for campaigns
+# A campaign is rendered into one sbatch script with one array task per allocation.
+# Short jobs are packed into the same array task and run one after another.
+# The scheduler is reached through an interface (sbatch/sacct/scancel) that LocalSlurm
+# replaces to run the array tasks on this machine.
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+import threading
+
+from . import MD_Settings
+from .Campaign import CampaignJob, run_campaign_job
+
+# the environment of config/SBATCH_md.sh
+DEFAULT_MODULES = ["GROMACS/2022.2-foss-2021a", "Anaconda3/2022.10"]
+DEFAULT_CONDA_ENV = "RIN_test"
+FINISHED_STATES = {"COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED"}
+
+
+def format_time(minutes):
+    """Returns minutes as a SLURM time limit, D-HH:MM:SS."""
+    seconds = int(round(minutes * 60))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    time_limit = "%02d:%02d:%02d" % (hours, minutes, seconds)
+    return f"{days}-{time_limit}" if days else time_limit
+
+
+def expand_array_ids(task_ids):
+    """Expands an array task id field such as "[0-3,7%2]" or "5" into a list of ints."""
+    task_ids = task_ids.strip("[]").split("%")[0]
+    ids = []
+    for part in task_ids.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            ids.append(int(part))
+    return ids
+
+
+def pack_jobs(jobs, max_minutes, short_minutes):
+    """
+    Groups the jobs into array tasks.
+    Jobs shorter than short_minutes are packed first fit decreasing into tasks of at most
+    max_minutes, every other job gets a task of its own. Jobs without a time estimate are not packed.
+    Returns a list of lists of jobs.
+    """
+    tasks = []
+    short = []
+    for job in jobs:
+        if job.minutes is not None and job.minutes <= short_minutes:
+            short.append(job)
+        else:
+            tasks.append([job])
+
+    packed = []
+    totals = []
+    for job in sorted(short, key=lambda job: job.minutes, reverse=True):
+        for i, total in enumerate(totals):
+            if total + job.minutes <= max_minutes and packed[i][0].cores == job.cores:
+                packed[i].append(job)
+                totals[i] += job.minutes
+                break
+        else:
+            packed.append([job])
+            totals.append(job.minutes)
+    # higher priority tasks get the lower array indices, which SLURM starts first
+    tasks = tasks + packed
+    tasks.sort(key=lambda task: -max(job.priority for job in task))
+    return tasks
+
+
+class SlurmInterface():
+    """
+    Talks to SLURM with sbatch, sacct and scancel.
+    """
+    def submit(self, script_path):
+        """Submits a batch script and returns the job id."""
+        output = subprocess.run(["sbatch", "--parsable", script_path],
+                                check=True, capture_output=True, text=True).stdout
+        return output.strip().split(";")[0]
+
+    def status(self, job_id):
+        """Returns {task_id: state} for the array tasks of a job."""
+        output = subprocess.run(["sacct", "-n", "-X", "-P", "-j", str(job_id), "-o", "JobID,State"],
+                                check=True, capture_output=True, text=True).stdout
+        states = {}
+        for line in output.splitlines():
+            if "|" not in line:
+                continue
+            job, state = line.split("|")[:2]
+            if "_" not in job:
+                continue
+            # "CANCELLED by 1234" -> "CANCELLED"
+            state = state.split()[0]
+            for task_id in expand_array_ids(job.split("_", 1)[1]):
+                states[task_id] = state
+        return states
+
+    def cancel(self, job_id):
+        subprocess.run(["scancel", str(job_id)], check=True)
+
+
+class LocalSlurm():
+    """
+    Stand-in for SlurmInterface that runs the array tasks of a script on this machine,
+    as many at a time as the script's array throttle (%n) allows.
+    Task output goes to the script's --output file.
+    The task environment has SLURM_ARRAY_JOB_ID, SLURM_ARRAY_TASK_ID and SLURM_CPUS_PER_TASK set.
+    """
+    def __init__(self, shell="bash"):
+        self.shell = shell
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def submit(self, script_path):
+        with open(script_path) as f:
+            script = f.read()
+        array = re.search(r"^#SBATCH --array=(\S+)", script, re.MULTILINE).group(1)
+        throttle = int(array.split("%")[1]) if "%" in array else None
+        cpus = re.search(r"^#SBATCH --cpus-per-task=(\d+)", script, re.MULTILINE)
+        output = re.search(r"^#SBATCH --output=(\S+)", script, re.MULTILINE)
+        with self.lock:
+            job_id = str(self.next_id)
+            self.next_id += 1
+            states = {task_id: "PENDING" for task_id in expand_array_ids(array)}
+            self.jobs[job_id] = {"states": states, "processes": {}, "cancelled": False}
+
+        def run_tasks():
+            slots = threading.Semaphore(throttle or len(states))
+            threads = []
+            for task_id in list(states):
+                slots.acquire()
+                if self.jobs[job_id]["cancelled"]:
+                    slots.release()
+                    break
+                env = dict(os.environ,
+                           SLURM_JOB_ID=job_id,
+                           SLURM_ARRAY_JOB_ID=job_id,
+                           SLURM_ARRAY_TASK_ID=str(task_id),
+                           SLURM_CPUS_PER_TASK=cpus.group(1) if cpus else "1")
+                thread = threading.Thread(target=run_task, args=(task_id, env, slots), daemon=True)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        def run_task(task_id, env, slots):
+            log = None
+            try:
+                if output is not None:
+                    log = open(output.group(1).replace("%A", job_id).replace("%a", str(task_id)), "w")
+                process = subprocess.Popen([self.shell, script_path], env=env,
+                                           stdout=log, stderr=subprocess.STDOUT if log else None)
+                with self.lock:
+                    states[task_id] = "RUNNING"
+                    self.jobs[job_id]["processes"][task_id] = process
+                returncode = process.wait()
+                with self.lock:
+                    if states[task_id] == "RUNNING":
+                        states[task_id] = "COMPLETED" if returncode == 0 else "FAILED"
+            finally:
+                if log is not None:
+                    log.close()
+                slots.release()
+
+        threading.Thread(target=run_tasks, daemon=True).start()
+        return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            return dict(self.jobs[job_id]["states"])
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            job["cancelled"] = True
+            for task_id, state in job["states"].items():
+                if state in ("PENDING", "RUNNING"):
+                    job["states"][task_id] = "CANCELLED"
+                if state == "RUNNING":
+                    job["processes"][task_id].terminate()
+
+
+class SlurmArrayBackend():
+    """
+    Submits the jobs of a Campaign to SLURM as one job array.
+    Every array task is one allocation of cores_per_task cores (one GPU with settings.gpu);
+    mdrun is run with -ntomp (gmx_mpi) or -nt on all of them.
+    Jobs with an estimate below short_minutes are packed into tasks of up to max_minutes.
+    The script, task spec, task output and job metrics are written to work_dir.
+    """
+    def __init__(self,
+                 settings,
+                 interface=None,
+                 work_dir=None,
+                 cores_per_task: int = 48,
+                 mem_per_cpu: str = "2G",
+                 partition: str = "short",
+                 max_minutes: float = 12 * 60,
+                 short_minutes: float = 60,
+                 default_minutes: float = 12 * 60,
+                 max_running: int = None,
+                 modules: list = DEFAULT_MODULES,
+                 conda_env: str = DEFAULT_CONDA_ENV,
+                 setup_commands: list = None):
+        self.settings = settings
+        self.interface = interface if interface is not None else SlurmInterface()
+        self.work_dir = work_dir if work_dir is not None else os.path.join(settings.logs_directory, "slurm")
+        self.cores_per_task = cores_per_task
+        self.mem_per_cpu = mem_per_cpu
+        self.partition = partition
+        self.max_minutes = max_minutes
+        self.short_minutes = short_minutes
+        self.default_minutes = default_minutes
+        self.max_running = max_running
+        self.modules = list(modules)
+        self.conda_env = conda_env
+        self.setup_commands = list(setup_commands or [])
+        self.job_id = None
+        self.tasks = []
+        self.spec_path = None
+        self.metrics_path = None
+
+    def task_minutes(self, task):
+        return sum(job.minutes if job.minutes is not None else self.default_minutes for job in task)
+
+    def render(self, name, tasks):
+        """Returns the sbatch script running the tasks as a job array."""
+        time_limit = min(self.max_minutes, max(self.task_minutes(task) for task in tasks))
+        array = f"0-{len(tasks) - 1}"
+        if self.max_running is not None:
+            array += f"%{self.max_running}"
+        lines = ["#!/bin/bash",
+                 "",
+                 "#SBATCH --nodes=1",
+                 "#SBATCH --ntasks=1",
+                 f"#SBATCH --cpus-per-task={self.cores_per_task}",
+                 f"#SBATCH --mem-per-cpu={self.mem_per_cpu}",
+                 f"#SBATCH --time={format_time(time_limit)}",
+                 f"#SBATCH --job-name={name}",
+                 f"#SBATCH --partition={self.partition}",
+                 f"#SBATCH --array={array}",
+                 f"#SBATCH --output={os.path.abspath(self.work_dir)}/{name}_%A_%a.out"]
+        if self.settings.gpu:
+            lines.append("#SBATCH --gres=gpu:1")
+        lines.append("")
+        lines += [f"module load {module}" for module in self.modules]
+        if self.conda_env is not None:
+            lines.append(f"conda activate {self.conda_env}")
+        lines += self.setup_commands
+        lines += ["",
+                  f"export {self.settings.environ}={self.settings.environ_path}",
+                  f"cd {os.getcwd()}",
+                  f"{sys.executable} -m xMD.Slurm_Backend run-task {os.path.abspath(self.spec_path)} $SLURM_ARRAY_TASK_ID",
+                  ""]
+        return "\n".join(lines)
+
+    def write_spec(self, name, tasks):
+        """Writes the settings and the jobs of every task to a JSON file read by the array tasks."""
+        spec = {"settings_class": type(self.settings).__name__,
+                "settings": vars(self.settings),
+                "cores": self.cores_per_task,
+                "metrics": os.path.abspath(self.metrics_path),
+                "tasks": [[vars(job) for job in task] for task in tasks]}
+        with open(self.spec_path, "w") as f:
+            json.dump(spec, f, indent=1)
+
+    def submit(self, campaign, name="xMD"):
+        """
+        Renders the campaign's jobs into one job array and submits it with a single call.
+        Returns the job id.
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.tasks = pack_jobs(campaign.jobs, self.max_minutes, self.short_minutes)
+        self.spec_path = os.path.join(self.work_dir, name + ".tasks.json")
+        self.metrics_path = os.path.join(self.work_dir, name + ".metrics.jsonl")
+        self.write_spec(name, self.tasks)
+        script_path = os.path.join(self.work_dir, name + ".sbatch")
+        with open(script_path, "w") as f:
+            f.write(self.render(name, self.tasks))
+        self.job_id = self.interface.submit(script_path)
+        print(f"Submitted {len(campaign.jobs)} jobs as {len(self.tasks)} array tasks: job {self.job_id}")
+        return self.job_id
+
+    def status(self):
+        """Returns {task_id: state} of the submitted array."""
+        return self.interface.status(self.job_id)
+
+    def jobs_status(self):
+        """Returns {job key: state}, taking the state of the array task the job is in."""
+        states = self.status()
+        return {job.key: states.get(task_id, "PENDING")
+                for task_id, task in enumerate(self.tasks) for job in task}
+
+    def wait(self, poll: float = 60, timeout: float = None):
+        """Waits until every array task has finished and returns their states."""
+        start = time.time()
+        while True:
+            states = self.status()
+            if len(states) >= len(self.tasks) and all(state in FINISHED_STATES for state in states.values()):
+                return states
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"Job {self.job_id} did not finish in {timeout} s")
+            time.sleep(poll)
+
+    def cancel(self):
+        self.interface.cancel(self.job_id)
+
+    def results(self):
+        """Returns the metrics written by the finished jobs as a DataFrame."""
+        import pandas as pd
+
+        if self.metrics_path is None or not os.path.exists(self.metrics_path):
+            return pd.DataFrame()
+        with open(self.metrics_path) as f:
+            return pd.DataFrame([json.loads(line) for line in f if line.endswith("\n")])
+
+
+def run_task(spec_path, task_id):
+    """
+    Runs the jobs of one array task one after another, inside its allocation.
+    A failing job does not stop the jobs packed after it.
+    Returns the number of failed jobs.
+    """
+    with open(spec_path) as f:
+        spec = json.load(f)
+    settings_class = getattr(MD_Settings, spec["settings_class"])
+    settings = settings_class.__new__(settings_class)
+    settings.__dict__.update(spec["settings"])
+    settings.gmx = tuple(settings.gmx)
+
+    cores = int(os.environ.get("SLURM_CPUS_PER_TASK", spec["cores"]))
+    mdrun_opts = ["-ntomp" if settings.gmx_mpi_on else "-nt", str(cores)]
+    failed = 0
+    for job_state in spec["tasks"][task_id]:
+        job = CampaignJob.__new__(CampaignJob)
+        job.__dict__.update(job_state)
+        result = run_campaign_job(settings, job, mdrun_opts)
+        result["array_task"] = task_id
+        result["slurm_job"] = os.environ.get("SLURM_ARRAY_JOB_ID")
+        result["queue_wait"] = None
+        # one write per record so concurrent tasks do not interleave
+        line = (json.dumps(result) + "\n").encode()
+        fd = os.open(spec["metrics"], os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        print(f"Job {result['key']} {result['status']} in {result['run_time']:.1f} s")
+        if result["status"] != "complete":
+            print(result.get("traceback", ""))
+            failed += 1
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an array task of an xMD SLURM campaign")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    task_parser = subparsers.add_parser("run-task", help="Run the jobs of one array task")
+    task_parser.add_argument("spec", help="Task spec written by SlurmArrayBackend")
+    task_parser.add_argument("task_id", type=int, help="SLURM_ARRAY_TASK_ID")
+    args = parser.parse_args()
+
+    sys.exit(1 if run_task(args.spec, args.task_id) else 0)
@@ -0,0 +1,245 @@
+# Staging of trajectories between scratch and home storage
+# A Stager mirrors a directory tree with a bounded pool of copy threads. Files are compared by size
+# and mtime, then by sha256, so unchanged files are skipped, and every copy is verified by checksum.
+# Copies go to a .xmd-partial file first, so an interrupted transfer resumes where it stopped.
+# Files that fail are reported and the transfer raises StagingError once the others are done.
+# The storage is reached through a transport: LocalTransport covers any mounted filesystem,
+# other transports (e.g. over ssh) implement the same methods.
+import os
+import json
+import time
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .Artifact_Store import file_digest
+
+STAGING_MANIFEST = ".xmd_staging.json"
+PARTIAL_SUFFIX = ".xmd-partial"
+# not staged: catalogs, manifests of staging, partial copies and GROMACS backups
+DEFAULT_EXCLUDE = (".xmd_catalog.json", STAGING_MANIFEST, "*" + PARTIAL_SUFFIX, "#*#")
+
+_stagers = {}
+_stagers_lock = threading.Lock()
+
+
+class StagingError(IOError):
+    """Raised when files could not be staged. report is the report of the transfer, with the errors."""
+    def __init__(self, report):
+        self.report = report
+        failed = ", ".join(error["path"] for error in report["errors"])
+        super().__init__(f"{len(report['errors'])} files were not staged from {report['source']} "
+                         f"to {report['destination']}: {failed}")
+
+
+def get_stager(max_workers=4):
+    """
+    Returns the local stager with max_workers copy threads, shared by every experiment in this process
+    so background transfers are queued one after another.
+    """
+    with _stagers_lock:
+        stager = _stagers.get(max_workers)
+        if stager is None:
+            stager = Stager(max_workers=max_workers)
+            _stagers[max_workers] = stager
+        return stager
+
+
+class LocalTransport():
+    """
+    Copies between paths on mounted filesystems. Copies are done in the kernel with
+    copy_file_range where possible, otherwise through a large buffer.
+    """
+    name = "local"
+
+    def __init__(self, buffer_size=1 << 24):
+        self.buffer_size = buffer_size
+
+    def walk(self, root):
+        """Yields (relative path, size, mtime_ns) of every file under root."""
+        for directory, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                yield os.path.relpath(path, root), stat.st_size, stat.st_mtime_ns
+
+    def stat(self, path):
+        """Returns (size, mtime_ns) of path, or None if it does not exist."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def digest(self, path):
+        return file_digest(path)
+
+    def copy(self, source, destination, offset=0):
+        """Copies source from offset to the same offset of destination. Returns the bytes copied."""
+        os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+        copied = 0
+        with open(source, "rb") as src, open(destination, "r+b" if offset else "wb") as dst:
+            dst.truncate(offset)
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            length = os.fstat(src_fd).st_size - offset
+            while length > 0:
+                try:
+                    n = os.copy_file_range(src_fd, dst_fd, min(length, 1 << 30), offset)
+                except (AttributeError, OSError):
+                    n = 0
+                if n == 0:
+                    data = os.pread(src_fd, min(length, self.buffer_size), offset)
+                    if not data:
+                        break
+                    n = os.write(dst_fd, data)
+                offset += n
+                copied += n
+                length -= n
+        return copied
+
+    def finish(self, partial, destination, mtime_ns):
+        """Gives the complete copy the mtime of the source and moves it into place."""
+        os.utime(partial, ns=(mtime_ns, mtime_ns))
+        os.replace(partial, destination)
+
+    def set_mtime(self, path, mtime_ns):
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def read_manifest(self, root):
+        try:
+            with open(os.path.join(root, STAGING_MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_manifest(self, root, manifest):
+        os.makedirs(root, exist_ok=True)
+        path = os.path.join(root, STAGING_MANIFEST)
+        tmp_path = path + ".tmp" + str(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, path)
+
+
+class Stager():
+    """
+    Mirrors source directories to destinations with max_workers copy threads.
+    stage runs a transfer and returns its report, start runs it in the background and
+    returns a future, so the next replicate can run while the last one is staged.
+    """
+    def __init__(self, transport=None, max_workers=4, exclude=DEFAULT_EXCLUDE, include=None, verbose=True):
+        self.transport = transport if transport is not None else LocalTransport()
+        self.max_workers = max_workers
+        self.exclude = exclude
+        self.include = include
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.background = ThreadPoolExecutor(max_workers=1)
+
+    def wanted(self, relpath):
+        name = os.path.basename(relpath)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.exclude):
+            return False
+        return self.include is None or any(fnmatch.fnmatch(name, pattern) for pattern in self.include)
+
+    def stage_file(self, source_root, destination_root, relpath, size, mtime_ns, manifest):
+        """
+        Brings one file up to date at the destination.
+        Returns a record with the action (copied, resumed, unchanged or same content), bytes and throughput.
+        """
+        transport = self.transport
+        source = os.path.join(source_root, relpath)
+        destination = os.path.join(destination_root, relpath)
+        start = time.perf_counter()
+        record = {"path": relpath, "size": size, "bytes": 0}
+
+        existing = transport.stat(destination)
+        known = manifest.get(relpath)
+        if existing == (size, mtime_ns) and known and known["size"] == size and known["mtime_ns"] == mtime_ns:
+            record.update(action="unchanged", sha256=known["sha256"], seconds=time.perf_counter() - start)
+            return record
+        digest = transport.digest(source)
+        if existing is not None and existing[0] == size and transport.digest(destination) == digest:
+            transport.set_mtime(destination, mtime_ns)
+            record.update(action="same content", sha256=digest, seconds=time.perf_counter() - start)
+            return record
+
+        partial = destination + PARTIAL_SUFFIX
+        partial_stat = transport.stat(partial)
+        offset = partial_stat[0] if partial_stat is not None and partial_stat[0] <= size else 0
+        copied = transport.copy(source, partial, offset)
+        if transport.digest(partial) != digest:
+            if offset == 0:
+                raise IOError(f"Checksum of the copy of {source} does not match")
+            # the partial copy was from an older version of the file
+            offset = 0
+            copied = transport.copy(source, partial, 0)
+            if transport.digest(partial) != digest:
+                raise IOError(f"Checksum of the copy of {source} does not match")
+        transport.finish(partial, destination, mtime_ns)
+        seconds = time.perf_counter() - start
+        record.update(action="resumed" if offset else "copied", sha256=digest, bytes=copied,
+                      seconds=seconds, mb_per_s=copied / 1e6 / seconds if seconds > 0 else None)
+        if self.verbose:
+            print(f"Staged {relpath}: {copied / 1e6:.1f} MB in {seconds:.2f} s "
+                  f"({record['mb_per_s'] or 0:.0f} MB/s){' resumed' if offset else ''}")
+        return record
+
+    def stage(self, source_root, destination_root):
+        """
+        Copies the files of source_root that are missing or changed in destination_root.
+        The sizes, mtimes and digests of the staged files are kept in .xmd_staging.json at the destination.
+        Returns a report with one record per file and the totals.
+        Raises StagingError with the report if any file failed, after the other files are staged.
+        """
+        transport = self.transport
+        start = time.perf_counter()
+        manifest = transport.read_manifest(destination_root)
+        files = [entry for entry in transport.walk(source_root) if self.wanted(entry[0])]
+        # largest first, so a big file does not start last and hold up the end of the transfer
+        files.sort(key=lambda entry: -entry[1])
+
+        records, errors = [], []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.stage_file, source_root, destination_root, relpath, size, mtime_ns, manifest):
+                       (relpath, size, mtime_ns) for relpath, size, mtime_ns in files}
+            for future, (relpath, size, mtime_ns) in futures.items():
+                try:
+                    record = future.result()
+                except OSError as error:
+                    errors.append({"path": relpath, "error": repr(error)})
+                    continue
+                records.append(record)
+                manifest[relpath] = {"size": size, "mtime_ns": mtime_ns, "sha256": record["sha256"]}
+        with self.lock:
+            transport.write_manifest(destination_root, manifest)
+
+        seconds = time.perf_counter() - start
+        copied = sum(record["bytes"] for record in records)
+        report = {"source": source_root,
+                  "destination": destination_root,
+                  "transport": transport.name,
+                  "files": records,
+                  "errors": errors,
+                  "copied_files": sum(record["action"] in ("copied", "resumed") for record in records),
+                  "skipped_files": sum(record["action"] in ("unchanged", "same content") for record in records),
+                  "copied_bytes": copied,
+                  "seconds": seconds,
+                  "mb_per_s": copied / 1e6 / seconds if seconds > 0 else None}
+        if self.verbose:
+            print(f"Staged {source_root} -> {destination_root}: {report['copied_files']} copied, "
+                  f"{report['skipped_files']} unchanged, {len(errors)} failed, "
+                  f"{copied / 1e6:.1f} MB in {seconds:.1f} s ({report['mb_per_s'] or 0:.0f} MB/s)")
+        for error in errors:
+            print(f"ERROR: {error['path']} was not staged: {error['error']}")
+        if errors:
+            raise StagingError(report)
+        return report
+
+    def start(self, source_root, destination_root):
+        """Stages in a background thread. Returns a future of the report."""
+        return self.background.submit(self.stage, source_root, destination_root)
+
+    def shutdown(self, wait=True):
+        self.background.shutdown(wait=wait)
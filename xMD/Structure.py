@@ -0,0 +1,222 @@
+# Reading and writing of .gro and .pdb structure files with NumPy
+# Fixed width fields are sliced column-wise from a byte array instead of parsed line by line.
+import os
+import numpy as np
+
+SOLVENT_RESIDUES = {"SOL", "WAT", "HOH", "TIP3", "TIP4", "TIP5", "SPC",
+                    "NA", "CL", "K", "MG", "ZN", "CA", "NA+", "CL-", "K+"}
+
+
+class Structure():
+    """
+    Atoms of a structure file as compact arrays.
+    coords are (n_atoms, 3) float32 in nm and box is a (3, 3) float32 array of box vectors in nm.
+    resids, resnames, names and chains are per-atom arrays.
+    """
+    def __init__(self, coords, resids, resnames, names, box=None, chains=None, title=""):
+        self.coords = coords
+        self.resids = resids
+        self.resnames = resnames
+        self.names = names
+        self.box = box if box is not None else np.zeros((3, 3), dtype=np.float32)
+        self.chains = chains if chains is not None else np.full(len(coords), " ", dtype="U1")
+        self.title = title
+
+    @property
+    def n_atoms(self):
+        return len(self.coords)
+
+    def solvent_atoms(self, solvent=SOLVENT_RESIDUES):
+        """Returns a boolean mask of the solvent and ion atoms."""
+        return np.isin(self.resnames, list(solvent))
+
+    def protein_atoms(self):
+        """Returns the indices of the non-solvent atoms (the Protein group for our systems)."""
+        return np.flatnonzero(~self.solvent_atoms())
+
+    def molecule_starts(self, solvent=SOLVENT_RESIDUES):
+        """
+        Splits the atoms into molecules without a topology.
+        Every solvent or ion residue is its own molecule, consecutive non-solvent residues form one molecule.
+        Returns the index of the first atom of each molecule.
+        """
+        is_solvent = self.solvent_atoms(solvent)
+        new_residue = np.ones(self.n_atoms, dtype=bool)
+        new_residue[1:] = self.resids[1:] != self.resids[:-1]
+        starts = new_residue & is_solvent
+        # a solute molecule starts after solvent or at the first atom
+        solute_start = ~is_solvent
+        solute_start[1:] &= is_solvent[:-1]
+        starts |= solute_start
+        starts[0] = True
+        return np.flatnonzero(starts)
+
+    def select(self, atoms):
+        """Returns a new structure with only the given atoms."""
+        return Structure(self.coords[atoms], self.resids[atoms], self.resnames[atoms],
+                         self.names[atoms], self.box, self.chains[atoms], self.title)
+
+
+def _fixed_width(lines, width):
+    """Returns the lines as an (n_lines, width) uint8 array, padded with spaces."""
+    joined = b"".join(line[:width].ljust(width) for line in lines)
+    return np.frombuffer(joined, dtype=np.uint8).reshape(len(lines), width)
+
+
+def _column(buffer, start, stop):
+    """Returns the bytes in columns start:stop of every line as an S array."""
+    return np.ascontiguousarray(buffer[:, start:stop]).view(f"S{stop - start}").ravel()
+
+
+def _strings(column):
+    return np.char.strip(column).astype("U")
+
+
+def read_gro(path):
+    """
+    Reads a .gro file into a Structure.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    lines = data.split(b"\n")
+    title = lines[0].decode(errors="replace").strip()
+    n_atoms = int(lines[1])
+    atom_lines = [line.rstrip(b"\r") for line in lines[2:2 + n_atoms]]
+    buffer = _fixed_width(atom_lines, 44)
+
+    coords = np.empty((n_atoms, 3), dtype=np.float32)
+    for i in range(3):
+        coords[:, i] = _column(buffer, 20 + 8 * i, 28 + 8 * i).astype(np.float64)
+
+    box_values = [float(v) for v in lines[2 + n_atoms].split()]
+    box = np.zeros((3, 3), dtype=np.float32)
+    box[0, 0], box[1, 1], box[2, 2] = box_values[:3]
+    if len(box_values) == 9:
+        box[0, 1], box[0, 2], box[1, 0], box[1, 2], box[2, 0], box[2, 1] = box_values[3:]
+
+    return Structure(coords,
+                     _column(buffer, 0, 5).astype(np.int32),
+                     _strings(_column(buffer, 5, 10)),
+                     _strings(_column(buffer, 10, 15)),
+                     box=box, title=title)
+
+
+def box_from_cryst1(a, b, c, alpha, beta, gamma):
+    """Returns the (3, 3) box vectors in nm from CRYST1 lengths in Angstrom and angles in degrees."""
+    alpha, beta, gamma = np.radians([alpha, beta, gamma])
+    box = np.zeros((3, 3), dtype=np.float64)
+    box[0, 0] = a
+    box[1, 0] = b * np.cos(gamma)
+    box[1, 1] = b * np.sin(gamma)
+    box[2, 0] = c * np.cos(beta)
+    box[2, 1] = c * (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+    box[2, 2] = np.sqrt(max(c * c - box[2, 0] ** 2 - box[2, 1] ** 2, 0.0))
+    # remove rounding noise on rectangular boxes
+    box[np.abs(box) < 1e-6 * max(a, b, c)] = 0.0
+    return (box / 10).astype(np.float32)
+
+
+def box_to_cryst1(box):
+    """Returns the CRYST1 record for a (3, 3) box in nm."""
+    lengths = np.linalg.norm(box, axis=1)
+    def angle(u, v):
+        if lengths[u] == 0 or lengths[v] == 0:
+            return 90.0
+        return np.degrees(np.arccos(np.dot(box[u], box[v]) / (lengths[u] * lengths[v])))
+    a, b, c = lengths * 10
+    return "CRYST1%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f P 1           1\n" % (
+        a, b, c, angle(1, 2), angle(0, 2), angle(0, 1))
+
+
+def read_pdb(path):
+    """
+    Reads the ATOM/HETATM records of the first model of a .pdb file into a Structure.
+    """
+    atom_lines = []
+    box = None
+    title = ""
+    with open(path, "rb") as f:
+        for line in f:
+            record = line[:6]
+            if record in (b"ATOM  ", b"HETATM"):
+                atom_lines.append(line.rstrip(b"\r\n"))
+            elif record == b"CRYST1" and box is None:
+                box = box_from_cryst1(*[float(line[i:j]) for i, j in
+                                        ((6, 15), (15, 24), (24, 33), (33, 40), (40, 47), (47, 54))])
+            elif record == b"TITLE ":
+                title = line[10:].decode(errors="replace").strip()
+            elif record == b"ENDMDL":
+                break
+    buffer = _fixed_width(atom_lines, 54)
+
+    coords = np.empty((len(atom_lines), 3), dtype=np.float32)
+    for i in range(3):
+        coords[:, i] = _column(buffer, 30 + 8 * i, 38 + 8 * i).astype(np.float64) / 10
+
+    return Structure(coords,
+                     _column(buffer, 22, 26).astype(np.int32),
+                     _strings(_column(buffer, 17, 21)),
+                     _strings(_column(buffer, 12, 16)),
+                     box=box, chains=_column(buffer, 21, 22).astype("U1"), title=title)
+
+
+def read_structure(path):
+    """Reads a .gro or .pdb file depending on the extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".gro":
+        return read_gro(path)
+    if extension in (".pdb", ".ent"):
+        return read_pdb(path)
+    raise ValueError(f"Unknown structure format: {path}")
+
+
+def _pdb_atom_lines(structure, coords):
+    names = [name if len(name) == 4 else " " + name for name in structure.names.tolist()]
+    serials = (np.arange(1, structure.n_atoms + 1) % 100000).tolist()
+    resids = (structure.resids % 10000).tolist()
+    lines = ["ATOM  %5d %-4s %-4s%1s%4d    %8.3f%8.3f%8.3f  1.00  0.00\n" % row
+             for row in zip(serials, names, structure.resnames.tolist(), structure.chains.tolist(),
+                            resids, *(coords * 10).T.tolist())]
+    return "".join(lines)
+
+
+def write_pdb(path, structure, coords=None, box=None):
+    """
+    Writes a single model pdb file of the structure.
+    coords and box replace the structure's own coordinates and box (in nm).
+    """
+    write_pdb_models(path, structure, [coords if coords is not None else structure.coords],
+                     [box if box is not None else structure.box])
+
+
+def write_pdb_models(path, structure, frames, boxes=None, mode="w"):
+    """
+    Writes one MODEL per frame of (n_atoms, 3) coordinates, like trjconv -o traj.pdb.
+    frames can be any iterable so trajectories can be streamed.
+    """
+    with open(path, mode) as f:
+        if structure.title:
+            f.write("TITLE     " + structure.title + "\n")
+        for i, coords in enumerate(frames):
+            box = boxes[i] if boxes is not None else structure.box
+            f.write(box_to_cryst1(box))
+            f.write("MODEL %8d\n" % (i + 1))
+            f.write(_pdb_atom_lines(structure, np.asarray(coords)))
+            f.write("TER\nENDMDL\n")
+
+
+def write_gro(path, structure, coords=None, box=None):
+    """Writes the structure to a .gro file."""
+    coords = structure.coords if coords is None else coords
+    box = structure.box if box is None else box
+    with open(path, "w") as f:
+        f.write((structure.title or "Generated by xMD") + "\n")
+        f.write("%5d\n" % structure.n_atoms)
+        rows = zip((structure.resids % 100000).tolist(), structure.resnames.tolist(),
+                   structure.names.tolist(), (np.arange(1, structure.n_atoms + 1) % 100000).tolist(),
+                   *np.asarray(coords).T.tolist())
+        f.write("".join("%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n" % row for row in rows))
+        box_values = [box[0, 0], box[1, 1], box[2, 2]]
+        if np.any(box[~np.eye(3, dtype=bool)]):
+            box_values += [box[0, 1], box[0, 2], box[1, 0], box[1, 2], box[2, 0], box[2, 1]]
+        f.write("".join("%10.5f" % v for v in box_values) + "\n")
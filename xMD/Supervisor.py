@@ -0,0 +1,381 @@
+# Supervision of running mdrun processes
+# A Supervisor starts commands with their stdout and stderr piped and watches every process it started
+# from one thread, with a selector over the pipes, so many concurrent mdruns cost one sleeping thread.
+# The last lines of each process are kept in a ring buffer and the mdrun -v progress lines are parsed
+# into the step, ETA and ns/day, available from status() and optionally written to tensorboard.
+# Processes are stopped with SIGINT, on which mdrun writes a checkpoint, and killed after a grace period.
+import os
+import re
+import time
+import signal
+import selectors
+import threading
+import subprocess
+from collections import deque
+
+from .Tracing import span, child_usage
+
+# "imb F  2% step 1200, will finish Sat Oct 17 14:03:12 2026" or "step 400, remaining wall clock time:    29 s"
+STEP_PATTERN = re.compile(r"step\s+(\d+),\s+(?:will finish\s+(.+?)\s*$|remaining wall clock time:\s*([\d.]+)\s*s)")
+# printed once mdrun has finished: ns/day, hour/ns
+PERFORMANCE_PATTERN = re.compile(r"^Performance:\s+([\d.]+)\s+([\d.]+)")
+SIGNAL_PATTERN = re.compile(r"Received the (\w+) signal")
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor(report_secs=60):
+    """Returns the supervisor shared by every experiment in this process, creating it on first use."""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor(report_secs=report_secs)
+        return _supervisor
+
+
+class MdrunProgress():
+    """
+    The progress of one mdrun, read from its -v output.
+    The rate is measured between progress lines; ns/day needs the time step dt_ps.
+    The fraction done needs nsteps, the last step of the run.
+    """
+    def __init__(self, dt_ps=None, nsteps=None, smoothing=0.3):
+        self.dt_ps = dt_ps
+        self.nsteps = nsteps
+        self.smoothing = smoothing
+        self.step = None
+        self.eta_s = None
+        self.finish = None
+        self.steps_per_s = None
+        self.final_ns_per_day = None
+        self.signal = None
+        self.updated = None
+
+    def feed(self, line, now):
+        """Reads one line of output. Returns True if it was a progress line."""
+        match = STEP_PATTERN.search(line)
+        if match is not None:
+            step = int(match.group(1))
+            if self.step is not None and step > self.step and now > self.updated:
+                rate = (step - self.step) / (now - self.updated)
+                # smoothed, the steps between progress lines vary with the load balancing
+                self.steps_per_s = rate if self.steps_per_s is None else \
+                    self.smoothing * rate + (1 - self.smoothing) * self.steps_per_s
+            if self.step is None or step != self.step:
+                self.step, self.updated = step, now
+            if match.group(3) is not None:
+                self.eta_s = float(match.group(3))
+                self.finish = time.time() + self.eta_s
+            else:
+                try:
+                    self.finish = time.mktime(time.strptime(match.group(2), "%a %b %d %H:%M:%S %Y"))
+                    self.eta_s = max(self.finish - time.time(), 0.0)
+                except ValueError:
+                    pass
+            return True
+        match = PERFORMANCE_PATTERN.match(line)
+        if match is not None:
+            self.final_ns_per_day = float(match.group(1))
+            return False
+        match = SIGNAL_PATTERN.search(line)
+        if match is not None:
+            self.signal = match.group(1)
+        return False
+
+    @property
+    def ns_per_day(self):
+        if self.final_ns_per_day is not None:
+            return self.final_ns_per_day
+        if self.steps_per_s is None or self.dt_ps is None:
+            return None
+        return self.steps_per_s * self.dt_ps * 86400 / 1000
+
+    @property
+    def fraction(self):
+        if self.step is None or not self.nsteps or self.step > self.nsteps:
+            return None
+        return self.step / self.nsteps
+
+
+class SupervisedProcess():
+    """
+    A process started by a Supervisor. The last buffer_lines lines of its stdout and stderr are kept in lines.
+    wait() blocks until it has exited, cancel() stops it. state is one of
+    running, stopping (signalled), finished, failed, cancelled or timed out.
+    """
+    def __init__(self, supervisor, command, name, nsteps=None, dt_ps=None, timeout=None,
+                 buffer_lines=200, writer=None, step_offset=0):
+        self.supervisor = supervisor
+        self.command = command
+        self.name = name
+        self.timeout = timeout
+        self.lines = deque(maxlen=buffer_lines)
+        self.progress = MdrunProgress(dt_ps, nsteps)
+        self.writer = writer
+        self.step_offset = step_offset
+        self.state = "starting"
+        self.cancel_reason = None
+        self.returncode = None
+        self.usage = None
+        self.popen = None
+        self.started = None
+        self.ended = None
+        self.signalled = None
+        self.written = None
+        self.printed = None
+        self.open_pipes = 0
+        self._partial = {}
+        self.done = threading.Event()
+
+    @property
+    def pid(self):
+        return self.popen.pid if self.popen is not None else None
+
+    def feed(self, fd, data, now):
+        """Splits the output into lines at newlines and the carriage returns of the progress lines."""
+        text = self._partial.pop(fd, "") + data.decode(errors="replace")
+        lines = re.split(r"[\r\n]", text)
+        if lines[-1]:
+            self._partial[fd] = lines[-1]
+        for line in lines[:-1]:
+            if line.strip():
+                self.lines.append(line)
+                self.progress.feed(line, now)
+
+    def tail(self, n=20):
+        return "\n".join(list(self.lines)[-n:])
+
+    def status(self):
+        progress = self.progress
+        now = time.monotonic()
+        return {"name": self.name,
+                "pid": self.pid,
+                "state": self.state,
+                "step": progress.step,
+                "nsteps": progress.nsteps,
+                "fraction": progress.fraction,
+                "eta_s": progress.eta_s,
+                "finish": progress.finish,
+                "ns_per_day": progress.ns_per_day,
+                "steps_per_s": progress.steps_per_s,
+                "elapsed_s": ((self.ended or now) - self.started) if self.started is not None else None,
+                "returncode": self.returncode,
+                "cancel_reason": self.cancel_reason}
+
+    def wait(self, timeout=None):
+        """Waits for the process to exit. Returns its return code, or None if timeout passed first."""
+        self.done.wait(timeout)
+        return self.returncode
+
+    def cancel(self, reason="cancelled"):
+        self.supervisor.cancel(self, reason)
+
+
+class Supervisor():
+    """
+    Starts processes and watches all of them from one thread.
+    Progress is printed every report_secs (if verbose) and written to each process's tensorboard writer.
+    A cancelled process gets SIGINT and is killed if it has not exited grace_secs later.
+    """
+    def __init__(self, report_secs=60, writer_secs=10, grace_secs=120, poll_secs=1.0, verbose=True):
+        self.report_secs = report_secs
+        self.writer_secs = writer_secs
+        self.grace_secs = grace_secs
+        self.poll_secs = poll_secs
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.processes = []
+        self.finished = deque(maxlen=100)
+        self._new = []
+        self._exiting = []
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        self.selector.register(self._wake_read, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run, name="mdrun_supervisor", daemon=True)
+        self._thread.start()
+
+    def start(self, command, name=None, nsteps=None, dt_ps=None, timeout=None, writer=None, step_offset=0,
+              buffer_lines=200, cwd=None, env=None):
+        """Starts command and returns its SupervisedProcess. timeout is in seconds of wall time."""
+        if name is None:
+            name = " ".join([os.path.basename(command[0])] + command[1:2])
+        process = SupervisedProcess(self, command, name, nsteps, dt_ps, timeout, buffer_lines, writer, step_offset)
+        process.popen = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, cwd=cwd, env=env)
+        process.started = process.written = process.printed = time.monotonic()
+        process.state = "running"
+        for pipe in (process.popen.stdout, process.popen.stderr):
+            os.set_blocking(pipe.fileno(), False)
+        with self.lock:
+            self._new.append(process)
+        self._wake()
+        return process
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b"x")
+        except BlockingIOError:
+            pass
+
+    def cancel(self, process, reason="cancelled", sig=signal.SIGINT):
+        """Asks the process to stop. mdrun stops at the next neighbour search step and writes a checkpoint."""
+        with self.lock:
+            if process.done.is_set() or process.signalled is not None:
+                return
+            process.cancel_reason = reason
+            process.signalled = time.monotonic()
+            process.state = "stopping"
+        print(f"Stopping {process.name} ({reason})")
+        try:
+            process.popen.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    def status(self):
+        """Returns the status of the running processes and the last finished ones."""
+        with self.lock:
+            processes = list(self.processes) + list(self.finished)
+        return [process.status() for process in processes]
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select(self.poll_secs):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._read(key.data, key.fileobj)
+            with self.lock:
+                new, self._new = self._new, []
+                self.processes.extend(new)
+            for process in new:
+                for pipe in (process.popen.stdout, process.popen.stderr):
+                    self.selector.register(pipe, selectors.EVENT_READ, process)
+                    process.open_pipes += 1
+            now = time.monotonic()
+            for process in list(self._exiting):
+                self._reap(process)
+            for process in list(self.processes):
+                try:
+                    self._check(process, now)
+                except Exception as error:
+                    # reporting must not stop the supervision of the other processes
+                    print(f"Could not report progress of {process.name}: ", error)
+
+    def _read(self, process, pipe):
+        try:
+            data = os.read(pipe.fileno(), 1 << 16)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if data:
+            process.feed(pipe.fileno(), data, time.monotonic())
+            return
+        self.selector.unregister(pipe)
+        pipe.close()
+        process.open_pipes -= 1
+        if process.open_pipes == 0:
+            self._exiting.append(process)
+            self._reap(process)
+
+    def _reap(self, process):
+        """Collects the exit status and resources of a process whose pipes have closed, once it has exited."""
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid == 0:
+            return
+        self._exiting.remove(process)
+        process.returncode = process.popen.returncode = os.waitstatus_to_exitcode(status)
+        process.usage = usage
+        process.ended = time.monotonic()
+        if process.cancel_reason == "timeout":
+            process.state = "timed out"
+        elif process.cancel_reason is not None:
+            process.state = "cancelled"
+        else:
+            process.state = "finished" if process.returncode == 0 else "failed"
+        with self.lock:
+            self.processes.remove(process)
+            self.finished.append(process)
+        self._write(process, process.ended)
+        if self.verbose:
+            self._print(process, process.ended)
+        process.done.set()
+
+    def _check(self, process, now):
+        if process.signalled is not None:
+            if now - process.signalled > self.grace_secs and process.popen.returncode is None:
+                print(f"Killing {process.name}, it did not stop within {self.grace_secs} s")
+                try:
+                    process.popen.kill()
+                except ProcessLookupError:
+                    pass
+                process.signalled = now
+        elif process.timeout is not None and now - process.started > process.timeout:
+            self.cancel(process, "timeout")
+        if now - process.written >= self.writer_secs:
+            self._write(process, now)
+        if self.verbose and now - process.printed >= self.report_secs:
+            self._print(process, now)
+
+    def _write(self, process, now):
+        progress = process.progress
+        if process.writer is not None and progress.step is not None:
+            step = progress.step + process.step_offset
+            for key in ("ns_per_day", "eta_s", "fraction"):
+                value = getattr(progress, key)
+                if value is not None:
+                    process.writer.add_scalar("mdrun/" + key, value, global_step=step)
+        process.written = now
+
+    def _print(self, process, now):
+        status = process.status()
+        parts = [f"{process.name}: {status['state']}"]
+        if status["step"] is not None:
+            fraction = status["fraction"]
+            parts.append(f"step {status['step']}" + (f" ({100 * fraction:.0f}%)" if fraction is not None else ""))
+        if status["ns_per_day"] is not None:
+            parts.append(f"{status['ns_per_day']:.1f} ns/day")
+        if status["eta_s"] is not None and process.returncode is None:
+            parts.append(f"ETA {status['eta_s'] / 60:.1f} min")
+        print(", ".join(parts))
+        process.printed = now
+
+
+def run_mdrun(command, name=None, nsteps=None, dt_ps=None, timeout=None, writer=None, step_offset=0,
+              supervisor=None, check=True, on_start=None):
+    """
+    Runs mdrun under the shared supervisor inside a span, like run_command, and waits for it.
+    on_start is called with the SupervisedProcess once it has started (e.g. to stop it early).
+    If the wait is interrupted the run is stopped (with a checkpoint) before the exception is raised.
+    Raises subprocess.TimeoutExpired if it ran out of time and CalledProcessError if it failed,
+    with the last lines of its output. Returns a CompletedProcess.
+    """
+    if supervisor is None:
+        supervisor = get_supervisor()
+    if name is None:
+        name = " ".join([os.path.basename(command[0])] + command[1:2])
+    with span(name, "gmx", command=" ".join(command)) as record:
+        process = supervisor.start(command, name, nsteps, dt_ps, timeout, writer, step_offset)
+        try:
+            if on_start is not None:
+                on_start(process)
+            process.wait()
+        except BaseException:
+            process.cancel("interrupted")
+            process.wait()
+            raise
+        if record is not None:
+            record.update(child_usage(process.usage))
+            record.update(returncode=process.returncode, state=process.state, ns_per_day=process.progress.ns_per_day)
+    if process.state == "timed out":
+        raise subprocess.TimeoutExpired(command, timeout, output=process.tail())
+    if check and process.returncode != 0:
+        print(process.tail())
+        raise subprocess.CalledProcessError(process.returncode, command, output=process.tail())
+    return subprocess.CompletedProcess(command, process.returncode, stdout=process.tail())
@@ -0,0 +1,321 @@
+# Reader for GROMACS .top/.itp topologies with a binary cache
+# Only what describes the system is kept: the molecule types with their atoms and the
+# bond graph (bonds, constraints and settles), and the [ molecules ] table.
+# The other bonded sections are skipped without being split.
+# The result is cached as an .npz keyed by the sha256 of the topology file.
+import os
+import json
+import numpy as np
+
+from .Artifact_Store import file_digest
+from .Structure import SOLVENT_RESIDUES
+
+TOPOLOGY_CACHE_VERSION = 2
+CACHE_DIRECTORY = ".xmd_topology"
+
+
+class Topology():
+    """
+    The molecule types and molecules of a topology as compact arrays.
+    The atoms of every molecule type are stored back to back: the atoms of type i are
+    atom_*[type_offsets[i]:type_offsets[i + 1]]. molecules and counts are the [ molecules ] table.
+    The bonds of type i are bonds[bond_offsets[i]:bond_offsets[i + 1]], as pairs of atom indices
+    within the molecule type.
+    """
+    def __init__(self, type_names, type_offsets, atom_names, atom_types, resids, resnames,
+                 charges, masses, molecules, counts, system="", includes=None, bonds=None, bond_offsets=None):
+        self.type_names = type_names
+        self.type_offsets = type_offsets
+        self.atom_names = atom_names
+        self.atom_types = atom_types
+        self.resids = resids
+        self.resnames = resnames
+        self.charges = charges
+        self.masses = masses
+        self.molecules = molecules
+        self.counts = counts
+        self.system = system
+        self.includes = includes or {}
+        self.bonds = np.zeros((0, 2), dtype=np.int64) if bonds is None else bonds
+        self.bond_offsets = np.zeros(len(type_names) + 1, dtype=np.int64) if bond_offsets is None else bond_offsets
+
+    def type_index(self, name):
+        matches = np.flatnonzero(self.type_names == name)
+        if not len(matches):
+            raise KeyError(f"Molecule type {name} is not defined in the topology")
+        # a later definition overrides an earlier one
+        return int(matches[-1])
+
+    def _molecule_types(self):
+        return np.array([self.type_index(name) for name in self.molecules], dtype=np.int64)
+
+    def type_atom_counts(self):
+        """Returns the number of atoms of each molecule type."""
+        return np.diff(self.type_offsets)
+
+    def type_charges(self):
+        """Returns the net charge of each molecule type."""
+        return np.add.reduceat(self.charges, self.type_offsets[:-1]) if len(self.charges) else np.zeros(0)
+
+    def type_masses(self):
+        return np.add.reduceat(self.masses, self.type_offsets[:-1]) if len(self.masses) else np.zeros(0)
+
+    @property
+    def n_atoms(self):
+        """Number of atoms in the system."""
+        return int((self.type_atom_counts()[self._molecule_types()] * self.counts).sum())
+
+    @property
+    def charge(self):
+        """Net charge of the system."""
+        return float((self.type_charges()[self._molecule_types()] * self.counts).sum())
+
+    @property
+    def mass(self):
+        """Total mass of the system in amu."""
+        return float((self.type_masses()[self._molecule_types()] * self.counts).sum())
+
+    def molecule_table(self):
+        """Returns the [ molecules ] table as a DataFrame with the atoms and charge of each entry."""
+        import pandas as pd
+
+        types = self._molecule_types()
+        return pd.DataFrame({"molecule": self.molecules,
+                             "count": self.counts,
+                             "atoms_per_molecule": self.type_atom_counts()[types],
+                             "charge_per_molecule": self.type_charges()[types],
+                             "atoms": self.type_atom_counts()[types] * self.counts})
+
+    def group_sizes(self, solvent=SOLVENT_RESIDUES):
+        """
+        Returns the number of atoms in the System group, the non-solvent (Protein) atoms,
+        the solvent and ions (Non-Protein) and in each molecule type.
+        """
+        types = self._molecule_types()
+        atoms = self.type_atom_counts()[types] * self.counts
+        sizes = {"System": int(atoms.sum())}
+        is_solvent = np.array([set(self.resnames[self.type_offsets[t]:self.type_offsets[t + 1]].tolist())
+                               <= set(solvent) for t in types], dtype=bool)
+        sizes["Protein"] = int(atoms[~is_solvent].sum())
+        sizes["Non-Protein"] = int(atoms[is_solvent].sum())
+        for name, n in zip(self.molecules.tolist(), atoms.tolist()):
+            sizes[name] = sizes.get(name, 0) + int(n)
+        return sizes
+
+    def atom_charges(self):
+        """Returns the charge of every atom of the system, in topology order."""
+        types = self._molecule_types()
+        return np.concatenate([np.tile(self.charges[self.type_offsets[t]:self.type_offsets[t + 1]], n)
+                               for t, n in zip(types, self.counts)]) if len(types) else np.zeros(0)
+
+    def molecule_starts(self):
+        """Returns the index of the first atom of every molecule of the system."""
+        types = self._molecule_types()
+        sizes = np.repeat(self.type_atom_counts()[types], self.counts)
+        return np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64) if len(sizes) else sizes
+
+    def system_bonds(self):
+        """Returns the bonds of every molecule of the system as an (n_bonds, 2) array of atom indices."""
+        types = self._molecule_types()
+        starts = self.molecule_starts()
+        bonds = []
+        molecule = 0
+        for t, n in zip(types, self.counts):
+            type_bonds = self.bonds[self.bond_offsets[t]:self.bond_offsets[t + 1]]
+            offsets = starts[molecule:molecule + n]
+            bonds.append((type_bonds[None, :, :] + offsets[:, None, None]).reshape(-1, 2))
+            molecule += n
+        return np.concatenate(bonds) if bonds else np.zeros((0, 2), dtype=np.int64)
+
+    def save(self, path):
+        meta = {"version": TOPOLOGY_CACHE_VERSION, "system": self.system, "includes": self.includes}
+        tmp_path = path + ".tmp" + str(os.getpid()) + ".npz"
+        np.savez(tmp_path,
+                 type_names=self.type_names, type_offsets=self.type_offsets,
+                 atom_names=self.atom_names, atom_types=self.atom_types,
+                 resids=self.resids, resnames=self.resnames,
+                 charges=self.charges, masses=self.masses,
+                 molecules=self.molecules, counts=self.counts,
+                 bonds=self.bonds, bond_offsets=self.bond_offsets,
+                 meta=np.array(json.dumps(meta)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != TOPOLOGY_CACHE_VERSION:
+                raise ValueError(f"{path} is an old topology cache")
+            return cls(data["type_names"], data["type_offsets"], data["atom_names"], data["atom_types"],
+                       data["resids"], data["resnames"], data["charges"], data["masses"],
+                       data["molecules"], data["counts"], meta["system"], meta["includes"],
+                       data["bonds"], data["bond_offsets"])
+
+
+def _find_include(name, directory, include_dirs):
+    for base in [directory] + list(include_dirs):
+        path = os.path.join(base, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def default_include_dirs():
+    """The directories grompp searches for includes: GMXLIB and the GROMACS share/top directory."""
+    dirs = [path for path in os.environ.get("GMXLIB", "").split(os.pathsep) if path]
+    if os.environ.get("GMXDATA"):
+        dirs.append(os.path.join(os.environ["GMXDATA"], "top"))
+    return dirs
+
+
+def parse_topology(path, include_dirs=None, defines=None):
+    """
+    Parses a topology and the files it includes into a Topology.
+    #ifdef/#ifndef/#else/#endif are followed for the given defines (like grompp -D).
+    Atom masses and charges missing from [ atoms ] are taken from [ atomtypes ].
+    topology.includes maps the path of every included file to its sha256.
+    Includes that cannot be found are skipped and recorded by name with a None digest.
+    """
+    if include_dirs is None:
+        include_dirs = default_include_dirs()
+    defines = set(defines or [])
+
+    type_names = []
+    type_starts = []
+    atoms = []
+    bonds = []
+    bond_starts = []
+    atomtypes = {}
+    molecules = []
+    counts = []
+    system = []
+    includes = {}
+
+    def read(path):
+        directory = os.path.dirname(path)
+        section = None
+        # one entry per open #if: whether its lines are used
+        active = []
+        with open(path, errors="replace") as f:
+            for line in f:
+                line = line.split(";", 1)[0].strip()
+                if not line:
+                    continue
+                if line[0] == "#":
+                    directive = line.split()
+                    keyword = directive[0]
+                    if keyword == "#ifdef":
+                        active.append(directive[1] in defines)
+                    elif keyword == "#ifndef":
+                        active.append(directive[1] not in defines)
+                    elif keyword == "#else":
+                        active[-1] = not active[-1]
+                    elif keyword == "#endif":
+                        active.pop()
+                    elif all(active):
+                        if keyword == "#define":
+                            defines.add(directive[1])
+                        elif keyword == "#undef":
+                            defines.discard(directive[1])
+                        elif keyword == "#include":
+                            name = line.split(None, 1)[1].strip('"<> ')
+                            include = _find_include(name, directory, include_dirs)
+                            if include is None:
+                                includes[name] = None
+                            else:
+                                includes[os.path.abspath(include)] = file_digest(include)
+                                read(include)
+                    continue
+                if not all(active):
+                    continue
+                if line[0] == "[":
+                    section = line.strip("[] ").lower()
+                    continue
+                if section == "atoms":
+                    atoms.append(line.split())
+                elif section == "moleculetype":
+                    type_names.append(line.split()[0])
+                    type_starts.append(len(atoms))
+                    bond_starts.append(len(bonds))
+                elif section in ("bonds", "constraints"):
+                    fields = line.split()
+                    bonds.append((int(fields[0]) - 1, int(fields[1]) - 1))
+                elif section == "settles":
+                    # the oxygen, with the two hydrogens right after it
+                    oxygen = int(line.split()[0]) - 1
+                    bonds.append((oxygen, oxygen + 1))
+                    bonds.append((oxygen, oxygen + 2))
+                elif section == "molecules":
+                    name, count = line.split()[:2]
+                    molecules.append(name)
+                    counts.append(int(count))
+                elif section == "atomtypes":
+                    fields = line.split()
+                    # the ptype column is a single letter, mass and charge come right before it
+                    for i in range(3, len(fields)):
+                        if fields[i] in ("A", "S", "V", "D"):
+                            atomtypes[fields[0]] = (float(fields[i - 2]), float(fields[i - 1]))
+                            break
+                elif section == "system":
+                    system.append(line)
+
+    read(path)
+    type_offsets = np.array(type_starts + [len(atoms)], dtype=np.int64)
+    bond_offsets = np.array(bond_starts + [len(bonds)], dtype=np.int64)
+
+    n = len(atoms)
+    charges = np.empty(n, dtype=np.float64)
+    masses = np.empty(n, dtype=np.float64)
+    for i, fields in enumerate(atoms):
+        default_mass, default_charge = atomtypes.get(fields[1], (0.0, 0.0))
+        charges[i] = float(fields[6]) if len(fields) > 6 else default_charge
+        masses[i] = float(fields[7]) if len(fields) > 7 else default_mass
+
+    def column(index, dtype):
+        return np.array([fields[index] for fields in atoms], dtype=dtype) if n else np.zeros(0, dtype=dtype)
+
+    return Topology(np.array(type_names, dtype="U"),
+                    type_offsets,
+                    column(4, "U"),
+                    column(1, "U"),
+                    column(2, np.int32),
+                    column(3, "U"),
+                    charges,
+                    masses,
+                    np.array(molecules, dtype="U"),
+                    np.array(counts, dtype=np.int64),
+                    " ".join(system),
+                    includes,
+                    np.array(bonds, dtype=np.int64).reshape(-1, 2),
+                    bond_offsets)
+
+
+def read_topology(path, include_dirs=None, defines=None, cache_dir=None):
+    """
+    Returns the Topology of path, from the binary cache if the topology and its includes
+    are unchanged. The cache is kept in cache_dir (by default .xmd_topology next to the file)
+    under the sha256 of the topology, so copies of the same file in every replicate share it.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRECTORY)
+    suffix = "" if not defines else "_" + "_".join(sorted(defines))
+    cache_path = os.path.join(cache_dir, file_digest(path) + suffix + ".npz")
+
+    if os.path.exists(cache_path):
+        try:
+            topology = Topology.load(cache_path)
+            # the cache is only valid while the included files are unchanged
+            if all(digest is None or file_digest(include) == digest
+                   for include, digest in topology.includes.items()):
+                return topology
+        except (OSError, ValueError, KeyError):
+            pass
+
+    topology = parse_topology(path, include_dirs, defines)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        topology.save(cache_path)
+    except OSError:
+        # read-only topology directories are parsed every time
+        pass
+    return topology
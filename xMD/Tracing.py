@@ -0,0 +1,195 @@
+# Timing spans for the stages of an experiment
+# Spans record wall time, CPU time, memory and I/O. Commands run with run_command also
+# record the resources of the child process (gmx), taken from wait4 when it is reaped.
+# Spans are only recorded while a Tracer is active (set_tracer). The active tracer is a context
+# variable, so replicates run in threads each trace to their own tracer. New threads start without
+# one; work handed to a thread is run in contextvars.copy_context() to keep tracing to the caller's.
+import os
+import json
+import time
+import resource
+import threading
+import subprocess
+import contextvars
+from contextlib import contextmanager
+
+_tracer = contextvars.ContextVar("xmd_tracer", default=None)
+
+
+def get_tracer():
+    """Returns the active tracer of this context, or None if tracing is off."""
+    return _tracer.get()
+
+
+def set_tracer(tracer):
+    """Makes tracer the active tracer of this context (None turns tracing off). Returns the previous one."""
+    previous = _tracer.get()
+    _tracer.set(tracer)
+    return previous
+
+
+def _proc_io():
+    """Returns the bytes read and written by this process so far, from /proc/self/io."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _cpu_time():
+    times = os.times()
+    # user + system time of this process and of the children it has waited for
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def child_usage(usage):
+    """Returns the resources of a reaped child process from its rusage."""
+    return {"child_cpu_time": usage.ru_utime + usage.ru_stime,
+            # ru_maxrss is in kB on Linux
+            "child_max_rss_mb": usage.ru_maxrss / 1024,
+            # block counts are 512 byte units, so only I/O that reached the disk is counted
+            "child_read_bytes": usage.ru_inblock * 512,
+            "child_write_bytes": usage.ru_oublock * 512}
+
+
+class Tracer():
+    """
+    Collects spans as Chrome trace events ("X" complete events, times in microseconds).
+    Each span records in its args: wall_time and cpu_time in seconds, max_rss_mb of this process,
+    and read_bytes/write_bytes done by this process during the span (all threads).
+    Spans of commands run with run_command also record the child_* resources of the command.
+    """
+    def __init__(self, name="xMD"):
+        self.name = name
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.epoch = time.time()
+
+    @contextmanager
+    def span(self, name, category="xmd", **args):
+        """Records the code in the with block as a span. Yields the args dict of the span."""
+        record = dict(args)
+        start = time.perf_counter()
+        cpu_start = _cpu_time()
+        io_start = _proc_io()
+        try:
+            yield record
+        except BaseException as error:
+            record["error"] = repr(error)
+            raise
+        finally:
+            end = time.perf_counter()
+            record["wall_time"] = end - start
+            record["cpu_time"] = _cpu_time() - cpu_start
+            record["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            io_end = _proc_io()
+            if io_start is not None and io_end is not None:
+                record["read_bytes"] = io_end[0] - io_start[0]
+                record["write_bytes"] = io_end[1] - io_start[1]
+            event = {"name": name,
+                     "cat": category,
+                     "ph": "X",
+                     "ts": (start - self.origin) * 1e6,
+                     "dur": (end - start) * 1e6,
+                     "pid": os.getpid(),
+                     "tid": threading.get_ident(),
+                     "args": record}
+            with self.lock:
+                self.events.append(event)
+
+    def write_chrome_trace(self, path):
+        """Writes the spans as a Chrome/Perfetto trace JSON file (open in ui.perfetto.dev)."""
+        with self.lock:
+            events = list(self.events)
+        metadata = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": self.name}}]
+        threads = {event["tid"] for event in events}
+        metadata += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                      "args": {"name": "main" if tid == threading.main_thread().ident else str(tid)}}
+                     for tid in threads]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + events,
+                       "displayTimeUnit": "ms",
+                       "otherData": {"name": self.name, "start": self.epoch}}, f)
+        print("Trace written to: ", path)
+        return path
+
+    def write_tensorboard(self, writer, prefix="trace"):
+        """
+        Adds the numeric args of every span to a SummaryWriter as prefix/name/arg scalars.
+        The step is the index of the span among the spans with the same name.
+        """
+        counts = {}
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        for event in events:
+            step = counts.get(event["name"], 0)
+            counts[event["name"]] = step + 1
+            for key, value in event["args"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    writer.add_scalar(f"{prefix}/{event['name']}/{key}", value, global_step=step)
+
+    def to_dataframe(self):
+        """Returns one row per span with its name, category, start and args."""
+        import pandas as pd
+
+        with self.lock:
+            rows = [dict(event["args"], name=event["name"], category=event["cat"],
+                         start=event["ts"] / 1e6, thread=event["tid"]) for event in self.events]
+        return pd.DataFrame(rows)
+
+    def summary(self):
+        """Returns the count, total and mean wall time and total CPU time of each span name."""
+        dataframe = self.to_dataframe()
+        if dataframe.empty:
+            return dataframe
+        return dataframe.groupby("name").agg(count=("wall_time", "size"),
+                                             wall_time=("wall_time", "sum"),
+                                             mean_wall_time=("wall_time", "mean"),
+                                             cpu_time=("cpu_time", "sum")).sort_values("wall_time", ascending=False)
+
+
+@contextmanager
+def span(name, category="xmd", **args):
+    """
+    Records a span on the active tracer. Yields the args dict of the span, or None if tracing is off.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(name, category, **args) as record:
+        yield record
+
+
+def run_command(command, input=None, check=True, name=None, category="gmx"):
+    """
+    Runs a command like subprocess.run, inside a span named after the command (e.g. "gmx mdrun").
+    The child is reaped with wait4 so its CPU time, peak RSS and disk I/O are recorded.
+    input is written to the command's stdin. Returns a CompletedProcess.
+    """
+    if name is None:
+        name = " ".join([os.path.basename(command[0])] + command[1:2])
+    with span(name, category, command=" ".join(command)) as record:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else None)
+        try:
+            if input is not None:
+                try:
+                    process.stdin.write(input)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if record is not None:
+            record.update(child_usage(usage))
+            record["returncode"] = process.returncode
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return subprocess.CompletedProcess(command, process.returncode)
@@ -0,0 +1,179 @@
+# Persistent catalog of the replicate directories and the segment files in them
+import os
+import re
+import json
+import time
+import threading
+
+# <prefix>_<segment>[-<variant>].<ext>, e.g. APO_md_1K55_3-nojump.xtc
+SEGMENT_FILE = re.compile(r"^(?P<prefix>.+)_(?P<segment>\d+)(?P<variant>-[^.]+)?\.(?P<ext>[^.]+)$")
+CATALOG_NAME = ".xmd_catalog.json"
+CATALOG_VERSION = 1
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(root):
+    """
+    Returns the catalog for root, shared by every experiment in this process.
+    """
+    root = os.path.normpath(root)
+    with _catalogs_lock:
+        catalog = _catalogs.get(root)
+        if catalog is None:
+            catalog = TrajectoryCatalog(root)
+            _catalogs[root] = catalog
+        return catalog
+
+
+class TrajectoryCatalog():
+    """
+    Catalog of the files in the replicate directories under root (root/pdbcode/trial/R_n).
+    Directories are scanned with os.scandir and only rescanned when their mtime changes,
+    so a lookup normally costs one stat. The catalog is saved to root/.xmd_catalog.json
+    so other processes start from it. File sizes are updated when their directory is rescanned.
+    Backup files (#name#) are counted but not listed.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, CATALOG_NAME)
+        self.lock = threading.RLock()
+        self.dirs = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == CATALOG_VERSION:
+            self.dirs = data["dirs"]
+
+    def save(self):
+        """Writes the catalog atomically if it changed."""
+        with self.lock:
+            if not self.changed or not os.path.isdir(self.root):
+                return
+            tmp_path = self.path + ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+            with open(tmp_path, "w") as f:
+                json.dump({"version": CATALOG_VERSION, "dirs": self.dirs}, f)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+
+    def _scan(self, path):
+        """
+        Returns the cached entry for a directory, rescanning it if its mtime changed.
+        Returns None if the directory does not exist.
+        """
+        key = os.path.relpath(path, self.root)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if self.dirs.pop(key, None) is not None:
+                self.changed = True
+            return None
+
+        entry = self.dirs.get(key)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry
+
+        files = {}
+        subdirs = []
+        backups = 0
+        latest = {}
+        with os.scandir(path) as it:
+            for item in it:
+                if item.name.startswith("#"):
+                    backups += 1
+                elif item.is_dir():
+                    subdirs.append(item.name)
+                elif item.name != CATALOG_NAME:
+                    record = {"size": item.stat().st_size}
+                    match = SEGMENT_FILE.match(item.name)
+                    if match is not None:
+                        record.update(prefix=match["prefix"],
+                                      segment=int(match["segment"]),
+                                      variant=match["variant"],
+                                      kind=match["ext"])
+                        # latest segment per prefix and file kind, for O(1) lookups
+                        latest_key = match["prefix"] + "|" + match["ext"] + "|" + (match["variant"] or "")
+                        latest[latest_key] = max(latest.get(latest_key, -1), int(match["segment"]))
+                    else:
+                        record["kind"] = os.path.splitext(item.name)[1].lstrip(".")
+                    files[item.name] = record
+
+        # a directory modified within the mtime resolution may change again unseen
+        recent = time.time_ns() - mtime < 2_000_000_000
+        entry = {"mtime": None if recent else mtime,
+                 "files": files,
+                 "subdirs": sorted(subdirs),
+                 "backups": backups,
+                 "latest": latest}
+        self.dirs[key] = entry
+        self.changed = True
+        return entry
+
+    def replicates(self, pdbcode, trial):
+        """Returns the replicate directories of a trial."""
+        with self.lock:
+            entry = self._scan(os.path.join(self.root, pdbcode, trial))
+            self.save()
+        return [] if entry is None else list(entry["subdirs"])
+
+    def replicate(self, pdbcode, trial, rep_dir):
+        """Returns the files of one replicate directory as {name: record}."""
+        with self.lock:
+            entry = self._scan(os.path.join(self.root, pdbcode, trial, rep_dir))
+            self.save()
+        return {} if entry is None else entry["files"]
+
+    def latest_segment(self, pdbcode, trial, rep_dir, prefix, kind="gro", variant=None):
+        """
+        Returns the highest segment number of prefix_<n>.<kind> in the replicate, or None.
+        """
+        with self.lock:
+            entry = self._scan(os.path.join(self.root, pdbcode, trial, rep_dir))
+            self.save()
+        if entry is None:
+            return None
+        return entry["latest"].get(prefix + "|" + kind + "|" + (variant or ""))
+
+    def refresh(self):
+        """Rescans every changed directory under root."""
+        with self.lock:
+            root = self._scan(self.root)
+            for pdbcode in root["subdirs"] if root else []:
+                pdb_entry = self._scan(os.path.join(self.root, pdbcode))
+                for trial in pdb_entry["subdirs"] if pdb_entry else []:
+                    trial_entry = self._scan(os.path.join(self.root, pdbcode, trial))
+                    for rep_dir in trial_entry["subdirs"] if trial_entry else []:
+                        self._scan(os.path.join(self.root, pdbcode, trial, rep_dir))
+            self.save()
+
+    def query(self, pdbcode=None, trial=None, rep_dir=None, kind=None, prefix=None):
+        """
+        Returns the catalogued segment files matching the filters as a list of dicts
+        with pdbcode, trial, replicate, name, segment, variant, kind and size.
+        """
+        self.refresh()
+        results = []
+        with self.lock:
+            for key, entry in self.dirs.items():
+                parts = key.split(os.sep)
+                if len(parts) != 3:
+                    continue
+                if ((pdbcode is not None and parts[0] != pdbcode)
+                        or (trial is not None and parts[1] != trial)
+                        or (rep_dir is not None and parts[2] != rep_dir)):
+                    continue
+                for name, record in entry["files"].items():
+                    if kind is not None and record["kind"] != kind:
+                        continue
+                    if prefix is not None and record.get("prefix") != prefix:
+                        continue
+                    results.append(dict(record, pdbcode=parts[0], trial=parts[1],
+                                        replicate=parts[2], name=name))
+        return results
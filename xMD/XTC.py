@@ -0,0 +1,817 @@
+# Reader and writer for GROMACS .xtc trajectories using NumPy
+# Implements the xdrfile xtc compression so trajectories can be read and written without gmx.
+# Whole chunks go through the compiled codec of mdtraj when it is installed, which is about 30x faster
+# than the Python codec below and gives the same coordinates and bytes.
+import os
+import struct
+import tempfile
+from collections import namedtuple
+import numpy as np
+
+MAGIC = 1995
+# GROMACS 2023+ writes this magic with a 64 bit byte count for very large frames
+MAGIC_LARGE = 2023
+FIRSTIDX = 9
+MAGICINTS = (
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 8, 10, 12, 16, 20, 25, 32, 40, 50, 64,
+    80, 101, 128, 161, 203, 256, 322, 406, 512, 645, 812, 1024, 1290,
+    1625, 2048, 2580, 3250, 4096, 5060, 6501, 8192, 10321, 13003,
+    16384, 20642, 26007, 32768, 41285, 52015, 65536, 82570, 104031,
+    131072, 165140, 208063, 262144, 330280, 416127, 524287, 660561,
+    832255, 1048576, 1321122, 1664510, 2097152, 2642245, 3329021,
+    4194304, 5284491, 6658042, 8388607, 10568983, 13316085, 16777216)
+LASTIDX = len(MAGICINTS)
+MAXABS = 2147483647 - 2
+
+HEADER = struct.Struct(">iiif9fi")
+
+XTCFrame = namedtuple("XTCFrame", ["step", "time", "box", "coords", "precision"])
+
+
+def _compiled_xtc():
+    """Returns mdtraj's XTCTrajectoryFile if mdtraj is installed, else None."""
+    try:
+        from mdtraj.formats.xtc import XTCTrajectoryFile
+    except ImportError:
+        return None
+    return XTCTrajectoryFile
+
+
+def _sizeofints(sizes):
+    """Number of bits needed to store the three ints packed with sizes."""
+    return (sizes[0] * sizes[1] * sizes[2]).bit_length()
+
+
+def _unpack_ints(combined, sizes):
+    z = combined % sizes[2]
+    combined //= sizes[2]
+    y = combined % sizes[1]
+    return combined // sizes[1], y, z
+
+
+def _reverse_chunks(value, n_bits):
+    """
+    Converts between the packed integer and the order xdrfile streams it in:
+    8 bit chunks starting from the least significant byte, then a final 1-8 bit chunk.
+    The conversion is its own inverse.
+    """
+    n_full = (n_bits - 1) // 8
+    remainder = n_bits - 8 * n_full
+    if n_full == 0:
+        return value
+    low = value >> remainder
+    high = value & ((1 << remainder) - 1)
+    return (int.from_bytes(low.to_bytes(n_full, "big"), "little")
+            | (high << (8 * n_full)))
+
+
+def _pack_chunks(value, n_bits):
+    """Inverse of _reverse_chunks."""
+    n_full = (n_bits - 1) // 8
+    remainder = n_bits - 8 * n_full
+    if n_full == 0:
+        return value
+    low = value & ((1 << (8 * n_full)) - 1)
+    high = value >> (8 * n_full)
+    return (int.from_bytes(low.to_bytes(n_full, "little"), "big") << remainder) | high
+
+
+def decompress_coords(data, n_atoms, minint, maxint, smallidx):
+    """
+    Decodes the compressed coordinate block of one xtc frame.
+    Returns the integer coordinates as an (n_atoms, 3) int64 array.
+    """
+    # pad so reads at the end of the buffer never run short
+    data = bytes(data) + bytes(8)
+    from_bytes = int.from_bytes
+    pos = 0
+
+    sizeint = [maxint[i] - minint[i] + 1 for i in range(3)]
+    large = (sizeint[0] | sizeint[1] | sizeint[2]) > 0xffffff
+    if large:
+        bitsizeint = [s.bit_length() for s in sizeint]
+        bitsize = 0
+    else:
+        bitsize = _sizeofints(sizeint)
+    minx, miny, minz = minint
+
+    smaller = MAGICINTS[max(FIRSTIDX, smallidx - 1)] // 2
+    smallnum = MAGICINTS[smallidx] // 2
+    sizesmall = MAGICINTS[smallidx]
+
+    out = []
+    append = out.append
+    run = 0
+    i = 0
+    while i < n_atoms:
+        if large:
+            coord = []
+            for n in bitsizeint:
+                start = pos >> 3
+                n_bytes = ((pos & 7) + n + 7) >> 3
+                v = from_bytes(data[start:start + n_bytes], "big")
+                coord.append((v >> (n_bytes * 8 - (pos & 7) - n)) & ((1 << n) - 1))
+                pos += n
+            x, y, z = coord
+        else:
+            start = pos >> 3
+            n_bytes = ((pos & 7) + bitsize + 7) >> 3
+            v = from_bytes(data[start:start + n_bytes], "big")
+            v = (v >> (n_bytes * 8 - (pos & 7) - bitsize)) & ((1 << bitsize) - 1)
+            pos += bitsize
+            x, y, z = _unpack_ints(_reverse_chunks(v, bitsize), sizeint)
+        i += 1
+        px, py, pz = x + minx, y + miny, z + minz
+
+        # run length flag
+        flag = (data[pos >> 3] >> (7 - (pos & 7))) & 1
+        pos += 1
+        is_smaller = 0
+        if flag:
+            start = pos >> 3
+            v = from_bytes(data[start:start + 2], "big")
+            run = (v >> (16 - (pos & 7) - 5)) & 31
+            pos += 5
+            is_smaller = run % 3
+            run -= is_smaller
+            is_smaller -= 1
+
+        if run > 0:
+            for k in range(0, run, 3):
+                start = pos >> 3
+                n_bytes = ((pos & 7) + smallidx + 7) >> 3
+                v = from_bytes(data[start:start + n_bytes], "big")
+                v = (v >> (n_bytes * 8 - (pos & 7) - smallidx)) & ((1 << smallidx) - 1)
+                pos += smallidx
+                sx, sy, sz = _unpack_ints(_reverse_chunks(v, smallidx),
+                                          (sizesmall, sizesmall, sizesmall))
+                i += 1
+                sx += px - smallnum
+                sy += py - smallnum
+                sz += pz - smallnum
+                if k == 0:
+                    # the first two atoms of a run are swapped (water compresses better)
+                    append(sx)
+                    append(sy)
+                    append(sz)
+                    append(px)
+                    append(py)
+                    append(pz)
+                    px, py, pz = sx, sy, sz
+                else:
+                    px, py, pz = sx, sy, sz
+                    append(sx)
+                    append(sy)
+                    append(sz)
+        else:
+            append(px)
+            append(py)
+            append(pz)
+
+        smallidx += is_smaller
+        if is_smaller < 0:
+            smallnum = smaller
+            smaller = MAGICINTS[smallidx - 1] // 2 if smallidx > FIRSTIDX else 0
+        elif is_smaller > 0:
+            smaller = smallnum
+            smallnum = MAGICINTS[smallidx] // 2
+        sizesmall = MAGICINTS[smallidx]
+
+    return np.array(out, dtype=np.int64).reshape(n_atoms, 3)
+
+
+class _BitWriter():
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0
+        self.n_acc = 0
+
+    def write(self, value, n_bits):
+        if n_bits <= 0:
+            return
+        self.acc = (self.acc << n_bits) | (value & ((1 << n_bits) - 1))
+        self.n_acc += n_bits
+        if self.n_acc >= 8:
+            n_bytes = self.n_acc >> 3
+            rest = self.n_acc & 7
+            self.buffer += (self.acc >> rest).to_bytes(n_bytes, "big")
+            self.acc &= (1 << rest) - 1
+            self.n_acc = rest
+
+    def getvalue(self):
+        if self.n_acc:
+            return bytes(self.buffer) + bytes([(self.acc << (8 - self.n_acc)) & 0xff])
+        return bytes(self.buffer)
+
+
+def quantise_coords(coords, precision):
+    """Rounds coordinates to the integer grid used by xtc, half away from zero."""
+    # float32 arithmetic as in xdrfile so the output matches gmx bit for bit
+    scaled = coords.astype(np.float32) * np.float32(precision)
+    ints = np.trunc((scaled + np.where(scaled >= 0, 0.5, -0.5)).astype(np.float32)).astype(np.float64)
+    if np.any(np.abs(ints) > MAXABS):
+        raise ValueError("Coordinates too large to be compressed at this precision.")
+    return ints.astype(np.int64)
+
+
+def compress_coords(ints):
+    """
+    Encodes an (n_atoms, 3) integer coordinate array.
+    Returns (minint, maxint, smallidx, compressed bytes).
+    """
+    n_atoms = len(ints)
+    minint = [int(v) for v in ints.min(axis=0)]
+    maxint = [int(v) for v in ints.max(axis=0)]
+    if any(maxint[i] - minint[i] >= MAXABS for i in range(3)):
+        raise ValueError("Coordinate range too large to be compressed.")
+
+    sizeint = [maxint[i] - minint[i] + 1 for i in range(3)]
+    large = (sizeint[0] | sizeint[1] | sizeint[2]) > 0xffffff
+    if large:
+        bitsizeint = [s.bit_length() for s in sizeint]
+        bitsize = 0
+    else:
+        bitsize = _sizeofints(sizeint)
+
+    if n_atoms > 1:
+        mindiff = int(np.abs(np.diff(ints, axis=0)).sum(axis=1).min())
+    else:
+        mindiff = MAXABS
+    smallidx = FIRSTIDX
+    while smallidx < LASTIDX - 1 and MAGICINTS[smallidx] < mindiff:
+        smallidx += 1
+    start_smallidx = smallidx
+
+    maxidx = min(LASTIDX - 1, smallidx + 8)
+    minidx = maxidx - 8
+    smaller = MAGICINTS[max(FIRSTIDX, smallidx - 1)] // 2
+    smallnum = MAGICINTS[smallidx] // 2
+    sizesmall = MAGICINTS[smallidx]
+    larger = MAGICINTS[maxidx] // 2
+
+    coords = ints.reshape(-1).tolist()
+    writer = _BitWriter()
+    write = writer.write
+    prevrun = -1
+    px = py = pz = 0
+    i = 0
+    while i < n_atoms:
+        is_small = 0
+        j = 3 * i
+        if (smallidx < maxidx and i >= 1
+                and abs(coords[j] - px) < larger
+                and abs(coords[j + 1] - py) < larger
+                and abs(coords[j + 2] - pz) < larger):
+            is_smaller = 1
+        elif smallidx > minidx:
+            is_smaller = -1
+        else:
+            is_smaller = 0
+
+        if i + 1 < n_atoms:
+            if (abs(coords[j] - coords[j + 3]) < smallnum
+                    and abs(coords[j + 1] - coords[j + 4]) < smallnum
+                    and abs(coords[j + 2] - coords[j + 5]) < smallnum):
+                # swap the first and second atom, as the decoder expects
+                coords[j:j + 3], coords[j + 3:j + 6] = coords[j + 3:j + 6], coords[j:j + 3]
+                is_small = 1
+
+        x, y, z = coords[j] - minint[0], coords[j + 1] - minint[1], coords[j + 2] - minint[2]
+        if large:
+            write(x, bitsizeint[0])
+            write(y, bitsizeint[1])
+            write(z, bitsizeint[2])
+        else:
+            write(_pack_chunks((x * sizeint[1] + y) * sizeint[2] + z, bitsize), bitsize)
+        px, py, pz = coords[j], coords[j + 1], coords[j + 2]
+        i += 1
+        j += 3
+
+        run = 0
+        small_coords = []
+        if is_small == 0 and is_smaller == -1:
+            is_smaller = 0
+        while is_small and run < 8 * 3:
+            tx, ty, tz = coords[j], coords[j + 1], coords[j + 2]
+            if is_smaller == -1 and ((tx - px) ** 2 + (ty - py) ** 2 + (tz - pz) ** 2
+                                     >= smaller * smaller):
+                is_smaller = 0
+            small_coords.append((tx - px + smallnum, ty - py + smallnum, tz - pz + smallnum))
+            run += 3
+            px, py, pz = tx, ty, tz
+            i += 1
+            j += 3
+            is_small = 0
+            if (i < n_atoms
+                    and abs(coords[j] - px) < smallnum
+                    and abs(coords[j + 1] - py) < smallnum
+                    and abs(coords[j + 2] - pz) < smallnum):
+                is_small = 1
+
+        if run != prevrun or is_smaller != 0:
+            prevrun = run
+            write(1, 1)
+            write(run + is_smaller + 1, 5)
+        else:
+            write(0, 1)
+        for sx, sy, sz in small_coords:
+            write(_pack_chunks((sx * sizesmall + sy) * sizesmall + sz, smallidx), smallidx)
+
+        if is_smaller != 0:
+            smallidx += is_smaller
+            if is_smaller < 0:
+                smallnum = smaller
+                smaller = MAGICINTS[smallidx - 1] // 2 if smallidx > FIRSTIDX else 0
+            else:
+                smaller = smallnum
+                smallnum = MAGICINTS[smallidx] // 2
+            sizesmall = MAGICINTS[smallidx]
+
+    return minint, maxint, start_smallidx, writer.getvalue()
+
+
+def _padded(n_bytes):
+    return (n_bytes + 3) & ~3
+
+
+class XTCReader():
+    """
+    Reads an xtc trajectory one frame at a time.
+    Frames are returned as XTCFrame(step, time, box, coords, precision), with box (3, 3)
+    and coords (n_atoms, 3) float32 arrays in nm. Memory use does not depend on the trajectory length.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.n_atoms = None
+        self.precision = None
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _read_header(self):
+        data = self.file.read(HEADER.size)
+        if len(data) < HEADER.size:
+            return None
+        values = HEADER.unpack(data)
+        magic, n_atoms, step, time = values[:4]
+        if magic not in (MAGIC, MAGIC_LARGE):
+            raise ValueError(f"Not an xtc frame at byte {self.file.tell() - HEADER.size} of {self.path}")
+        box = np.array(values[4:13], dtype=np.float32).reshape(3, 3)
+        return magic, n_atoms, step, time, box
+
+    def read_frame(self):
+        """Reads the next frame, returns None at the end of the file."""
+        header = self._read_header()
+        if header is None:
+            return None
+        magic, n_atoms, step, time, box = header
+        self.n_atoms = n_atoms
+
+        if n_atoms <= 9:
+            coords = np.frombuffer(self.file.read(12 * n_atoms), dtype=">f4")
+            return XTCFrame(step, time, box, coords.astype(np.float32).reshape(n_atoms, 3), 0.0)
+
+        precision, = struct.unpack(">f", self.file.read(4))
+        ints = struct.unpack(">7i", self.file.read(28))
+        minint, maxint, smallidx = ints[:3], ints[3:6], ints[6]
+        if magic == MAGIC_LARGE:
+            n_bytes, = struct.unpack(">q", self.file.read(8))
+        else:
+            n_bytes, = struct.unpack(">i", self.file.read(4))
+        data = self.file.read(_padded(n_bytes))[:n_bytes]
+
+        self.precision = precision
+        coords = decompress_coords(data, n_atoms, minint, maxint, smallidx)
+        coords = coords.astype(np.float32) * np.float32(1.0 / precision)
+        return XTCFrame(step, time, box, coords, precision)
+
+    def seek(self, offset):
+        """Moves to the frame starting at byte offset, as returned by skip_frame or index."""
+        self.file.seek(offset)
+
+    def _skip_body(self, magic, n_atoms):
+        if n_atoms <= 9:
+            self.file.seek(12 * n_atoms, os.SEEK_CUR)
+        else:
+            self.file.seek(32, os.SEEK_CUR)
+            if magic == MAGIC_LARGE:
+                n_bytes, = struct.unpack(">q", self.file.read(8))
+            else:
+                n_bytes, = struct.unpack(">i", self.file.read(4))
+            self.file.seek(_padded(n_bytes), os.SEEK_CUR)
+
+    def skip_frame(self):
+        """
+        Skips the next frame without decoding it.
+        Returns (offset, size) of the frame in bytes or None at the end of the file.
+        """
+        offset = self.file.tell()
+        header = self._read_header()
+        if header is None:
+            return None
+        magic, n_atoms = header[:2]
+        self.n_atoms = n_atoms
+        self._skip_body(magic, n_atoms)
+        return offset, self.file.tell() - offset
+
+    def index(self):
+        """
+        Reads the headers of the remaining frames without decoding them.
+        Returns a dict of offsets, sizes, steps and times arrays, one entry per frame.
+        """
+        offsets, sizes, steps, times = [], [], [], []
+        while True:
+            offset = self.file.tell()
+            header = self._read_header()
+            if header is None:
+                break
+            magic, n_atoms, step, time = header[:4]
+            self.n_atoms = n_atoms
+            self._skip_body(magic, n_atoms)
+            offsets.append(offset)
+            sizes.append(self.file.tell() - offset)
+            steps.append(step)
+            times.append(time)
+        return {"offsets": np.array(offsets, dtype=np.int64),
+                "sizes": np.array(sizes, dtype=np.int64),
+                "steps": np.array(steps, dtype=np.int64),
+                "times": np.array(times, dtype=np.float32)}
+
+    def iter_chunks(self, chunk_size=100, stride=1):
+        """
+        Yields the trajectory in batches of up to chunk_size frames as
+        (steps, times, boxes, coords) arrays, with coords of shape (n_frames, n_atoms, 3).
+        With stride > 1 only every stride-th frame is decoded.
+        """
+        compiled = self._open_compiled()
+        if compiled is not None:
+            yield from self._iter_chunks_compiled(*compiled, chunk_size, stride)
+            return
+        steps, times, boxes, coords = [], [], [], []
+        index = 0
+        while True:
+            if index % stride:
+                if self.skip_frame() is None:
+                    break
+                index += 1
+                continue
+            frame = self.read_frame()
+            if frame is None:
+                break
+            index += 1
+            steps.append(frame.step)
+            times.append(frame.time)
+            boxes.append(frame.box)
+            coords.append(frame.coords)
+            if len(coords) == chunk_size:
+                yield np.array(steps), np.array(times, dtype=np.float32), np.stack(boxes), np.stack(coords)
+                steps, times, boxes, coords = [], [], [], []
+        if coords:
+            yield np.array(steps), np.array(times, dtype=np.float32), np.stack(boxes), np.stack(coords)
+
+    def _open_compiled(self):
+        """
+        Opens the file with the compiled codec at the current frame.
+        Returns (trajectory file, first frame, number of frames) or None to use the Python codec.
+        """
+        trajectory_class = _compiled_xtc()
+        if trajectory_class is None:
+            return None
+        start = self.file.tell()
+        header = self._read_header()
+        if header is None:
+            self.file.seek(start)
+            return None
+        # iter_chunks does not return the precision, callers read it from the reader
+        self.n_atoms = header[1]
+        self.precision = struct.unpack(">f", self.file.read(4))[0] if header[1] > 9 else 0.0
+        self.file.seek(start)
+        try:
+            trajectory = trajectory_class(self.path, "r")
+        except Exception:
+            return None
+        try:
+            offsets = trajectory.offsets
+            first = int(np.searchsorted(offsets, start))
+            if first < len(offsets) and offsets[first] == start:
+                return trajectory, first, len(offsets)
+        except Exception:
+            pass
+        # not at a frame boundary mdtraj knows of, e.g. a truncated file
+        trajectory.close()
+        return None
+
+    def _iter_chunks_compiled(self, trajectory, first, n_frames, chunk_size, stride):
+        try:
+            for chunk_start in range(first, n_frames, chunk_size * stride):
+                trajectory.seek(chunk_start)
+                coords, times, steps, boxes = trajectory.read(n_frames=chunk_size, stride=stride)
+                if not len(coords):
+                    break
+                yield steps.astype(np.int64), times, boxes, coords
+        finally:
+            trajectory.close()
+        self.file.seek(0, os.SEEK_END)
+
+
+class XTCWriter():
+    """
+    Writes frames to an xtc trajectory.
+    coords are (n_atoms, 3) arrays in nm, box is a (3, 3) array or the 3 box lengths.
+    """
+    def __init__(self, path, precision=1000.0, append=False):
+        self.path = path
+        self.precision = precision
+        self.file = open(path, "ab" if append else "wb")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_frame(self, coords, step=0, time=0.0, box=None, precision=None):
+        if precision is None:
+            precision = self.precision
+        coords = np.asarray(coords, dtype=np.float32).reshape(-1, 3)
+        n_atoms = len(coords)
+        if box is None:
+            box = np.zeros((3, 3), dtype=np.float32)
+        box = np.asarray(box, dtype=np.float32)
+        if box.shape == (3,):
+            box = np.diag(box)
+
+        header = HEADER.pack(MAGIC, n_atoms, int(step), float(time), *box.reshape(-1).tolist(), n_atoms)
+        if n_atoms <= 9:
+            self.file.write(header + coords.astype(">f4").tobytes())
+            return
+
+        minint, maxint, smallidx, data = compress_coords(quantise_coords(coords, precision))
+        self.file.write(header
+                        + struct.pack(">f7ii", precision, *minint, *maxint, smallidx, len(data))
+                        + data + bytes(_padded(len(data)) - len(data)))
+
+    def write_chunk(self, steps, times, boxes, coords, precision=None):
+        """Writes a batch of frames as yielded by XTCReader.iter_chunks."""
+        if precision is None:
+            precision = self.precision
+        # mdtraj always writes at the default precision
+        if precision == 1000.0 and self._write_chunk_compiled(steps, times, boxes, coords):
+            return
+        for step, time, box, frame in zip(steps, times, boxes, coords):
+            self.write_frame(frame, step, time, box, precision)
+
+
+    def _write_chunk_compiled(self, steps, times, boxes, coords):
+        """Encodes the chunk with mdtraj into a scratch file and appends its bytes. Returns False without mdtraj."""
+        trajectory_class = _compiled_xtc()
+        coords = np.asarray(coords, dtype=np.float32)
+        boxes = np.asarray(boxes, dtype=np.float32)
+        if trajectory_class is None or coords.ndim != 3 or boxes.shape != (len(coords), 3, 3):
+            return False
+        fd, scratch = tempfile.mkstemp(suffix=".xtc", dir=os.path.dirname(os.path.abspath(self.path)))
+        os.close(fd)
+        try:
+            with trajectory_class(scratch, "w", force_overwrite=True) as trajectory:
+                trajectory.write(coords, time=np.asarray(times, dtype=np.float32),
+                                 step=np.asarray(steps, dtype=np.int32), box=boxes)
+            with open(scratch, "rb") as encoded:
+                self.file.write(encoded.read())
+        finally:
+            os.remove(scratch)
+        return True
+
+
+def read_xtc(path, chunk_size=100, stride=1):
+    """
+    Iterates over an xtc file in chunks, see XTCReader.iter_chunks.
+    """
+    with XTCReader(path) as reader:
+        yield from reader.iter_chunks(chunk_size, stride)
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """Copies length bytes from offset in src_fd to the current position of dst_fd, in the kernel if possible."""
+    while length > 0:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, length, offset)
+        except (AttributeError, OSError):
+            copied = 0
+        if copied == 0:
+            # not supported between these files, copy through a buffer instead
+            data = os.pread(src_fd, min(length, 1 << 23), offset)
+            if not data:
+                raise EOFError("Trajectory ended while copying frames")
+            copied = os.write(dst_fd, data)
+        offset += copied
+        length -= copied
+
+
+class ConcatenatedXTC():
+    """
+    The segments of a run as one trajectory, without copying or decoding anything up front.
+    Only the frame headers are read. Frames that overlap the previous segment are dropped:
+    a continuation (mdrun -cpi) repeats the last frame of the previous segment, and a new
+    segment started from the previous .gro repeats it at time 0.
+    With rewrite_times, segments that restart their time (and step) are shifted to follow
+    on from the previous segment.
+    Frames are decoded on access with the shifted step and time, and write() joins the
+    segments on disk by copying the compressed frames.
+    Copying is only right for raw or -pbc mol trajectories. Segments unwrapped with -pbc nojump
+    each start from their own first frame, so an atom that crossed the box in an earlier segment
+    jumps back at the boundary. With nojump=True the jumps are removed across the joins as well:
+    frames are read in order through one NoJump and write() encodes them again.
+    """
+    def __init__(self, paths, rewrite_times=True, tolerance=1e-3, nojump=False):
+        self.paths = list(paths)
+        self.nojump = nojump
+        self.segments = []
+        self.n_atoms = None
+        self.precision = None
+        last_time = None
+        last_step = None
+        for path in self.paths:
+            with XTCReader(path) as reader:
+                index = reader.index()
+                n_atoms = reader.n_atoms
+            if not len(index["offsets"]):
+                continue
+            if self.n_atoms is not None and n_atoms != self.n_atoms:
+                raise ValueError(f"{path} has {n_atoms} atoms, the previous segments have {self.n_atoms}")
+            self.n_atoms = n_atoms
+
+            time_shift = 0.0
+            step_shift = 0
+            keep = np.ones(len(index["offsets"]), dtype=bool)
+            if last_time is not None:
+                if rewrite_times and index["times"][0] < last_time - tolerance:
+                    time_shift = last_time - float(index["times"][0])
+                    step_shift = last_step - int(index["steps"][0])
+                keep = index["times"].astype(np.float64) + time_shift > last_time + tolerance
+            segment = {"path": path,
+                       "offsets": index["offsets"][keep],
+                       "sizes": index["sizes"][keep],
+                       "steps": index["steps"][keep] + step_shift,
+                       "times": index["times"][keep].astype(np.float64) + time_shift,
+                       "step_shift": step_shift,
+                       "time_shift": time_shift,
+                       "dropped": int((~keep).sum())}
+            self.segments.append(segment)
+            if len(segment["times"]):
+                last_time = float(segment["times"][-1])
+                last_step = int(segment["steps"][-1])
+
+    def __len__(self):
+        return sum(len(segment["offsets"]) for segment in self.segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    @property
+    def steps(self):
+        return np.concatenate([segment["steps"] for segment in self.segments]) if self.segments else np.array([])
+
+    @property
+    def times(self):
+        return np.concatenate([segment["times"] for segment in self.segments]) if self.segments else np.array([])
+
+    def _locate(self, index):
+        if index < 0:
+            index += len(self)
+        for segment in self.segments:
+            if index < len(segment["offsets"]):
+                return segment, index
+            index -= len(segment["offsets"])
+        raise IndexError("Frame index out of range")
+
+    def _read(self, reader, segment, i):
+        reader.seek(int(segment["offsets"][i]))
+        frame = reader.read_frame()
+        self.precision = reader.precision
+        return frame._replace(step=int(segment["steps"][i]), time=float(segment["times"][i]))
+
+    def __getitem__(self, index):
+        if self.nojump:
+            raise ValueError("Frames joined with nojump depend on the frames before them, iterate instead")
+        segment, i = self._locate(index)
+        with XTCReader(segment["path"]) as reader:
+            return self._read(reader, segment, i)
+
+    def __iter__(self):
+        if self.nojump:
+            for steps, times, boxes, coords in self.iter_chunks(chunk_size=1):
+                yield XTCFrame(int(steps[0]), float(times[0]), boxes[0], coords[0], self.precision)
+            return
+        for segment in self.segments:
+            with XTCReader(segment["path"]) as reader:
+                for i in range(len(segment["offsets"])):
+                    yield self._read(reader, segment, i)
+
+    def iter_chunks(self, chunk_size=100, stride=1):
+        """Yields (steps, times, boxes, coords) batches like XTCReader.iter_chunks."""
+        from .PBC import NoJump
+
+        # every frame goes through nojump, or frames skipped by stride could not be unwrapped
+        if self.nojump and stride > 1:
+            nojump = NoJump()
+            for steps, times, boxes, coords in self._iter_chunks(chunk_size * stride, 1):
+                coords = nojump(coords, boxes)
+                yield steps[::stride], times[::stride], boxes[::stride], coords[::stride]
+            return
+        nojump = NoJump() if self.nojump else None
+        for steps, times, boxes, coords in self._iter_chunks(chunk_size, stride):
+            yield steps, times, boxes, coords if nojump is None else nojump(coords, boxes)
+
+    def _iter_chunks(self, chunk_size, stride):
+        steps, times, boxes, coords = [], [], [], []
+        index = 0
+        for segment in self.segments:
+            with XTCReader(segment["path"]) as reader:
+                for i in range(len(segment["offsets"])):
+                    index += 1
+                    if (index - 1) % stride:
+                        continue
+                    frame = self._read(reader, segment, i)
+                    steps.append(frame.step)
+                    times.append(frame.time)
+                    boxes.append(frame.box)
+                    coords.append(frame.coords)
+                    if len(coords) == chunk_size:
+                        yield np.array(steps), np.array(times, dtype=np.float32), np.stack(boxes), np.stack(coords)
+                        steps, times, boxes, coords = [], [], [], []
+        if coords:
+            yield np.array(steps), np.array(times, dtype=np.float32), np.stack(boxes), np.stack(coords)
+
+    def write(self, out_path):
+        """
+        Writes the concatenated trajectory by copying the compressed frames of each segment.
+        Runs of consecutive frames are copied in one call; shifted steps and times are then
+        patched into the copied frame headers. With nojump the frames are decoded and encoded
+        again instead. Returns the number of frames written.
+        """
+        tmp_path = out_path + ".tmp" + str(os.getpid())
+        if self.nojump:
+            with XTCWriter(tmp_path) as writer:
+                for steps, times, boxes, coords in self.iter_chunks():
+                    writer.write_chunk(steps, times, boxes, coords, self.precision)
+            os.replace(tmp_path, out_path)
+            return len(self)
+        out_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            position = 0
+            for segment in self.segments:
+                offsets, sizes = segment["offsets"], segment["sizes"]
+                if not len(offsets):
+                    continue
+                # split the kept frames into runs that are contiguous in the segment file
+                breaks = np.flatnonzero(offsets[1:] != offsets[:-1] + sizes[:-1]) + 1
+                src_fd = os.open(segment["path"], os.O_RDONLY)
+                try:
+                    for run in np.split(np.arange(len(offsets)), breaks):
+                        start = int(offsets[run[0]])
+                        length = int(offsets[run[-1]] + sizes[run[-1]]) - start
+                        _copy_range(src_fd, out_fd, start, length)
+                        if segment["time_shift"] or segment["step_shift"]:
+                            for i in run:
+                                # step and time follow the magic and atom count in the header
+                                os.pwrite(out_fd, struct.pack(">if", int(segment["steps"][i]),
+                                                              float(segment["times"][i])),
+                                          position + int(offsets[i]) - start + 8)
+                        position += length
+                finally:
+                    os.close(src_fd)
+        finally:
+            os.close(out_fd)
+        os.replace(tmp_path, out_path)
+        return len(self)
+
+
+def concatenate_xtc(paths, out_path, rewrite_times=True, nojump=False):
+    """
+    Joins segment trajectories into out_path without decoding them, see ConcatenatedXTC.
+    Segments unwrapped with -pbc nojump must be joined with nojump=True.
+    Returns the ConcatenatedXTC view of the result.
+    """
+    view = ConcatenatedXTC(paths, rewrite_times, nojump=nojump)
+    view.write(out_path)
+    return view
@@ -1,2 +1,2 @@
-import os
-print(os.getcwd())
\ No newline at end of file
+# xMD: manage and monitor MD experiments
+# The command line is in __main__.py (python -m xMD)
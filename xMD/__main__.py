@@ -0,0 +1,185 @@
+# Command line for xMD experiments: python -m xMD {run,resume,status,analyse}
+# Only argparse and the settings are imported at startup; each subcommand imports what it needs,
+# so status checks and short array tasks do not pay for pandas, numpy or tensorboardX.
+import os
+import sys
+import json
+import argparse
+
+from .MD_Settings import GROMACS_Settings
+
+
+def parse_value(value):
+    """Reads a --set value as JSON (numbers, true/false, lists), otherwise as a string."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def make_settings(args):
+    settings = GROMACS_Settings(args.name, args.pdbcode)
+    if args.suffix is not None:
+        settings.suffix = args.suffix
+    if args.search is not None:
+        settings.search = args.search
+    for assignment in args.set or []:
+        key, _, value = assignment.partition("=")
+        if not hasattr(settings, key):
+            raise SystemExit(f"Unknown setting: {key}")
+        setattr(settings, key, parse_value(value))
+    return settings
+
+
+def make_experiment(args, rep=None):
+    from .xMD import xMD
+
+    settings = make_settings(args)
+    return xMD(settings, args.name, args.pdbcode, rep)
+
+
+def run(args, resume=False):
+    experiment = make_experiment(args, args.replicate)
+    experiment.create_directory_structure(overwrite=not args.new_trial)
+    experiment.run_experiment(search=args.search,
+                              config_files=args.config,
+                              rep=args.replicate,
+                              md_steps=args.md_steps,
+                              monitor=args.monitor,
+                              pipeline=args.pipeline,
+                              resume=resume)
+    experiment.save_experiment()
+    return 0
+
+
+def segment_table(data_dir, rep_dir, prefix):
+    """
+    Returns the state of each segment of a replicate from the file names alone:
+    the mdrun state, whether it was analysed or archived, and its size on disk.
+    """
+    from .Trajectory_Catalog import get_catalog
+
+    pdb_dir, trial = os.path.split(os.path.normpath(data_dir))
+    root, pdbcode = os.path.split(pdb_dir)
+    files = get_catalog(root).replicate(pdbcode, trial, rep_dir)
+    segments = {}
+    for name, record in files.items():
+        if record.get("prefix") != prefix:
+            continue
+        segment = segments.setdefault(record["segment"], {"segment": record["segment"], "files": set(), "bytes": 0})
+        segment["files"].add((record["variant"] or "") + "." + record["kind"])
+        segment["bytes"] += record["size"]
+    rows = []
+    for number in sorted(segments):
+        segment = segments.pop(number)
+        files = segment.pop("files")
+        if ".gro" in files:
+            segment["state"] = "complete"
+        elif ".cpt" in files and ".tpr" in files:
+            segment["state"] = "checkpoint"
+        elif ".tpr" in files:
+            segment["state"] = "prepared"
+        else:
+            segment["state"] = "missing"
+        segment["archived"] = "-archive.json" in files
+        segment["analysed"] = segment["archived"] or any(file.endswith(".pdb") and file != ".pdb" for file in files)
+        rows.append(segment)
+    return rows
+
+
+def status(args):
+    settings = make_settings(args)
+    data_dir = os.path.join(settings.data_directory, settings.parent, settings.pdbcode, args.name or settings.trial_name)
+    if not os.path.isdir(data_dir):
+        print(f"No trial at {data_dir}", file=sys.stderr)
+        return 1
+    prefix = "_".join([settings.suffix, settings.pdbcode])
+    rep_dirs = sorted(entry for entry in os.listdir(data_dir) if entry.startswith(settings.rep_directory))
+    if args.replicate:
+        rep_dirs = [settings.rep_directory + str(rep) for rep in args.replicate]
+
+    report = {rep_dir: segment_table(data_dir, rep_dir, prefix) for rep_dir in rep_dirs}
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return 0
+    print(f"{data_dir} ({prefix})")
+    for rep_dir, rows in report.items():
+        complete = sum(row["state"] == "complete" for row in rows)
+        print(f"{rep_dir}: {complete}/{len(rows)} segments complete")
+        for row in rows:
+            flags = [flag for flag in ("analysed", "archived") if row[flag]]
+            print(f"  {row['segment']:>4}  {row['state']:<10} {row['bytes'] / 1e6:>10.1f} MB  {' '.join(flags)}")
+    return 0
+
+
+def analyse(args):
+    reps = args.replicate or [1]
+    experiment = make_experiment(args, reps[0])
+    try:
+        # keep the results of earlier runs
+        experiment = experiment.load_experiment(latest=True)
+    except FileNotFoundError:
+        pass
+    for rep in reps:
+        experiment.load_energy_logs(rep)
+    frames = experiment.analyse_structure(reps, args.variant, max_workers=args.workers)
+    if args.output:
+        frames.to_csv(args.output, index=False)
+        print("Structural analysis written to: ", args.output)
+    if args.archive:
+        for rep in reps:
+            experiment.archive_replicate(rep)
+    experiment.save_experiment()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="xmd", description="Run and inspect xMD experiments")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-P", "--pdbcode", required=True, help="PDB code")
+    common.add_argument("-N", "--name", help="Name of the trial")
+    common.add_argument("-S", "--suffix", help="string for the trajectory files")
+    common.add_argument("-s", "--search", help="search string for the top files")
+    common.add_argument("--set", action="append", metavar="KEY=VALUE",
+                        help="override a setting, the value is read as JSON if possible")
+
+    for command, description in (("run", "Run the MD segments of a replicate"),
+                                 ("resume", "Run a replicate, skipping complete segments and continuing from checkpoints")):
+        command_parser = subparsers.add_parser(command, parents=[common], help=description)
+        command_parser.add_argument("-R", "--replicate", type=int, default=1, help="Replicate number")
+        command_parser.add_argument("-c", "--config", nargs="+", help="mdp files for the segments, in order")
+        command_parser.add_argument("--md-steps", type=int, help="Number of segments")
+        command_parser.add_argument("--monitor", action="store_true", help="Stream the energies to tensorboard")
+        command_parser.add_argument("--pipeline", action="store_true", help="Analyse segments while the next one runs")
+        command_parser.add_argument("--new-trial", action="store_true",
+                                    help="Number the trial name instead of using an existing trial directory")
+
+    status_parser = subparsers.add_parser("status", parents=[common], help="Show the state of the segments")
+    status_parser.add_argument("-R", "--replicate", type=int, nargs="+", help="Replicate numbers, default all")
+    status_parser.add_argument("--json", action="store_true", help="Print the state as JSON")
+
+    analyse_parser = subparsers.add_parser("analyse", parents=[common],
+                                           help="Compute RMSD, RMSF, Rg and contacts of analysed segments")
+    analyse_parser.add_argument("-R", "--replicate", type=int, nargs="+", help="Replicate numbers, default 1")
+    analyse_parser.add_argument("--variant", help="Trajectory variant to analyse, default the last pbc step")
+    analyse_parser.add_argument("--workers", type=int, help="Analysis processes, default all cores")
+    analyse_parser.add_argument("--output", help="Write the per-frame results to this csv")
+    analyse_parser.add_argument("--archive", action="store_true", help="Archive the segments afterwards")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "resume":
+        return run(args, resume=True)
+    if args.command == "status":
+        return status(args)
+    return analyse(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
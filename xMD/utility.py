@@ -1,4 +1,11 @@
-import pandas as pd
+import os
+import time
+import atexit
+import random
+import fnmatch
+import threading
+import numpy as np
+from .MD_Log import GROMACS_energy_parser, GROMACS_energy_table
 from tensorboardX import SummaryWriter as SummaryWriter_
 
 class SummaryWriter(SummaryWriter_):
@@ -33,28 +40,366 @@ class SummaryWriter(SummaryWriter_):
 
 
 
+class ScalarBuffer():
+    """
+    The steps, values and wall times of one tag waiting to be written, in arrays grown geometrically.
+    With a reservoir size only that many points are kept, sampled uniformly from all the points added.
+    """
+    def __init__(self, capacity=64, reservoir=None):
+        self.reservoir = reservoir
+        if reservoir is not None:
+            capacity = reservoir
+        self.steps = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.walltimes = np.empty(capacity, dtype=np.float64)
+        self.n = 0
+        self.seen = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, step, value, walltime):
+        self.seen += 1
+        i = self.n
+        if self.reservoir is not None and i == self.reservoir:
+            # algorithm R: the new point replaces a kept one with probability reservoir / seen
+            i = random.randrange(self.seen)
+            if i >= self.reservoir:
+                return
+        elif i == len(self.steps):
+            capacity = 2 * len(self.steps)
+            self.steps = np.resize(self.steps, capacity)
+            self.values = np.resize(self.values, capacity)
+            self.walltimes = np.resize(self.walltimes, capacity)
+        self.steps[i] = step
+        self.values[i] = value
+        self.walltimes[i] = walltime
+        if i == self.n:
+            self.n += 1
+
+    def points(self):
+        """Returns the kept (steps, values, walltimes) in step order."""
+        order = np.argsort(self.steps[:self.n], kind="stable")
+        return self.steps[:self.n][order], self.values[:self.n][order], self.walltimes[:self.n][order]
+
+
+class BufferedSummaryWriter():
+    """
+    A tensorboard writer shared by many runs (e.g. the replicates of a trial) that never writes in the caller.
+    Scalars are collected into arrays per run and tag and written by a background thread every flush_secs,
+    or sooner once max_buffer points are waiting. Other summaries are queued and written the same way.
+    downsample maps tag patterns to ("stride", n), which keeps every n-th point of the tag,
+    or ("reservoir", k), which keeps k points sampled uniformly from each flush interval.
+    Use run(log_dir) to get the writer of one run.
+    """
+    def __init__(self, flush_secs=10, max_buffer=10000, downsample=None, writer_class=None):
+        self.flush_secs = flush_secs
+        self.max_buffer = max_buffer
+        self.downsample = downsample or {}
+        self.writer_class = writer_class if writer_class is not None else SummaryWriter_
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.buffers = {}
+        self.calls = []
+        self.n_buffered = 0
+        self.counts = {}
+        self.rules = {}
+        self.writers = {}
+        self.closing = set()
+        self.dropped = 0
+        self.written = 0
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="summary_writer", daemon=True)
+        self._thread.start()
+
+    def run(self, log_dir):
+        """Returns the writer of the run logging to log_dir."""
+        return RunSummaryWriter(self, log_dir)
+
+    def _rule(self, tag):
+        rule = self.rules.get(tag, False)
+        if rule is False:
+            rule = next((rule for pattern, rule in self.downsample.items() if fnmatch.fnmatch(tag, pattern)), None)
+            self.rules[tag] = rule
+        return rule
+
+    def add_scalar(self, log_dir, tag, value, step, walltime=None):
+        rule = self._rule(tag)
+        key = (log_dir, tag)
+        with self.lock:
+            if rule is not None and rule[0] == "stride":
+                count = self.counts.get(key, 0)
+                self.counts[key] = count + 1
+                if count % rule[1]:
+                    self.dropped += 1
+                    return
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = ScalarBuffer(reservoir=rule[1] if rule is not None and rule[0] == "reservoir" else None)
+                self.buffers[key] = buffer
+            before = len(buffer)
+            buffer.append(int(step), float(value), time.time() if walltime is None else walltime)
+            self.n_buffered += len(buffer) - before
+            full = self.n_buffered >= self.max_buffer
+        if full:
+            self._wake.set()
+
+    def add_call(self, log_dir, method, *args, **kwargs):
+        """Queues any other SummaryWriter call (histograms, text, images) for the writer thread."""
+        with self.lock:
+            self.calls.append((log_dir, method, args, kwargs))
+            full = len(self.calls) >= self.max_buffer
+        if full:
+            self._wake.set()
+
+    def _writer(self, log_dir):
+        writer = self.writers.get(log_dir)
+        if writer is None:
+            writer = self.writer_class(log_dir=log_dir)
+            self.writers[log_dir] = writer
+        return writer
+
+    def flush(self, wait=False):
+        """Asks the writer thread to write what is buffered. With wait the writes are done in this thread."""
+        if wait:
+            self._write()
+        else:
+            self._wake.set()
+
+    def _write(self):
+        with self.flush_lock:
+            with self.lock:
+                buffers, self.buffers = self.buffers, {}
+                calls, self.calls = self.calls, []
+                closing, self.closing = self.closing, set()
+                for buffer in buffers.values():
+                    self.dropped += buffer.seen - len(buffer)
+                self.n_buffered = 0
+            for (log_dir, tag), buffer in buffers.items():
+                writer = self._writer(log_dir)
+                for step, value, walltime in zip(*buffer.points()):
+                    writer.add_scalar(tag, value, int(step), walltime=walltime)
+                self.written += len(buffer)
+            for log_dir, method, args, kwargs in calls:
+                getattr(self._writer(log_dir), method)(*args, **kwargs)
+            for log_dir in set(log_dir for log_dir, _ in buffers) | set(call[0] for call in calls):
+                self.writers[log_dir].flush()
+            for log_dir in closing:
+                writer = self.writers.pop(log_dir, None)
+                if writer is not None:
+                    writer.close()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_secs)
+            self._wake.clear()
+            try:
+                self._write()
+            except Exception as error:
+                # a failed write must not stop the logging of the other runs
+                print("Could not write summaries: ", error)
+
+    def close_run(self, log_dir, wait=True):
+        """Writes what is buffered for log_dir and closes its event file."""
+        with self.lock:
+            self.closing.add(log_dir)
+        self.flush(wait)
+
+    def close(self):
+        """Writes everything buffered, stops the writer thread and closes the event files."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        with self.lock:
+            self.closing.update(self.writers)
+        self._write()
+
+
+class RunSummaryWriter():
+    """
+    The writer of one run of a BufferedSummaryWriter, with the add_* methods of SummaryWriter.
+    Calls only append to the shared buffers. close writes the buffered summaries of the run.
+    """
+    def __init__(self, shared, log_dir):
+        self.shared = shared
+        self.log_dir = log_dir
+        self.step = 0
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None, **kwargs):
+        """Add a scalar to the Tensorboard summary."""
+        if global_step is None:
+            global_step = self.step
+        self.shared.add_scalar(self.log_dir, tag, scalar_value, global_step, walltime)
+
+    def add_scalars(self, main_tag, tag_scalar_dict, global_step=None, walltime=None):
+        for tag, value in tag_scalar_dict.items():
+            self.add_scalar(main_tag + "/" + tag, value, global_step, walltime)
+
+    def add_histogram(self, tag, values, global_step=None, bins='auto', **kwargs):
+        """Add a histogram to the Tensorboard summary."""
+        if global_step is None:
+            global_step = self.step
+        # copied, the caller may reuse the array
+        self.shared.add_call(self.log_dir, "add_histogram", tag, np.array(values), global_step, bins, **kwargs)
+
+    def add_image(self, tag, img_tensor, global_step=None, **kwargs):
+        """Add an image to the Tensorboard summary."""
+        if global_step is None:
+            global_step = self.step
+        self.shared.add_call(self.log_dir, "add_image", tag, np.array(img_tensor), global_step, **kwargs)
+
+    def add_text(self, tag, text_string, global_step=None, **kwargs):
+        if global_step is None:
+            global_step = self.step
+        self.shared.add_call(self.log_dir, "add_text", tag, text_string, global_step, **kwargs)
+
+    def flush(self):
+        """Asks the writer thread to write the buffered summaries, without waiting for it."""
+        self.shared.flush()
+
+    def close(self):
+        self.shared.close_run(self.log_dir)
+
 
+_summary_writer = None
+_summary_writer_lock = threading.Lock()
 
 
+def get_summary_writer(flush_secs=10, max_buffer=10000, downsample=None):
+    """
+    Returns the BufferedSummaryWriter shared by every experiment in this process, creating it on first use.
+    The settings of the first call are used. It is closed at exit, so nothing buffered is lost
+    when the daemon writer thread is stopped.
+    """
+    global _summary_writer
+    with _summary_writer_lock:
+        if _summary_writer is None:
+            _summary_writer = BufferedSummaryWriter(flush_secs, max_buffer, downsample)
+            atexit.register(_summary_writer.close)
+        return _summary_writer
+
 
 class live_GROMACS_log_reader():
     """
     A class to read the live GROMACS log file and reads the data out when called.
-    To start with this will only read out the last line of the log file.
-    Eventually it will read the entire log file and return a pandas dataframe.
-    When it is called it will need to consider the data already read out.
+    The reader remembers the byte offset it has read up to, so each call only
+    parses the bytes appended since the previous call.
+    Completed energy blocks are pushed to the SummaryWriter (if given) as
+    name/term scalars at global step: step + step_offset.
+    With live=True the log is polled from a background thread every frequency seconds
+    using start() and stop(), so that the reader runs alongside mdrun.
+    The records are also passed to monitor (e.g. a ConvergenceMonitor) if given.
     """
     def __init__(self, 
-                 name, 
-                 live=False,
-                 log_type,
+                 name,
                  log_file,
-                 frequency=0):
+                 log_type="energy",
+                 writer=None,
+                 live=False,
+                 frequency=5,
+                 step_offset=0,
+                 monitor=None):
         self.name = name
         self.path = log_file
-        self.data = pd.DataFrame()
         self.log_type = log_type
+        self.writer = writer
+        self.live = live
+        self.frequency = frequency
+        self.step_offset = step_offset
+        self.monitor = monitor
+        self.table = GROMACS_energy_table()
+        self.last_step = None
+        self.reset()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def reset(self):
+        """Resets the reader to the start of the log file."""
+        self.offset = 0
+        self.inode = None
+        self.remainder = b""
+        self.parser = GROMACS_energy_parser()
 
     def read_log(self):
+        """
+        Reads the bytes appended to the log since the last call.
+        Returns the list of newly completed (step, time, energies) records.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        # mdrun backs up an existing log and starts a new file
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return []
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read(stat.st_size - self.offset)
+        self.offset += len(chunk)
+
+        lines = (self.remainder + chunk).split(b"\n")
+        # the last entry is an incomplete line (or empty)
+        self.remainder = lines.pop()
+        records = self.parser.feed(line.decode(errors="replace") for line in lines)
+
+        if records:
+            self.table.extend(records)
+            self.last_step = records[-1][0]
+            if self.writer is not None:
+                self.write_records(records)
+        if self.monitor is not None:
+            self.monitor.feed(records)
+        return records
+
+    def write_records(self, records):
+        """Writes the energy records to the SummaryWriter."""
+        for step, time, energies in records:
+            global_step = step + self.step_offset
+            for term, value in energies.items():
+                self.writer.add_scalar(self.name + "/" + term, value, global_step=global_step)
+        # the buffered writer is written on its own schedule and at exit
+        if not isinstance(self.writer, RunSummaryWriter):
+            self.writer.flush()
+
+    def to_dataframe(self):
+        """Returns the energies read so far as a dataframe."""
+        return self.table.to_dataframe()
+
+    def _poll(self):
+        while not self._stop_event.wait(self.frequency):
+            try:
+                self.read_log()
+            except OSError as e:
+                print("Could not read log file: ", self.path, e)
+
+    def start(self):
+        """Starts polling the log file in a background thread."""
+        if not self.live or self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._poll,
+                                        name="log_reader_" + self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and reads whatever is left in the log."""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        return self.read_log()
+
+    def __enter__(self):
+        self.start()
+        return self
 
-        
\ No newline at end of file
+    def __exit__(self, *exc):
+        self.stop()
@@ -8,12 +8,17 @@ import glob
 import shutil
 import subprocess
 from abc import ABC, abstractmethod
-import pandas as pd
-import argparse
+import queue
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 from xMD.MD_Experiment import MD_Experiment
 from xMD.MD_Settings import GROMACS_Settings
-from xMD.AuxMD import run_MD, traj_to_pdb
+from xMD.AuxMD import run_MD, traj_to_pdb, partition_cores, mdrun_thread_options, collect_parts, part_files, part_number, \
+    aggregate_performance
+from xMD.MDP import extension as extend_segment
+from xMD.Tracing import span
 
 class xMD(MD_Experiment):
     def __init__(self, settings: GROMACS_Settings, name=None, pdbcode: str = None, rep=None):
@@ -25,60 +30,324 @@ class xMD(MD_Experiment):
                        config_files=None, 
                        topology_files=None, 
                        rep=None, 
-                       md_steps:int=None):
+                       md_steps:int=None,
+                       monitor:bool=False,
+                       pipeline:bool=False,
+                       resume:bool=False):
         """
         This will run the experiment for the trial.
         suffix is the suffix for the initial topology files. 
         Should revert back to the suffix set in the settings.
+        If monitor is True the energies in the mdrun log are streamed to tensorboard.
+        If pipeline is True each finished segment is analysed in a background worker
+        while the next segment runs, otherwise only the last segment is analysed at the end.
+        If resume is True completed segments are skipped and an interrupted segment is
+        continued from its checkpoint, so the experiment can be re-run safely.
+        If settings.trace is set the time spent in each stage is written to a trace in the logs directory.
+        If settings.structure_analysis is set the RMSD, Rg and contacts of each frame are added to the dataframe.
+        If settings.archive is set the trajectories are then replaced by the archive tiers (see archive_replicate).
         """
         ### TODO more flexibile setup of experiment
         # how do we make sure settings are not overwritten by this method?
-        # TODO setup tensorboard logging
-        # write parser for gromacs outputs
-        # write tensorboard logger
-        # use threading to run logger concurrently
         self.set_replicate(rep)
-        self.prepare_simulation(search,
-                                config_files=config_files,
-                                topology_files=topology_files)
-        if md_steps is None:
-            md_steps = len(self.config_files)
-        if len(self.config_files) == 1:
-            self.config_files = self.config_files * md_steps
-        assert len(self.config_files) == md_steps, "Number of config files must match number of steps"
-
-        tpr_path = self.run_MD_step()
-        traj_file, pdb_top_file = self.prepare_analysis(tpr_path=tpr_path)
-        self.run_analysis(traj_file=traj_file, tpr_path=tpr_path, pdb_top=pdb_top_file)
+        with self.trace_experiment():
+            if monitor:
+                self.prepare_TB_writer()
+            with span("prepare_simulation"):
+                self.prepare_simulation(search,
+                                        config_files=config_files,
+                                        topology_files=topology_files)
+            if md_steps is None:
+                md_steps = len(self.config_files)
+            if len(self.config_files) == 1:
+                self.config_files = self.config_files * md_steps
+            assert len(self.config_files) == md_steps, "Number of config files must match number of steps"
+
+            if pipeline:
+                self.run_pipelined(resume)
+            else:
+                try:
+                    tpr_path = self.run_MD_step(resume=resume)
+                finally:
+                    self.close_TB_writer()
+                if not (resume and self.analysis_complete(tpr_path)):
+                    self.analyse_segment(tpr_path)
+            with span("load_energy_logs"):
+                self.load_energy_logs()
+            if getattr(self.settings, "structure_analysis", False):
+                self.analyse_structure()
+            if getattr(self.settings, "archive", False):
+                self.archive_replicate()
+
+    def run_pipelined(self, resume=False):
+        """
+        Runs the MD steps with the post-processing of each finished segment
+        (pbc conversion and pdb output) overlapped with the next segment's grompp/mdrun.
+        Returns once every segment has been run and analysed.
+        """
+        futures = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            def segment_done(tpr_path):
+                print("Queueing analysis of: ", tpr_path)
+                # in a copy of this thread's context so the analysis is traced with the run
+                futures.append(executor.submit(contextvars.copy_context().run, self.analyse_segment, tpr_path))
+            try:
+                tpr_path = self.run_MD_step(segment_done=segment_done, resume=resume)
+            finally:
+                self.close_TB_writer()
+        # re-raise any errors from the analysis worker
+        for future in futures:
+            future.result()
+        return tpr_path
+
+    def analyse_segment(self, tpr_path):
+        """
+        Prepares and runs the analysis for the segment written to tpr_path.
+        Returns the pbc corrected trajectory and pdb file.
+        """
+        with span("analyse_segment", "analysis", tpr=tpr_path):
+            traj_file, pdb_top_file = self.prepare_analysis(tpr_path=tpr_path)
+            self.run_analysis(traj_file=traj_file, tpr_path=tpr_path, pdb_top=pdb_top_file)
+        return traj_file, pdb_top_file
+
+    def run_replicates(self,
+                       reps=None,
+                       n_parallel=None,
+                       total_cores=None,
+                       pin_stride=1,
+                       **run_kwargs):
+        """
+        Runs several replicates of the experiment concurrently on one node.
+        The cores are split into n_parallel disjoint sets and each running replicate
+        is pinned to its own set with -nt/-ntomp, -pinoffset and -pinstride.
+        run_kwargs are passed on to run_experiment.
+        If settings.staging_directory is set each finished replicate is staged there in the background.
+        Returns a dict of ns/day per replicate, the aggregate ns/day (the sum of the replicates' Performance
+        ns/day, estimated from their mean if they did not all run at once) and the staging reports.
+        Raises StagingError once every replicate has finished if any of their files could not be staged.
+        """
+        from xMD.Staging import StagingError
+
+        if reps is None:
+            reps = list(range(1, self.settings.replicates + 1))
+        if n_parallel is None:
+            n_parallel = len(reps)
+
+        core_sets = queue.Queue()
+        for pin_offset, n_threads in partition_cores(n_parallel, total_cores, pin_stride):
+            core_sets.put(mdrun_thread_options(n_threads, pin_offset, self.gmx[0], pin_stride))
+
+        staging = []
+        stage = getattr(self.settings, "staging_directory", None) is not None
+
+        def run_replicate(rep):
+            # each replicate gets its own copy so rep_no and traj_no are not shared
+            experiment = deepcopy(self)
+            mdrun_opts = core_sets.get()
+            try:
+                experiment.mdrun_opts = self.mdrun_opts + mdrun_opts
+                print(f"Running replicate {rep} with: ", experiment.mdrun_opts)
+                experiment.run_experiment(rep=rep, **run_kwargs)
+            finally:
+                core_sets.put(mdrun_opts)
+            if stage:
+                # the finished replicate is copied home while the next one runs
+                staging.append(experiment.load_trajectory_files(rep=rep, background=True))
+            return experiment
+
+        start = time.time()
+        # every replicate runs in its own copy of the context, so a tracer set by the caller
+        # is kept while the tracers the replicates set are not shared
+        contexts = [contextvars.copy_context() for _ in reps]
+        with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+            experiments = list(executor.map(lambda context, rep: context.run(run_replicate, rep), contexts, reps))
+        wall_time = time.time() - start
+        staging_failures = []
+        for i, future in enumerate(staging):
+            try:
+                staging[i] = future.result()
+            except StagingError as error:
+                staging[i] = error.report
+                staging_failures.append(error)
+
+        performance = {rep: experiment.replicate_performance(rep)
+                       for rep, experiment in zip(reps, experiments)}
+        import pandas as pd
+        self.dataframe = pd.concat([self.dataframe] + [experiment.dataframe for experiment in experiments],
+                                   ignore_index=True)
+        aggregate, estimated = aggregate_performance(list(performance.values()), n_parallel, len(reps))
+        print(f"Ran {len(reps)} replicates, {n_parallel} at a time in {wall_time:.1f} s")
+        print("ns/day per replicate: ", performance)
+        print("Aggregate ns/day" + (" (estimate)" if estimated else "") + ": ", aggregate)
+        for error in staging_failures:
+            print("ERROR: ", error)
+        if staging_failures:
+            raise staging_failures[0]
+        return {"replicates": performance, "aggregate": aggregate, "aggregate_estimated": estimated,
+                "wall_time": wall_time, "staging": staging}
+
+    def tune_mdrun(self,
+                   rep=None,
+                   cores=None,
+                   layouts=None,
+                   nsteps=None):
+        """
+        Benchmarks mdrun layouts for this system with short probe runs of settings.probe_mdp
+        and caches the fastest in settings.mdrun_tuning, so later runs use it.
+        The probes run in the temporary directory of the replicate. The pinning options in
+        mdrun_opts are kept. Returns the probe results, fastest first.
+        """
+        from .Autotune import MDRunTuner, option_cores, remove_layout_options
+
+        if getattr(self.settings, "mdrun_tuning", None) is None:
+            raise ValueError("settings.mdrun_tuning must be set to the path of the tuning cache.")
+        self.set_replicate(rep)
+        self.prepare_simulation(self.settings.search, config_files=[self.settings.probe_mdp])
+        probe_mdp, input_path, topo_path, _ = super().run_MD_step()
+        if cores is None:
+            cores = option_cores(self.mdrun_opts)
+        work_dir = os.path.join(self.dirs[self.settings.temporary_directory],
+                                self.settings.rep_directory + str(self.rep_no), "probe")
+        tuner = MDRunTuner(self.settings.mdrun_tuning)
+        return tuner.tune(probe_mdp[0], input_path, topo_path, work_dir,
+                          gmx=self.gmx[0],
+                          gpu=self.settings.gpu,
+                          cores=cores,
+                          layouts=layouts,
+                          nsteps=nsteps,
+                          pin_opts=remove_layout_options(self.mdrun_opts),
+                          artifact_store=self.get_artifact_store())
 
     ## TODO add repeat steps - run for as many mdp files are provided.
-    def run_MD_step(self):
+    def run_MD_step(self, segment_done=None, resume=False):
         """
         This will run the steps of MD for the trial.
+        Each segment is written to its own trajectory number.
+        segment_done is called with the tpr path of each segment once it has finished.
+        With resume, complete segments are skipped and interrupted ones continue from their checkpoint.
         Retruns the tpr file name.
         """
 
+        from xMD.MD_Log import last_energy_step
+
         md_mdp, input_path, topo_path, tpr_path = super().run_MD_step()
 
         assert isinstance(md_mdp, list), "md_mdp must be a list of mdp files"
 
-        for mdp in md_mdp:
+        artifact_store = self.get_artifact_store()
+        step_offset = 0
+        # step offset and mdrun part number of the previous segment, an extended segment continues its steps
+        segment_offset = 0
+        part = 1
+        # a segment stopped at convergence ended before its nsteps, so the next one cannot extend it
+        stopped_early = False
+        for i, mdp in enumerate(md_mdp):
+            previous_tpr = tpr_path
+            if i > 0:
+                # do not overwrite the previous segment
+                self.set_trajectory_number(self.traj_no + 1)
+                _,_,_, tpr_path = super().run_MD_step()
+
+            deffnm = tpr_path.replace(".tpr", "")
+            status = self.segment_status(tpr_path) if resume else "new"
+            if status == "complete":
+                print("Segment already complete, skipping: ", tpr_path)
+                # mdrun may have finished before its part files were collected
+                collect_parts(deffnm)
+                input_path = tpr_path.replace(".tpr", ".gro")
+                # advance the step offset and part number as if the segment had run
+                if (i > 0 and getattr(self.settings, "extend_segments", False) and not stopped_early
+                        and extend_segment(md_mdp[i - 1], mdp) is not None):
+                    part += 1
+                    step_offset = segment_offset
+                else:
+                    part = 1
+                segment_offset = step_offset
+                last_step = last_energy_step(deffnm + ".log") if os.path.exists(deffnm + ".log") else None
+                if last_step is not None:
+                    step_offset += last_step
+                stopped_early = any(segment["traj_no"] == self.traj_no and segment["status"] == "converged"
+                                    for segment in self.segments)
+                if segment_done is not None and not self.analysis_complete(tpr_path):
+                    segment_done(tpr_path)
+                continue
+            checkpoint = None
+            if status == "checkpoint":
+                checkpoint = tpr_path.replace(".tpr", ".cpt")
+                print("Continuing segment from checkpoint: ", checkpoint)
+
+            mdrun_opts = self.tuned_mdrun_opts(input_path)
+            extension = None
+            if (i > 0 and checkpoint is None and getattr(self.settings, "extend_segments", False)
+                    and not stopped_early and os.path.exists(previous_tpr.replace(".tpr", ".cpt"))):
+                extension = extend_segment(md_mdp[i - 1], mdp)
+            log_path = None
+            if extension is not None:
+                print("Only the run length changes, extending the previous segment: ", previous_tpr)
+                if "-nstlist" not in mdrun_opts:
+                    mdrun_opts = mdrun_opts + extension["mdrun_opts"]
+                # mdrun -noappend numbers the outputs after the part of the checkpoint
+                part += 1
+                log_path = f"{deffnm}.part{part:04d}.log"
+                step_offset = segment_offset
+            elif checkpoint is not None and part_files(deffnm):
+                part = max(part_number(path) for paths in part_files(deffnm).values() for path in paths) + 1
+                log_path = f"{deffnm}.part{part:04d}.log"
+            else:
+                part = 1
+            segment_offset = step_offset
+
+            monitor = None
+            supervised = getattr(self.settings, "mdrun_supervised", False)
+            convergence = getattr(self.settings, "convergence", None)
+            if convergence and supervised:
+                from xMD.Convergence import ConvergenceMonitor
+
+                monitor = ConvergenceMonitor.for_segment(convergence, mdp, os.path.basename(deffnm),
+                                                         xtc_path=(log_path or deffnm + ".log").replace(".log", ".xtc"),
+                                                         structure_path=input_path)
+            elif convergence:
+                print("Convergence is only monitored with mdrun_supervised, running the full segment")
 
-            input_path = run_MD(mdp, 
-                                input_path, 
-                                topo_path, 
-                                tpr_path, 
-                                self.gmx[0],
-                                self.settings.gpu)
+            # the log reader runs in its own thread alongside mdrun
+            log_reader = self.prepare_log_reader(tpr_path, step_offset, log_path, monitor)
+            if log_reader is not None:
+                log_reader.start()
+            try:
+                with span("segment", "md", traj_no=self.traj_no, mdp=mdp, extended=extension is not None):
+                    input_path = run_MD(mdp, 
+                                        input_path, 
+                                        topo_path, 
+                                        tpr_path, 
+                                        self.gmx[0],
+                                        self.settings.gpu,
+                                        mdrun_opts,
+                                        checkpoint,
+                                        artifact_store,
+                                        extend_from=previous_tpr if extension is not None else None,
+                                        extend_ps=extension["extend_ps"] if extension is not None else None,
+                                        supervise=supervised,
+                                        timeout=getattr(self.settings, "mdrun_timeout", None),
+                                        writer=self.writer,
+                                        step_offset=step_offset,
+                                        on_start=monitor.attach if monitor is not None else None)
+            finally:
+                if log_reader is not None:
+                    log_reader.stop()
+                    if log_reader.last_step is not None:
+                        step_offset += log_reader.last_step
             
             self.set_trajectory_number()
 
             _,_,_, tpr_path = super().run_MD_step() 
+            stopped_early = monitor is not None and monitor.converged_step is not None
+            self.record_segment(self.traj_no, mdp, tpr_path, status="converged" if stopped_early else "complete")
+            if segment_done is not None:
+                segment_done(tpr_path)
     
             # add log file to tensorboard as text
         return tpr_path
 
-### TODO create analysis commands - add data to the dataframe
     def run_analysis(self, traj_file=None, tpr_path=None, pdb_top=None):
 
         
@@ -87,4 +356,5 @@ class xMD(MD_Experiment):
         
         traj_to_pdb(traj_file,
                     pdb_top,
-                    pdb_path)
+                    pdb_path,
+                    getattr(self.settings, "trajectory_backend", "gmx"))